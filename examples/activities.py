@@ -3,12 +3,12 @@
 to run in python terminal:
 python -c "execfile('examples/activities.py')"
 '''
-from bson.code import Code
 from examples.helpers import Nameable, make_list
 from random import random
 from whiskeynode import WhiskeyNode
 from whiskeynode.db import db
 from whiskeynode.edges import Edge
+from whiskeynode.snapshots import GraphSnapshot
 from whiskeynode.terminals import outbound_node, outbound_list, inbound_list, bidirectional_list
 
 
@@ -183,27 +183,21 @@ if __name__ == '__main__':
             make_list(['%s does %s' % (User.from_id(x['outboundId']).name, Activity.from_id(x['inboundId']).name) for x in edge_cursor])
 
 
-    print '\nPart 7: Using MongoDB Group aggregation to find users with common activites.'
+    print '\nPart 7: Using MongoDB aggregation to find users with common activites.'
     comp_user = User.find_one() 
     print "Finding users with activites in common with %s. \n%s's activities are: %s" %(comp_user.name, comp_user.name, str(make_list(comp_user.activities)))
 
-    #Hark! Javascript?! Tell the database to tally results; we initialize the count to zero when we make our group call.
-    reducer=Code("function(obj, result) {result.count+=1 }")
-    query = {
+    #one $match/$group over the edges of everyone who does one of comp_user's activities, tallied in the database
+    for user_id, count in comp_user.activities.most_shared():
+        print '%s has %s activities in common with %s'%(comp_user.name, count, User.from_id(user_id).name)
 
-                        'inboundId':{'$in':[act._id for act in list(comp_user.activities)]},
-                        'name':'activities',
-                        'outboundCollection':User.COLLECTION_NAME,
-                        'outboundId': {'$ne':comp_user._id},
-                    }
 
-    common_activities_users = Edge.COLLECTION.group(key=['outboundId'], 
-                                            condition=query,
-                                            initial={"count": 0},
-                                            reduce=reducer)
-
-    print common_activities_users
-
-    for cau in common_activities_users:
-        print '%s has %s activities in common with %s'%(comp_user.name, cau['count'], User.from_id(cau['outboundId']).name)
+    print '\nPart 8: Using a graph snapshot to find users with common activities and related activities.'
+    #one query for every user's activities, then everything else happens in memory
+    snapshot = GraphSnapshot.from_terminal(User, 'activities')
+    for user_id, count in snapshot.ranked(snapshot.co_occurrence(comp_user._id)):
+        print '%s has %s activities in common with %s'%(comp_user.name, count, User.from_id(user_id).name)
 
+    related = GraphSnapshot.from_terminal(Activity, 'relatedAbilities')
+    rank = related.pagerank(snapshot.neighbours(comp_user._id))
+    print '%s might like' % comp_user.name, make_list(Activity.from_ids([x for x, score in related.ranked(rank, limit=3, exclude=snapshot.neighbours(comp_user._id))]))
@@ -7,14 +7,13 @@ from examples.helpers import Nameable
 from random import random
 from whiskeynode import WhiskeyNode
 from whiskeynode.db import db
-from whiskeynode.edges import Edge
 from whiskeynode.terminals import outbound_node, bidirectional_list, inbound_list, bidirectional_list
 
 
 '''
 
-this is an example of finding friends of friends. The query is pretty borked because our 
-bidirectional friends terminal isn't directed, so we have to search for inbound and outbound relationsships
+this is an example of finding friends of friends. our bidirectional friends terminal isn't directed, 
+so every level of the search looks at inbound and outbound relationships, whiskeynode.graph takes care of that
 
 '''
 
@@ -63,58 +62,13 @@ if __name__ == '__main__':
     user_a = users[0]
     user_b = users[-1]
 
-    friend_ids = [user_a._id]
-
-    count = 0
-
-    #look at all george's friends, then look at all of their friends, then look at all of their friends, until kevin's id is returned
-
-    while(True):
-        #get friends
-        friends_of_friend_ids = Edge.COLLECTION.find({
-                '$or':[
-                    {
-                        '$and':[
-                            {
-                                'name':'friends',
-                                'outboundCollection':User.COLLECTION_NAME,
-                                'outboundId':{'$in':friend_ids},
-                            },
-                            {
-                                'name':'friends',
-                                'outboundCollection':User.COLLECTION_NAME,
-                                'inboundId':{'$nin':friend_ids},
-                            }
-                        
-                        ]
-                    },
-                    {
-                        '$and':[
-                            {
-                                'name':'friends',
-                                'outboundCollection':User.COLLECTION_NAME,
-                                'inboundId':{'$in':friend_ids},
-                            },
-                            {
-                                'name':'friends',
-                                'outboundCollection':User.COLLECTION_NAME,
-                                'outboundId':{'$nin':friend_ids},
-                            }
-                        
-                        ]
-                    }
-                ]
-                
-                    
-            }).distinct('inboundId')
-
-        if len(friends_of_friend_ids) == 0:
-            print '%s and %s are not connected' % (user_a.name, user_b.name)
-            break
-        if user_b._id in friends_of_friend_ids: 
-            print 'Found %s and %s are seperated by %d relationships' % (user_a.name, user_b.name, count + 1)
-            break
-        else:
-            count = count + 1
-            friend_ids = friend_ids + friends_of_friend_ids
+    #walks out from george and back from kevin a level at a time, one edge query per direction per level
+    path = user_a.friends.shortest_path(user_b)
 
+    if path is None:
+        print '%s and %s are not connected' % (user_a.name, user_b.name)
+    else:
+        print 'Found %s and %s are seperated by %d relationships' % (user_a.name, user_b.name, len(path) - 1)
+        print 'through: ', [x.name for x in User.from_ids(path)]
+
+    print '%s\'s friends of friends: ' % user_a.name, [x.name for x in User.from_ids(user_a.friends.k_hop(2)[-1])]
@@ -20,6 +20,7 @@ class Node(WhiskeyNode):
     FIELDS = {
         'myVar':int,
     }
+    CACHE_SORTED_INDEXES = set(['myVar'])
     def __init__(self, *args, **kwargs):
         WhiskeyNode.__init__(self, *args, **kwargs)
 nodes = [Node({'myVar':i}) for i in range(10000)]
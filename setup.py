@@ -21,6 +21,7 @@ setup(
       author_email='austinellis@gmail.com',
       py_modules=['whiskeynode'],
       install_requires=install_requires,
+      extras_require={'snapshots':['numpy']},
       scripts=[],
       namespace_packages=[]
       )
@@ -0,0 +1,33 @@
+from mongomock.filtering import filter_applies
+from operator import itemgetter
+import mock
+
+
+def aggregate(collection, pipeline, **kwargs):
+    ''' stands in for mongomock's aggregate, whose $group can't $sum a constant. runs the $match/$group/$sort/$limit 
+        pipelines edges are counted with, and answers like pymongo 2 '''
+    docs = None
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == '$match' and docs is None:
+            docs = list(collection.find(arg))
+        elif op == '$match':
+            docs = [x for x in docs if filter_applies(arg, x)]
+        elif op == '$group':
+            assert arg['count'] == {'$sum':1}, 'only counts are supported'
+            key = arg['_id'][1:]
+            counts = {}
+            for doc in docs:
+                counts[doc.get(key)] = counts.get(doc.get(key), 0) + 1
+            docs = [{'_id':k, 'count':v} for k, v in counts.iteritems()]
+        elif op == '$sort':
+            (field, direction), = arg.items()
+            docs.sort(key=itemgetter(field), reverse=direction < 0)
+        elif op == '$limit':
+            docs = docs[:arg]
+        else:
+            raise NotImplementedError('%s is not supported' % op)
+    return {'ok':1.0, 'result':docs}
+
+#decorate test cases that count edges with this
+patch_aggregate = mock.patch('mongomock.Collection.aggregate', aggregate)
@@ -1,15 +1,114 @@
+from bson.objectid import ObjectId
 from unittest import TestCase
+from whiskeynode import whiskeycache
 from whiskeynode.edges import Edge
+from whiskeynode.sessions import WhiskeySession
+import gc
+from tests import patch_aggregate
+import mock
 
 
 
+class AggregateCollection(object):
+    ''' looks like a pymongo 2 collection, aggregate returns a dict '''
+    name = 'aggregate_collection'
+    def __init__(self, result):
+        self.aggregate = mock.MagicMock(return_value={'ok':1.0, 'result':result})
+
+
+@patch_aggregate
 class EdgeBaseTest(TestCase):
     def tearDown(self):
         Edge.COLLECTION.drop()
+        whiskeycache.clear_cache()
 
 
     def test_init_should_return_yeah(self):
         d = Edge()
         self.assertIsInstance(d, Edge)
-        
 
+    def test_compact(self):
+        ''' edges keep their fields in slots, and _dict only has what isn't a field '''
+        self.assertTrue('outboundId' in Edge.__slots__)
+        e = Edge({'name':u'follows', 'extra':1})
+        self.assertEqual(e.name, u'follows')
+        self.assertEqual(e._dict, {'extra':1})
+        #no instance __dict__ was allocated (gc sees it if it was)
+        self.assertFalse(any(isinstance(x, dict) and '_dict' in x for x in gc.get_referents(e)))
+        e.save()
+        self.assertEqual(e._dict, {'extra':1})
+        doc = Edge.COLLECTION.find_one({'_id':e._id})
+        self.assertEqual((doc['name'], doc['extra']), (u'follows', 1))
+
+        e.data['weight'] = 2
+        with WhiskeySession() as session:
+            e.save(session=session)
+            self.assertEqual(sorted(session.pending[Edge.COLLECTION.full_name][1][0][1][1]['$set']), ['data', 'lastModified'])
+        self.assertEqual(Edge.COLLECTION.find_one({'_id':e._id})['data'], {'weight':2})
+
+        whiskeycache.clear_cache()
+        e = Edge.from_id(doc['_id'], projection=['name'])
+        self.assertEqual(e.data, {'weight':2}) #loaded on first touch
+        self.assertEqual(e._dict, {})
+
+    def test_compound_cache_indexes(self):
+        whiskeycache.clear_cache()
+        a, b, c = ObjectId(), ObjectId(), ObjectId()
+        e1 = Edge.create(a, 'x', b, 'y', u'likes', 'node')
+        e2 = Edge.create(a, 'x', c, 'y', u'likes', 'node')
+        e3 = Edge.create(a, 'x', c, 'y', u'follows', 'node')
+        e4 = Edge.create(b, 'y', c, 'y', u'likes', 'node')
+        self.assertEqual(whiskeycache._from_indexes(Edge, {'outboundId':a, 'name':u'likes'}), set([e1, e2]))
+        self.assertEqual(whiskeycache._from_indexes(Edge, {'outboundId':a}), set([e1, e2, e3])) #prefix
+        self.assertEqual(whiskeycache._from_indexes(Edge, {'inboundId':c, 'outboundCollection':'y', 'name':u'likes'}), set([e4]))
+        self.assertEqual(whiskeycache._from_indexes(Edge, {'outboundId':{'$in':[a, b]}, 'name':u'likes'}), set([e1, e2, e4]))
+        self.assertEqual(whiskeycache._from_indexes(Edge, {'$or':[{'outboundId':b}, {'inboundId':b}]}), set([e1, e4]))
+        self.assertEqual(whiskeycache._from_indexes(Edge, {'name':u'likes'}), None) #not the first field, scan
+
+        e3.name = u'likes' #moves to the new key
+        self.assertEqual(set(Edge.find({'outboundId':a, 'name':u'likes'})), set([e1, e2, e3]))
+        whiskeycache.remove(e4)
+        self.assertFalse(b in whiskeycache.COMPOUND_INDEXES[Edge.COLLECTION_NAME][('outboundId', 'name')]) #empty levels are pruned
+
+    def test_remove_while_the_insert_is_waiting(self):
+        a, b = ObjectId(), ObjectId()
+        edges = [Edge.create(a, 'x', b, 'y', u'likes', u'list') for i in range(3)]
+        session = WhiskeySession()
+        for edge in edges:
+            edge.save(session=session)
+        edges[0].remove() #goes in the session the insert is waiting in
+        Edge.remove_many(edges[1:2])
+        Edge.remove_many(edges[2:], session=session)
+        self.assertEqual(Edge.COLLECTION.find().count(), 0)
+        session.flush()
+        self.assertEqual(Edge.COLLECTION.find().count(), 0) #the flush didn't put them back
+
+    def test_count_by(self):
+        a, b, c = ObjectId(), ObjectId(), ObjectId()
+        for outbound_id, inbound_id in [(a, c), (b, c), (a, b)]:
+            Edge.create(outbound_id, 'x', inbound_id, 'y', u'likes', u'list').save()
+        Edge.create(a, 'x', ObjectId(), 'y', u'other', u'list').save()
+        query = {'outboundId':{'$in':[a, b]}, 'name':u'likes'}
+        self.assertEqual(Edge.count_by(query, 'outboundId'), [(a, 2), (b, 1)])
+        self.assertEqual(Edge.count_by(query, 'inboundId', min_count=2), [(c, 2)])
+        self.assertEqual(Edge.count_by(query, 'outboundId', limit=1), [(a, 2)])
+
+        unsaved = Edge.create(b, 'x', a, 'y', u'likes', u'list') #counted out of RAM
+        self.assertEqual(sorted(Edge.count_by(query, 'outboundId')), sorted([(a, 2), (b, 2)]))
+        self.assertEqual(Edge.count_by({'outboundId':b, 'name':u'likes'}, 'inboundId', skip_db=True), [(a, 1)])
+
+        #the db gets one $match/$group, and cuts the list itself when RAM has nothing to add
+        collection = AggregateCollection([{'_id':c, 'count':2}])
+        with mock.patch.object(Edge, 'COLLECTION', collection):
+            self.assertEqual(Edge.count_by({'inboundId':c}, 'inboundId', limit=5, min_count=2), [(c, 2)])
+        collection.aggregate.assert_called_once_with([
+                {'$match':{'inboundId':c}},
+                {'$group':{'_id':'$inboundId', 'count':{'$sum':1}}},
+                {'$match':{'count':{'$gte':2}}},
+                {'$sort':{'count':-1}},
+                {'$limit':5},
+            ])
+        collection = AggregateCollection([{'_id':b, 'count':1}])
+        with mock.patch.object(Edge, 'COLLECTION', collection):
+            self.assertEqual(sorted(Edge.count_by(query, 'outboundId', limit=5)), sorted([(b, 2)]))
+        self.assertEqual(len(collection.aggregate.call_args[0][0]), 2) #unsaved edges are added after
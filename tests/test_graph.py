@@ -0,0 +1,108 @@
+from unittest import TestCase
+from whiskeynode import WhiskeyNode
+from whiskeynode import whiskeycache
+from whiskeynode.db import db
+from whiskeynode.edges import Edge
+from whiskeynode.exceptions import InvalidTerminalOperationException
+from whiskeynode.terminals import outbound_node, outbound_list, inbound_list, bidirectional_list
+import mock
+import mongomock
+
+
+class Member(WhiskeyNode):
+    COLLECTION_NAME =   'graph_members'
+    COLLECTION =        db[COLLECTION_NAME]
+    FIELDS =            {
+                            'name':unicode,
+                        }
+    @classmethod
+    def init_terminals(cls):
+        cls.TERMINALS = {
+                            'friends':      bidirectional_list(Member),
+                            'follows':      outbound_list(Member),
+                            'followers':    inbound_list(Member, 'follows'),
+                            'mentor':       outbound_node(Member),
+                            'clubs':        outbound_list(Club),
+                        }
+
+
+class Club(WhiskeyNode):
+    COLLECTION_NAME =   'graph_clubs'
+    COLLECTION =        db[COLLECTION_NAME]
+
+
+class GraphTest(TestCase):
+    def tearDown(self):
+        self.__cleanup()
+
+    def __cleanup(self):
+        Edge.COLLECTION.drop()
+        Member.COLLECTION.drop()
+        Club.COLLECTION.drop()
+        whiskeycache.clear_cache()
+
+    def __chain(self, n, terminal):
+        members = [Member({'name':u'm%d' % i}) for i in range(n)]
+        for a, b in zip(members, members[1:]):
+            getattr(a, terminal).append(b)
+        map(lambda x:x.save(), members)
+        return members
+
+    def test_k_hop(self):
+        members = self.__chain(5, 'friends')
+        ids = [x._id for x in members]
+        self.assertEqual(members[0].friends.k_hop(1), [[ids[1]]])
+        self.assertEqual([sorted(x) for x in members[2].friends.k_hop(2)], [sorted([ids[1], ids[3]]), sorted([ids[0], ids[4]])])
+        self.assertEqual(members[0].friends.k_hop(10), [[x] for x in ids[1:]]) #stops when there's nowhere left to go
+
+        members[4].friends.append(members[0]) #a cycle, nothing is visited twice
+        self.assertEqual(sorted(sum(members[0].friends.k_hop(10), [])), sorted(ids[1:]))
+
+        calls = []
+        original = mongomock.Collection.find
+        def find(collection, *args, **kwargs):
+            calls.append(collection.name)
+            return original(collection, *args, **kwargs)
+        whiskeycache.clear_cache()
+        m = Member.from_id(ids[0])
+        with mock.patch('mongomock.Collection.find', find):
+            m.friends.k_hop(3)
+        self.assertEqual(calls, [Edge.COLLECTION_NAME] * 6) #one query per direction per hop, no nodes are loaded
+
+    def test_direction(self):
+        members = self.__chain(4, 'follows')
+        ids = [x._id for x in members]
+        self.assertEqual(members[1].follows.k_hop(5), [[ids[2]], [ids[3]]])
+        self.assertEqual(members[1].followers.k_hop(5), [[ids[0]]])
+        self.assertEqual(members[0].follows.shortest_path(members[3]), ids)
+        self.assertEqual(members[3].follows.shortest_path(members[0]), None)
+        self.assertEqual(members[3].followers.shortest_path(members[0]), ids[::-1])
+
+        members[1].mentor = members[0]
+        members[0].mentor = members[3]
+        self.assertEqual(members[1].k_hop('mentor', 3), [[ids[0]], [ids[3]]])
+        self.assertTrue(members[1].connected('mentor', members[3]))
+        self.assertEqual(members[0].shortest_path('followers', members[2]), None) #followers run the other way
+
+    def test_shortest_path(self):
+        members = self.__chain(8, 'friends')
+        ids = [x._id for x in members]
+        self.assertEqual(members[0].friends.shortest_path(members[7]), ids)
+        self.assertEqual(members[7].friends.shortest_path(members[0]._id), ids[::-1])
+        self.assertEqual(members[3].friends.shortest_path(members[3]), [ids[3]])
+        self.assertEqual(members[0].friends.shortest_path(members[7], max_depth=6), None)
+        self.assertEqual(len(members[0].friends.shortest_path(members[7], max_depth=7)), 8)
+
+        members[1].friends.append(members[6]) #a shortcut, not saved yet
+        self.assertEqual(members[0].friends.shortest_path(members[7]), [ids[0], ids[1], ids[6], ids[7]])
+
+        loner = Member()
+        self.assertFalse(members[0].friends.connected(loner))
+        self.assertTrue(members[0].friends.connected(members[5], max_depth=3))
+
+    def test_other_classes(self):
+        m = Member()
+        m.clubs.append(Club())
+        self.assertEqual(m.clubs.k_hop(1), [[m.clubs[0]._id]])
+        self.assertRaises(InvalidTerminalOperationException, m.clubs.k_hop, 2)
+        self.assertRaises(InvalidTerminalOperationException, m.clubs.shortest_path, m)
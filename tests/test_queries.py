@@ -0,0 +1,98 @@
+from unittest import TestCase
+from whiskeynode import WhiskeyNode
+from whiskeynode import queries
+from whiskeynode import whiskeycache
+from whiskeynode.db import db
+import mock
+
+
+class Q1(WhiskeyNode):
+    COLLECTION_NAME = 'queries_q1'
+    COLLECTION = db[COLLECTION_NAME]
+    FIELDS = {
+        'name':unicode,
+        'size':int,
+        'info':dict,
+        'tags':list,
+    }
+    def __init__(self, *args, **kwargs):
+        WhiskeyNode.__init__(self, *args, **kwargs)
+
+
+class QueriesTest(TestCase):
+    def setUp(self):
+        Q1.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        self.nodes = [
+            Q1({'name':u'a', 'size':1, 'info':{'color':'red', 'parts':[{'n':1}, {'n':2}]}, 'tags':['x', 'y']}),
+            Q1({'name':u'b', 'size':2, 'info':{'color':'blue'}, 'tags':['y']}),
+            Q1({'name':u'c', 'size':3, 'info':{}, 'tags':[], 'extra':True}),
+        ]
+
+    def tearDown(self):
+        Q1.COLLECTION.drop()
+        whiskeycache.clear_cache()
+
+    def names(self, query):
+        return sorted([x.name for x in whiskeycache.find(Q1, query, [('_id', -1)])])
+
+    def test_operators(self):
+        self.assertEqual(self.names({'size':{'$lt':2}}), ['a'])
+        self.assertEqual(self.names({'size':{'$lte':2}}), ['a', 'b'])
+        self.assertEqual(self.names({'size':{'$gte':2}}), ['b', 'c'])
+        self.assertEqual(self.names({'size':{'$gt':1, '$lt':3}}), ['b'])
+        self.assertEqual(self.names({'size':{'$in':[1, 3]}}), ['a', 'c'])
+        self.assertEqual(self.names({'size':{'$nin':[1, 3]}}), ['b'])
+        self.assertEqual(self.names({'name':{'$ne':'a'}}), ['b', 'c'])
+        self.assertEqual(self.names({'extra':{'$exists':True}}), ['c'])
+        self.assertEqual(self.names({'extra':{'$exists':False}}), ['a', 'b'])
+        self.assertEqual(self.names({'$or':[{'size':1}, {'name':'c'}]}), ['a', 'c'])
+        self.assertEqual(self.names({'$nor':[{'size':1}, {'name':'c'}]}), ['b'])
+        self.assertEqual(self.names({'$and':[{'size':{'$gt':1}}, {'name':'c'}]}), ['c'])
+
+    def test_arrays(self):
+        self.assertEqual(self.names({'tags':'y'}), ['a', 'b'])
+        self.assertEqual(self.names({'tags':{'$in':['x']}}), ['a'])
+        self.assertEqual(self.names({'tags':[]}), ['c'])
+
+    def test_dotted_paths(self):
+        self.assertEqual(self.names({'info.color':'red'}), ['a'])
+        self.assertEqual(self.names({'info.color':{'$exists':True}}), ['a', 'b'])
+        self.assertEqual(self.names({'info.color':None}), ['c'])
+        self.assertEqual(self.names({'info.parts.n':2}), ['a'])
+        self.assertEqual(self.names({'info.parts.n':{'$gt':1}}), ['a'])
+        self.assertEqual(self.names({'info.parts.0.n':2}), [])
+        self.assertEqual(self.names({'tags.1':'y'}), ['a'])
+
+    def test_unloaded_fields(self):
+        for x in self.nodes:
+            x.save()
+        self.nodes = []
+        whiskeycache.clear_cache()
+        loaded = list(Q1.find({}, projection=['name']))
+        with mock.patch('mongomock.Collection.find_one', wraps=Q1.COLLECTION.find_one) as find_one_mock:
+            self.assertEqual(queries.compile_query({'size':{'$gt':1}})(loaded[0]), None) #can't tell without loading it
+            self.assertEqual(self.names({'size':{'$gt':1}}), [])
+            self.assertEqual(whiskeycache.find_unmatched(Q1, {'size':{'$gt':1}}), [])
+            self.assertEqual(sorted([x.name for x in Q1.find({'size':{'$gt':1}})]), ['b', 'c']) #the db decides
+            self.assertEqual(self.names({'name':'a'}), ['a'])
+            self.assertEqual(find_one_mock.call_count, 0)
+        self.assertTrue(all('size' in x._unloaded for x in loaded))
+
+    def test_compiled_queries_are_reused(self):
+        queries.clear_compiled_queries()
+        queries.compile_query({'name':'a', 'size':{'$gt':1}})
+        queries.compile_query({'size':{'$gt':2}, 'name':'b'})
+        self.assertEqual(len(queries._compiled), 1)
+        queries.compile_query({'size':{'$lt':2}, 'name':'b'})
+        self.assertEqual(len(queries._compiled), 2)
+
+    def test_unsupported_operators_go_to_the_db(self):
+        self.assertEqual(queries.compile_query({'name':{'$regex':'a'}})(self.nodes[0]), None)
+        self.assertEqual(queries.compile_query({'$or':[{'size':1}, {'name':{'$regex':'b'}}]})(self.nodes[0]), True)
+        self.assertEqual(queries.compile_query({'size':2, 'name':{'$regex':'a'}})(self.nodes[0]), False)
+        for x in self.nodes:
+            x.save()
+        self.assertEqual(Q1.find_one({'name':{'$regex':'^b'}}).name, 'b') #in RAM, but the db answers
+        self.assertEqual(sorted([x.name for x in Q1.find({'name':{'$regex':'^[ab]'}})]), ['a', 'b'])
+        self.assertEqual(Q1.find_one({'tags':{'$all':['x', 'y']}}).name, 'a')
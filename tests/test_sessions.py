@@ -0,0 +1,98 @@
+from bson.objectid import ObjectId
+from unittest import TestCase
+from whiskeynode import WhiskeyNode
+from whiskeynode import whiskeycache
+from whiskeynode.db import db
+from whiskeynode.sessions import WhiskeySession
+import mock
+
+
+class BulkCollection(object):
+    ''' looks like a pymongo collection with the bulk api '''
+    name = 'bulk_collection'
+    full_name = 'test.bulk_collection'
+    def __init__(self):
+        self.bulk = mock.MagicMock()
+    def initialize_ordered_bulk_op(self):
+        return self.bulk
+
+
+class SessionNode(WhiskeyNode):
+    COLLECTION_NAME = 'sessions_nodes'
+    COLLECTION = db[COLLECTION_NAME]
+    FIELDS = {
+        'n':int,
+    }
+
+
+class SessionsTest(TestCase):
+    def setUp(self):
+        self.collection = db['sessions_test']
+        self.collection.drop()
+
+    def tearDown(self):
+        self.collection.drop()
+
+    def test_flush_without_bulk_api(self):
+        a, b, c = ObjectId(), ObjectId(), ObjectId()
+        with WhiskeySession() as session:
+            session.insert(self.collection, {'_id':a, 'n':1})
+            session.insert(self.collection, {'_id':b, 'n':2})
+            session.update(self.collection, {'_id':a}, {'$set':{'n':10}})
+            session.save(self.collection, {'_id':c, 'n':3})
+            self.assertEqual(len(session), 4)
+            self.assertEqual(self.collection.find().count(), 0) #nothing is written until the flush
+        self.assertEqual(len(session), 0)
+        self.assertEqual(session.write_counts, {'sessions_test':4})
+        self.assertEqual(sorted([x['n'] for x in self.collection.find()]), [2, 3, 10])
+
+    def test_flush_with_bulk_api(self):
+        collection = BulkCollection()
+        _id = ObjectId()
+        session = WhiskeySession()
+        session.insert(collection, {'_id':_id})
+        session.update(collection, {'_id':_id}, {'$set':{'n':1}})
+        session.remove(collection, {'_id':_id})
+        session.flush()
+        collection.bulk.insert.assert_called_once_with({'_id':_id})
+        self.assertEqual(collection.bulk.find.call_args_list, [mock.call({'_id':_id})] * 2)
+        collection.bulk.find.return_value.remove.assert_called_once_with()
+        self.assertEqual(collection.bulk.execute.call_count, 1)
+        self.assertEqual(session.write_counts, {'bulk_collection':3})
+
+    def test_collections_in_different_databases(self):
+        other = db.connection['sessions_other_db']['sessions_test']
+        other.drop()
+        with WhiskeySession() as session:
+            session.insert(self.collection, {'_id':ObjectId(), 'n':1})
+            session.insert(other, {'_id':ObjectId(), 'n':2})
+        self.assertEqual([x['n'] for x in self.collection.find()], [1])
+        self.assertEqual([x['n'] for x in other.find()], [2])
+        other.drop()
+
+    def test_no_flush_on_error(self):
+        try:
+            with WhiskeySession() as session:
+                session.insert(self.collection, {'_id':ObjectId()})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.collection.find().count(), 0)
+
+    def test_failed_flush_can_be_saved_again(self):
+        SessionNode.COLLECTION.drop()
+        node = SessionNode({'n':1})
+        with mock.patch('mongomock.Collection.insert', side_effect=ValueError()):
+            self.assertRaises(ValueError, node.save)
+        self.assertTrue(node._is_new_local) #put back the way it was
+        node.save()
+        self.assertEqual(SessionNode.COLLECTION.find_one(node._id)['n'], 1)
+
+        node.n = 2
+        with mock.patch('mongomock.Collection.update', side_effect=ValueError()):
+            self.assertRaises(ValueError, node.save)
+        self.assertEqual(SessionNode.COLLECTION.find_one(node._id)['n'], 1)
+        node.save()
+        self.assertEqual(SessionNode.COLLECTION.find_one(node._id)['n'], 2)
+        SessionNode.COLLECTION.drop()
+        whiskeycache.clear_cache()
@@ -0,0 +1,93 @@
+from unittest import TestCase, SkipTest
+from whiskeynode import WhiskeyNode
+from whiskeynode import whiskeycache
+from whiskeynode.db import db
+from whiskeynode.edges import Edge
+from whiskeynode.snapshots import GraphSnapshot, np
+from whiskeynode.terminals import outbound_list, inbound_list, bidirectional_list
+
+
+class Fan(WhiskeyNode):
+    COLLECTION_NAME =   'snapshot_fans'
+    COLLECTION =        db[COLLECTION_NAME]
+    @classmethod
+    def init_terminals(cls):
+        cls.TERMINALS = {
+                            'bands':        outbound_list(Band),
+                            'friends':      bidirectional_list(Fan),
+                        }
+
+
+class Band(WhiskeyNode):
+    COLLECTION_NAME =   'snapshot_bands'
+    COLLECTION =        db[COLLECTION_NAME]
+    @classmethod
+    def init_terminals(cls):
+        cls.TERMINALS = {
+                            'fans':         inbound_list(Fan, 'bands'),
+                            'influences':   outbound_list(Band),
+                        }
+
+
+class SnapshotsTest(TestCase):
+    def setUp(self):
+        if np is None:
+            raise SkipTest('numpy is not installed')
+
+    def tearDown(self):
+        Edge.COLLECTION.drop()
+        Fan.COLLECTION.drop()
+        Band.COLLECTION.drop()
+        whiskeycache.clear_cache()
+
+    def test_degrees_and_co_occurrence(self):
+        fans = [Fan() for i in range(4)]
+        bands = [Band() for i in range(3)]
+        fans[0].bands.extend(bands)
+        fans[1].bands.extend(bands[:2])
+        fans[2].bands.append(bands[2])
+        map(lambda x:x.save(), fans)
+        fans[3].bands.append(bands[0]) #not saved, snapshots only see the database
+
+        snapshot = GraphSnapshot.from_terminal(Fan, 'bands')
+        self.assertEqual((len(snapshot), snapshot.edge_count), (6, 6))
+        self.assertEqual([snapshot.degree(x._id) for x in fans], [3, 2, 1, 0])
+        self.assertEqual(sorted(snapshot.neighbours(fans[1]._id)), sorted([bands[0]._id, bands[1]._id]))
+        self.assertEqual(snapshot.degrees().sum(), 6)
+        self.assertEqual(snapshot.ranked(snapshot.co_occurrence(fans[0]._id)), [(fans[1]._id, 2), (fans[2]._id, 1)])
+        self.assertEqual(snapshot.ranked(snapshot.co_occurrence(fans[2]._id)), [(fans[0]._id, 1)])
+        self.assertEqual([snapshot.transpose().degree(x._id) for x in bands], [2, 2, 2]) #fans per band
+
+        inbound = GraphSnapshot.from_terminal(Band, 'fans') #the same edges from the other end
+        self.assertEqual(sorted(inbound.neighbours(bands[2]._id)), sorted([fans[0]._id, fans[2]._id]))
+        self.assertEqual(inbound.degree(fans[0]._id), 0)
+
+    def test_k_hop_and_pagerank(self):
+        fans = [Fan() for i in range(5)]
+        for a, b in zip(fans, fans[1:]):
+            a.friends.append(b)
+        map(lambda x:x.save(), fans)
+        ids = [x._id for x in fans]
+
+        snapshot = GraphSnapshot.from_terminal(Fan, 'friends')
+        self.assertEqual(snapshot.edge_count, 8) #both ways
+        self.assertEqual(snapshot.k_hop(ids[0], 10), [[x] for x in ids[1:]])
+        self.assertEqual([sorted(x) for x in snapshot.k_hop(ids[2], 2)], [sorted(ids[1:4:2]), sorted(ids[0:5:4])])
+        self.assertEqual([sorted(x) for x in snapshot.k_hop(ids[2], 2)], [sorted(x) for x in fans[2].friends.k_hop(2)]) #same as walking the terminals
+
+        rank = snapshot.pagerank()
+        self.assertAlmostEqual(rank.sum(), 1.0)
+        self.assertAlmostEqual(rank[snapshot.index[ids[0]]], rank[snapshot.index[ids[4]]]) #symmetric chain
+        self.assertTrue(rank[snapshot.index[ids[2]]] > rank[snapshot.index[ids[0]]])
+
+        ranked = snapshot.ranked(snapshot.pagerank([ids[0]]), exclude=[ids[0]])
+        self.assertEqual([x[0] for x in ranked], ids[1:]) #closer to the seed ranks higher
+
+        bands = [Band() for i in range(3)]
+        bands[0].influences.append(bands[1]) #bands[1] is dangling, its rank goes back to the seed
+        map(lambda x:x.save(), bands)
+        snapshot = GraphSnapshot.from_terminal(Band, 'influences')
+        rank = snapshot.pagerank([bands[0]._id])
+        self.assertAlmostEqual(rank.sum(), 1.0)
+        self.assertTrue(bands[2]._id not in snapshot)
+        self.assertEqual(snapshot.k_hop(bands[2]._id, 1), [])
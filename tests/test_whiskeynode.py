@@ -1,5 +1,6 @@
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
+from copy import deepcopy
 from datetime import datetime, timedelta
 from functools import partial
 from unittest import TestCase
@@ -7,7 +8,9 @@ from whiskeynode import WhiskeyNode
 from whiskeynode import whiskeycache
 from whiskeynode.db import db
 from whiskeynode.exceptions import InvalidFieldNameException, FieldNameNotDefinedException
+from whiskeynode.sessions import WhiskeySession
 import mock
+import weakref
 
 #properties that aren't listed in fields shouldn'd save
 class D1(WhiskeyNode):
@@ -54,6 +57,39 @@ class D5(WhiskeyNode):
     def __init__(self, *args, **kwargs):
         WhiskeyNode.__init__(self, *args, **kwargs)
 
+class D6(WhiskeyNode):
+    COLLECTION_NAME = 'd6'
+    COLLECTION = db[COLLECTION_NAME]
+    FIELDS = {
+        'myJaws':unicode,
+        'myNumber':int,
+    }
+    CACHE_INDEXES = set(['myJaws'])
+    def __init__(self, *args, **kwargs):
+        WhiskeyNode.__init__(self, *args, **kwargs)
+
+class D7(WhiskeyNode):
+    COLLECTION_NAME = 'd7'
+    COLLECTION = db[COLLECTION_NAME]
+    FIELDS = {
+        'myJaws':unicode,
+        'myNumber':int,
+    }
+    CACHE_SORTED_INDEXES = set(['myNumber'])
+    def __init__(self, *args, **kwargs):
+        WhiskeyNode.__init__(self, *args, **kwargs)
+
+class D8(WhiskeyNode):
+    COLLECTION_NAME = 'd8'
+    COLLECTION = db[COLLECTION_NAME]
+    FIELDS = {
+        'tags':list,
+        'kind':unicode,
+    }
+    CACHE_INDEXES = set(['tags', 'kind'])
+    def __init__(self, *args, **kwargs):
+        WhiskeyNode.__init__(self, *args, **kwargs)
+
 class DInvalid(WhiskeyNode):
     COLLECTION_NAME = 'DInvalid'
     COLLECTION = db[COLLECTION_NAME]
@@ -158,67 +194,194 @@ class DocumentBaseTest(TestCase):
         else:
             raise InvalidFieldNameException("invalid field names should raise an error")
 
+    def writes(self, node):
+        ''' saves the node, returns how many times it wrote to the db '''
+        session = WhiskeySession()
+        with mock.patch('mongomock.Collection.save'), mock.patch('mongomock.Collection.update'), mock.patch('mongomock.Collection.insert'):
+            node.save(session=session)
+            session.flush()
+        return sum(session.write_counts.values())
+
     def test_save(self):
         d1 = D3({'some_prop':'prop', 'some_dict':{'hey':'heyhey', 'um':{'yeah':'thats right'}}, 'some_list':['a', 'b', 'c']})
         self.assertTrue(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should save'
-            self.assertTrue(save_mock.call_count == 1)
+        self.assertEqual(self.writes(d1), 1)
 
         self.assertFalse(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should not save'
-            self.assertTrue(save_mock.call_count == 0)
+        self.assertEqual(self.writes(d1), 0)
         
         d1.myJaws = 'Big.'
         self.assertTrue(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should save'
-            self.assertTrue(save_mock.call_count == 1)
+        self.assertEqual(self.writes(d1), 1)
 
         #print 'should not save'
         d = d1._to_dict()
         d1 = D3.from_dict(d)
         self.assertFalse(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should not save'
-            self.assertTrue(save_mock.call_count == 0)
+        self.assertEqual(self.writes(d1), 0)
 
         #print 'should save'
         d1.lastModified = datetime.now()+timedelta(seconds=1)
         self.assertTrue(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should save'
-            self.assertTrue(save_mock.call_count == 1)
+        self.assertEqual(self.writes(d1), 1)
 
         d1.some_dict['hey'] = 'heyheyhey'
         self.assertTrue(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should save'
-            self.assertTrue(save_mock.call_count == 1)
+        self.assertEqual(self.writes(d1), 1)
 
         d1.some_dict['um']['yeah'] = 'what you say?'
         self.assertTrue(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should save'
-            self.assertTrue(save_mock.call_count == 1)
+        self.assertEqual(self.writes(d1), 1)
 
 
         d1.some_list.append('f')
         self.assertTrue(d1._diff_dict(d1._to_dict()) or d1._dirty)
-        with mock.patch('mongomock.Collection.save') as save_mock:
-            d1.save()
-            #print 'should save'
-            self.assertTrue(save_mock.call_count == 1)
+        self.assertEqual(self.writes(d1), 1)
 
 
+    def test_partial_updates(self):
+        D3.COLLECTION.drop()
+        d = D3({'myJaws':'big', 'some_dict':{'a':1}, 'some_list':[1]})
+        d.save()
+        with mock.patch('mongomock.Collection.update', wraps=D3.COLLECTION.update) as update_mock:
+            d.myJaws = 'bigger'
+            d.some_list.append(2)
+            d.save()
+            spec, update = update_mock.call_args[0][:2]
+        self.assertEqual(spec, {'_id':d._id})
+        self.assertEqual(sorted(update['$set'].keys()), ['lastModified', 'myJaws', 'some_list'])
+        self.assertTrue('$unset' not in update)
+        self.assertEqual(d._changes(), ({}, {}))
+
+        #somebody else changes a field we didn't touch
+        D3.COLLECTION.update({'_id':d._id}, {'$set':{'some_dict':{'b':2}}})
+        d.remove_field('some_list')
+        d.save()
+        saved = D3.COLLECTION.find_one(d._id)
+        self.assertEqual(saved['some_dict'], {'b':2})
+        self.assertEqual(saved['myJaws'], 'bigger')
+        self.assertTrue('some_list' not in saved)
+
+    def test_tracked_containers(self):
+        D3.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        d = D3({'some_dict':{'a':{'b':1}, 'c':{'d':2}}, 'some_list':[{'e':3}]})
+        d.save()
+        _id = d._id
+        del d
+        whiskeycache.clear_cache()
+
+        d = D3.from_id(_id)
+        loaded = d._dict['some_dict']
+        self.assertTrue(dict.__getitem__(d.some_dict, 'a') is not loaded['a']) #nothing is shared with what we loaded
+        self.assertEqual(d._changes(), ({}, {}))
+        self.assertEqual(self.writes(d), 0)
+
+        d.some_dict['a']['b'] = 10
+        self.assertEqual(loaded['a'], {'b':1}) #what we loaded didn't change
+        for x in d.some_list:
+            x['e'] = 30
+        self.assertEqual(d._changed, set(['some_dict', 'some_list']))
+        d.save()
+        saved = D3.COLLECTION.find_one(_id)
+        self.assertEqual(saved['some_dict'], {'a':{'b':10}, 'c':{'d':2}})
+        self.assertEqual(saved['some_list'], [{'e':30}])
+
+        #changes after a save are tracked against what was saved
+        d.some_dict['c']['d'] = 20
+        self.assertEqual(d._dict['some_dict']['c'], {'d':2})
+        d.save()
+        self.assertEqual(D3.COLLECTION.find_one(_id)['some_dict']['c'], {'d':20})
+
+        #assigned containers are tracked too
+        d.some_list = [1]
+        d.save()
+        d.some_list.append(2)
+        d.save()
+        self.assertEqual(D3.COLLECTION.find_one(_id)['some_list'], [1, 2])
+
+        #children handed out by slices, copies and views are tracked too
+        d.some_list = [{'e':3}, {'e':4}, {'e':5}]
+        d.save()
+        del d
+        whiskeycache.clear_cache()
+        d = D3.from_id(_id)
+        d.some_list[0:1][0]['e'] = 31
+        (d.some_list + [])[1]['e'] = 41
+        d.some_list.pop()['e'] = 51
+        d.some_dict.copy()['a']['b'] = 11
+        for x in d.some_dict.viewvalues():
+            x['f'] = 1
+        self.assertEqual(d._dict['some_list'], [{'e':3}, {'e':4}, {'e':5}]) #what we loaded didn't change
+        self.assertEqual(d._dict['some_dict'], {'a':{'b':10}, 'c':{'d':20}})
+        d.save()
+        del d
+        whiskeycache.clear_cache()
+        d = D3.from_id(_id)
+        self.assertEqual(d.some_list, [{'e':31}, {'e':41}])
+        self.assertEqual(d.some_dict, {'a':{'b':11, 'f':1}, 'c':{'d':20, 'f':1}})
+
+        #copies CPython makes without asking the container, the children are still tracked
+        dict(d.some_dict)['a']['b'] = 12
+        copied = {}
+        copied.update(d.some_dict)
+        copied['c']['d'] = 21
+        ([] + d.some_list)[0]['e'] = 32
+        self.assertEqual(d._changed, set(['some_dict', 'some_list']))
+        d.save()
+        saved = D3.COLLECTION.find_one(_id)
+        self.assertEqual(saved['some_dict'], {'a':{'b':12, 'f':1}, 'c':{'d':21, 'f':1}})
+        self.assertEqual(saved['some_list'], [{'e':32}, {'e':41}])
+
+        self.assertEqual(type(deepcopy(d.some_dict)['a']), dict)
+        self.assertEqual(type(d.render()['some_dict']), dict)
+        ref = weakref.ref(d)
+        del d, x
+        self.assertTrue(ref() is None) #containers don't keep their node alive
+        whiskeycache.clear_cache()
+
+    def test_containers_that_dont_match_the_schema(self):
+        D3.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        _id = ObjectId()
+        D3.COLLECTION.insert({'_id':_id, 'some_dict':None, 'some_list':'scalar'})
+        d = D3.from_id(_id)
+        self.assertEqual(d.some_dict, None) #left as they are, like they were loaded
+        self.assertEqual(d.some_list, 'scalar')
+        d.update({'some_dict':'scalar'})
+        self.assertEqual(d.some_dict, 'scalar')
+        whiskeycache.clear_cache()
+        d = D3.from_id(_id, projection=['myJaws'])
+        self.assertEqual(d.some_list, 'scalar') #loaded on demand
+        whiskeycache.clear_cache()
+
+    def test_schema(self):
+        class S1(WhiskeyNode):
+            COLLECTION_NAME = 'schema_s1'
+            COLLECTION = db[COLLECTION_NAME]
+            FIELDS = {'name':unicode, 'tags':list}
+            DO_NOT_RENDER_FIELDS = set(['name'])
+        class S2(S1):
+            FIELDS = {'size':int}
+
+        self.assertEqual([x[0] for x in S1._schema.fields], ['_id', 'createdAt', 'lastModified', 'name', 'tags'])
+        self.assertEqual(S1._schema.containers, frozenset(['tags']))
+        self.assertTrue('size' in S2.fields and 'name' not in S2.fields) #subclasses get their own fields
+        self.assertEqual(S1.DO_NOT_RENDER_FIELDS, set(['_id', 'name']))
+        self.assertEqual(S2.DO_NOT_RENDER_FIELDS, set(['_id', 'name']))
+        self.assertTrue(S1.DO_NOT_RENDER_FIELDS is not S2.DO_NOT_RENDER_FIELDS)
+        self.assertTrue('_id' not in S1._schema.updatable)
+        self.assertRaises(AttributeError, setattr, S1._schema, 'fields', ())
+
+        s = S1({'name':u'a'})
+        self.assertEqual(type(s.tags).__name__, 'TrackedList')
+        schema = S1._schema
+        s.add_field('color', unicode, render=False)
+        self.assertTrue(S1._schema is not schema)
+        self.assertTrue('color' in S1._schema.do_not_render)
+        self.assertEqual(S1().color, u'')
+        self.assertTrue('color' not in s.render())
+
     def test_find(self):
         D3.COLLECTION.drop()
         d1 = D3()
@@ -353,6 +516,7 @@ class DocumentBaseTest(TestCase):
         self.assertEqual(D3.find({}, skip=2).count(), 1)
         self.assertEqual(D3.find({}, sort=[('myJaws',1)], skip=2).next().myJaws, '3')
         self.assertEqual(D3.find({}, skip=4).count(), 0)
+        self.assertEqual(D3.find({}, skip=4).count(with_limit_and_skip=False), 3) #like pymongo
         
     def test_dequeue(self):
         D3.drop()
@@ -370,7 +534,230 @@ class DocumentBaseTest(TestCase):
 
         self.assertEqual(count, D_COUNT)
 
+    def test_cache_indexes(self):
+        D6.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        dees = [D6({'myJaws':'big', 'myNumber':i}) for i in range(10)]
+        dees[3].myJaws = 'small'
+        self.assertEqual(len(whiskeycache.find(D6, {'myJaws':'big'}, [('_id', -1)])), 9)
+        self.assertEqual(whiskeycache.find(D6, {'myJaws':'small'}, [('_id', -1)]), [dees[3]])
+        self.assertEqual(whiskeycache.find_one(D6, {'myJaws':'small'}), dees[3])
+        self.assertEqual(len(whiskeycache.find(D6, {'myJaws':{'$in':['small', 'medium']}}, [('_id', -1)])), 1)
+        self.assertEqual(len(whiskeycache.find(D6, {'myJaws':'big', 'myNumber':{'$gt':7}}, [('_id', -1)])), 2)
+
+        dees[3].update({'myJaws':'medium'})
+        dees[3].save()
+        self.assertEqual(whiskeycache.find_one(D6, {'myJaws':'small'}), None)
+        self.assertEqual(list(D6.find({'myJaws':'medium'})), [dees[3]])
+
+        dees[4].remove()
+        self.assertEqual(len(whiskeycache.find(D6, {'myJaws':'big'}, [('_id', -1)])), 8)
+        del dees
+        self.assertEqual(len(whiskeycache.find(D6, {'myJaws':'big'}, [('_id', -1)])), 0)
+
+    def test_cache_indexes_with_arrays(self):
+        D8.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        empty = D8() #the default list can't be hashed
+        tagged = D8({'tags':['a', 'b'], 'kind':u'x'})
+        self.assertEqual(set(whiskeycache.find(D8, {'tags':'a'}, None)), set([tagged])) #unsaved, still found
+        self.assertEqual(whiskeycache.find_one(D8, {'tags':{'$in':['z', 'b']}}), tagged)
+        self.assertEqual(set(whiskeycache.find(D8, {'kind':u'x'}, None)), set([tagged])) #other fields still use the index
+        tagged.tags.append('c')
+        self.assertEqual(whiskeycache.find_one(D8, {'tags':'c'}), tagged)
+        empty.tags = 'a' #a scalar is keyed again
+        self.assertEqual(set(whiskeycache.find(D8, {'tags':'a'}, None)), set([empty, tagged]))
+        del empty, tagged
+        whiskeycache.clear_cache()
+
+    def test_cache_sorted_indexes(self):
+        D7.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        dees = [D7({'myNumber':i}) for i in range(10)]
+        dees.append(D7({'myNumber':None}))
+        for d in dees:
+            d.save()
+        queries = [
+                    ({'myNumber':{'$gt':5}}, 4),
+                    ({'myNumber':{'$gte':5}}, 5),
+                    ({'myNumber':{'$lt':5}}, 5), #like mongo, None isn't less than 5
+                    ({'myNumber':{'$lte':5}}, 6),
+                    ({'myNumber':{'$gt':2, '$lte':7}}, 5),
+                    ({'myNumber':{'$gt':7, '$lt':2}}, 0),
+                    ({'myNumber':3}, 1),
+                    ({'myNumber':{'$gt':'a'}}, 0),
+                    ({'myNumber':{'$gte':2}, 'myJaws':'big'}, 0),
+                    ({'myNumber':{'$gt':3, '$gte':5}}, 5), #redundant bounds, the tighter one wins
+                    ({'myNumber':{'$gte':3, '$gt':5, '$lt':8, '$lte':6}}, 1),
+                  ]
+        for query, count in queries:
+            self.assertEqual(len(whiskeycache.find(D7, query, [('_id', -1)])), count)
+
+        numbers = lambda query, sort: [x.myNumber for x in whiskeycache.find(D7, query, sort)]
+        self.assertEqual(numbers({'myNumber':{'$gt':5}}, [('myNumber', -1)]), [9, 8, 7, 6])
+        self.assertEqual(numbers({'myNumber':{'$lt':3}}, [('myNumber', 1)]), [0, 1, 2])
+
+        dees[0].myNumber = 100
+        dees[9].remove()
+        self.assertEqual(numbers({'myNumber':{'$gt':5}}, [('myNumber', 1)]), [6, 7, 8, 100])
+        self.assertEqual(len(whiskeycache.find(D7, {'myNumber':0}, [('_id', -1)])), 0)
+
+        dees[1].myNumber = [1, 50] #arrays match element by element, the index isn't used while one is in it
+        self.assertEqual(set(whiskeycache.find(D7, {'myNumber':{'$gt':40}}, None)), set([dees[0], dees[1]]))
+        self.assertEqual(set(whiskeycache.find(D7, {'myNumber':1}, None)), set([dees[1]]))
+        dees[1].myNumber = 1
+        self.assertEqual(numbers({'myNumber':{'$gt':40}}, [('myNumber', 1)]), [100])
+
+        del dees, d
+        self.assertEqual(numbers({'myNumber':{'$gte':0}}, [('myNumber', 1)]), [])
+
+    def test_find_plans(self):
+        D3.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        dees = [D3({'myJaws':'big'}) for i in range(6)]
+        for d in dees:
+            d.save()
+        D3.COLLECTION.insert({'myJaws':'big'}) #one that isn't in RAM
+        dees[0].myJaws = 'small' #changed locally, the db still thinks it's big
+
+        #cached nodes are excluded from the db query
+        with mock.patch('mongomock.Collection.find', wraps=D3.COLLECTION.find) as find_mock:
+            result = list(D3.find({'myJaws':'big'}))
+            self.assertEqual(len(result), 6)
+            self.assertTrue(dees[0] not in result)
+            self.assertEqual(set(find_mock.call_args_list[0][0][0]['_id']['$nin']), set([d._id for d in dees[1:]]))
+
+        #too many to exclude, they get dropped in the merge
+        D3.CACHE_NIN_LIMIT = 2
+        try:
+            result = list(D3.find({'myJaws':'big'}))
+            self.assertEqual(len(result), 6)
+            self.assertEqual(len(set([x._id for x in result])), 6)
+            self.assertTrue(dees[0] not in result)
+        finally:
+            del D3.CACHE_NIN_LIMIT
+
+        #resident collections never hit the db
+        D3.make_resident()
+        try:
+            with mock.patch('mongomock.Collection.find') as find_mock:
+                self.assertEqual(len(list(D3.find({'myJaws':'big'}))), 6)
+                self.assertEqual(D3.find({'myJaws':'small'}).count(), 1)
+                self.assertEqual(find_mock.call_count, 0)
+        finally:
+            whiskeycache.release_resident(D3.COLLECTION_NAME)
+
+    def test_exact_count(self):
+        D3.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        dees = [D3({'myJaws':'big'}) for i in range(4)]
+        for d in dees:
+            d.save()
+        D3.COLLECTION.insert({'myJaws':'big'}) #in the db, not in RAM
+        new = D3({'myJaws':'big'}) #in RAM, not in the db
+        dees[0].myJaws = 'small' #the db still thinks it's big
+        dees[1].remove()
+        self.assertEqual(D3.find({'myJaws':'big'}).count(), 4)
+        self.assertEqual(len(list(D3.find({'myJaws':'big'}))), 4)
+        self.assertEqual(D3.find({'myJaws':'small'}).count(), 1)
+        self.assertEqual(D3.find({'myJaws':'big'}, limit=3).count(), 3)
+        self.assertEqual(D3.find({'myJaws':'big'}, limit=3).count(with_limit_and_skip=False), 4)
+
+        #too many to exclude in the db query
+        D3.CACHE_NIN_LIMIT = 1
+        try:
+            self.assertEqual(D3.find({'myJaws':'big'}).count(), 4)
+        finally:
+            del D3.CACHE_NIN_LIMIT
+
+        cursor = D3.find({'myJaws':'big'})
+        cursor.count()
+        with mock.patch('mongomock.Collection.find') as find_mock:
+            self.assertEqual(cursor.count(), 4) #remembered per cursor
+            self.assertEqual(find_mock.call_count, 0)
+        whiskeycache.clear_cache()
+
+    def test_projection(self):
+        D3.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        d = D3({'myJaws':'big', 'some_dict':{'a':1}, 'some_list':[1, 2]})
+        d.save()
+        _id = d._id
+        del d
+        whiskeycache.clear_cache()
+
+        d = D3.from_id(_id, projection=['myJaws'])
+        self.assertEqual(d.__dict__.get('some_dict'), None) #not loaded
+        d.myJaws = 'bigger'
+        d.save()
+        self.assertEqual(D3.COLLECTION.find_one(_id)['some_dict'], {'a':1}) #a partial save doesn't clobber the rest
+        self.assertEqual(D3.COLLECTION.find_one(_id)['myJaws'], 'bigger')
+
+        with mock.patch('mongomock.Collection.find_one', wraps=D3.COLLECTION.find_one) as find_one_mock:
+            self.assertEqual(d.some_dict, {'a':1}) #lazy fetch
+            self.assertEqual(d.some_list, [1, 2])
+            self.assertEqual(find_one_mock.call_count, 1)
+        d.some_list.append(3)
+        d.save()
+        self.assertEqual(D3.COLLECTION.find_one(_id)['some_list'], [1, 2, 3])
+        del d
+        whiskeycache.clear_cache()
 
+        d = list(D3.find({'myJaws':'bigger'}, projection=['some_list']))[0]
+        self.assertEqual(d.__dict__.get('myJaws'), None)
+        d.some_dict = {'b':2} #assigning loads it
+        d.save()
+        self.assertEqual(D3.COLLECTION.find_one(_id)['some_dict'], {'b':2})
+        self.assertEqual(D3.COLLECTION.find_one(_id)['myJaws'], 'bigger')
+        self.assertEqual(d.myJaws, 'bigger')
+        del d
+        whiskeycache.clear_cache()
 
+        self.assertEqual(D3.from_ids([_id], projection=['myJaws'])[0].some_dict, {'b':2})
+        whiskeycache.clear_cache()
+        self.assertEqual(D3.from_dbref(D3.COLLECTION_NAME, _id, projection=['myJaws']).some_list, [1, 2, 3])
+        whiskeycache.clear_cache()
 
+    def test_compound_sort_merge(self):
+        D7.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        for i in range(6):
+            D7.COLLECTION.insert({'myJaws':'big' if i % 2 else 'small', 'myNumber':i})
+        in_ram = [D7({'myJaws':'big' if i % 2 else 'small', 'myNumber':i}) for i in range(6, 12)]
+        result = [(x.myJaws, x.myNumber) for x in D7.find({}, sort=[('myJaws', 1), ('myNumber', -1)])]
+        self.assertEqual(result, sorted(result, key=lambda x: (x[0], -x[1])))
+        self.assertEqual(len(result), 12)
+        result = [(x.myJaws, x.myNumber) for x in D7.find({}, sort=[('myJaws', -1), ('myNumber', 1)], limit=4)]
+        self.assertEqual(result, [('small', 0), ('small', 2), ('small', 4), ('small', 6)])
+
+    def test_skip_pages(self):
+        D7.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        for i in range(0, 40, 2):
+            D7.COLLECTION.insert({'myNumber':i})
+        in_ram = [D7({'myNumber':i}) for i in range(1, 40, 8)]
+        everything = [x.myNumber for x in D7.find({}, sort=[('myNumber', 1)])]
+        self.assertEqual(len(everything), 25)
 
+        whiskeycache.clear_cache()
+        in_ram = [D7({'myNumber':i}) for i in range(1, 40, 8)]
+        for page in range(5):
+            with mock.patch('whiskeynode.whiskeycache.from_cache', wraps=whiskeycache.from_cache) as from_cache_mock:
+                result = [x.myNumber for x in D7.find({}, sort=[('myNumber', 1)], skip=page * 6, limit=6)]
+                self.assertTrue(from_cache_mock.call_count <= 6) #skipped documents don't become nodes
+            self.assertEqual(result, everything[page * 6:page * 6 + 6])
+
+        D7.COLLECTION.drop()
+        whiskeycache.clear_cache()
+        for i in range(21):
+            D7.COLLECTION.insert({'myJaws':'big', 'myNumber':i})
+        changed = D7.find_one({'myNumber':5})
+        changed.myJaws = 'small' #changed locally, the db still thinks it's big
+        pages = lambda: [[x.myNumber for x in D7.find({'myJaws':'big'}, sort=[('myNumber', 1)], skip=page * 5, limit=5)] for page in range(4)]
+        expected = [range(0, 5), range(6, 11), range(11, 16), range(16, 21)]
+        self.assertEqual(pages(), expected)
+        D7.CACHE_NIN_LIMIT = 0 #too many to exclude, skipped in the merge
+        try:
+            self.assertEqual(pages(), expected)
+        finally:
+            del D7.CACHE_NIN_LIMIT
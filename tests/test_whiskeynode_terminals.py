@@ -1,10 +1,15 @@
 from bson.objectid import ObjectId
 from unittest import TestCase
+from tests import patch_aggregate
+import mock
+import mongomock
+import sys
 from whiskeynode import WhiskeyNode
 from whiskeynode.db import db
-from whiskeynode.edges import Edge
+from whiskeynode.edges import Edge, EdgeRef
 from whiskeynode.exceptions import InvalidConnectionNameException, InvalidTerminalException, InvalidTerminalStateException
-from whiskeynode.terminals import outbound_node, inbound_node, outbound_list, inbound_list, bidirectional_list
+from whiskeynode.terminals import outbound_node, inbound_node, outbound_list, inbound_list, bidirectional_list, count_terminals, repair_counters
+from whiskeynode.traversals import lazy_traversal
 from whiskeynode.terminaltypes import TerminalType
 from whiskeynode import whiskeycache  
 
@@ -82,6 +87,33 @@ class TreeNode(WhiskeyNode):
                             }
 
 
+class Account(WhiskeyNode):
+    COLLECTION_NAME = 'account_collection'
+    COLLECTION = db[COLLECTION_NAME]
+
+    @classmethod
+    def init_terminals(cls):
+        cls.TERMINALS =    {
+                                'follows':outbound_list(Account, counted=True),
+                                'followers':inbound_list(Account, 'follows', counted=True),
+                                'clubs':outbound_list(Club),
+                            }
+        cls.TRAVERSALS =   {
+                                'followerCount':lazy_traversal('followers.count', default_value=0),
+                            }
+
+class Club(WhiskeyNode):
+    COLLECTION_NAME = 'club_collection'
+    COLLECTION = db[COLLECTION_NAME]
+
+    @classmethod
+    def init_terminals(cls):
+        cls.TERMINALS =    {
+                                'members':inbound_list(Account, 'clubs', counted='memberCount'),
+                            }
+
+
+@patch_aggregate
 class NodeBaseConnectionTest(TestCase):
     def tearDown(self):
         WhiskeyNode.COLLECTION.drop()
@@ -211,6 +243,28 @@ class NodeBaseConnectionTest(TestCase):
         else:
             raise AssertionError('you can\'t append to inbound lists')
 
+    def test_list_terminal_count(self):
+        Edge.COLLECTION.drop()
+        parent = ParentNode()
+        subs = [SubNode() for i in range(3)]
+        parent.sub_node_list.extend(subs)
+        parent.save()
+        whiskeycache.clear_cache()
+
+        parent2 = ParentNode.from_id(parent._id)
+        self.assertEqual(parent2.sub_node_list.count(), 3)
+        with mock.patch('mongomock.Collection.find') as find_mock:
+            self.assertEqual(parent2.sub_node_list.count(), 3) #remembered
+            self.assertEqual(find_mock.call_count, 0)
+
+        parent2.sub_node_list.append(SubNode()) #not saved yet, still counted
+        self.assertEqual(parent2.sub_node_list.count(), 4)
+        parent2.sub_node_list.pop(0)
+        self.assertEqual(parent2.sub_node_list.count(), 3)
+        parent2.save()
+        whiskeycache.clear_cache()
+        self.assertEqual(ParentNode.from_id(parent._id).sub_node_list.count(), 3)
+
     def test_inbound_node(self):
         parent = ParentNode()
         sub = parent.sub_node
@@ -297,7 +351,290 @@ class NodeBaseConnectionTest(TestCase):
         t.parent = t2
         t.save()
 
+    def test_save_deep_chain(self):
+        TreeNode.COLLECTION.drop()
+        nodes = [TreeNode() for i in range(sys.getrecursionlimit() + 100)]
+        for child, parent in zip(nodes, nodes[1:]):
+            child.parent = parent
+        nodes[0].save() #deeper than the recursion limit
+        self.assertEqual(TreeNode.COLLECTION.find().count(), len(nodes))
+        self.assertEqual(Edge.COLLECTION.find({'name':'parent'}).count(), len(nodes) - 1)
+        self.assertFalse(hasattr(nodes[0], '_save_record'))
 
 
+    def test_edge_refs(self):
+        Edge.COLLECTION.drop()
+        parent = ParentNode()
+        subs = [SubNode() for i in range(3)]
+        parent.sub_node_list.extend(subs)
+        parent.save()
+        whiskeycache.clear_cache()
 
+        parent2 = ParentNode.from_id(parent._id)
+        edges = parent2.sub_node_list.get_edges()
+        self.assertEqual(set(edges.keys()), set(x._id for x in subs))
+        self.assertTrue(all(type(x) is EdgeRef for x in edges.values())) #only the ids were loaded
+        self.assertEqual(len(whiskeycache.RAM_ALL.get(Edge.COLLECTION_NAME, [])), 0)
+        self.assertEqual(len(parent2.sub_node_list), 3)
+        self.assertEqual(parent2.sub_node_list.to_save(), []) #nothing to save for refs
+
+        edge = parent2.sub_node_list.get_edge(subs[0]) #promoted
+        self.assertTrue(isinstance(edge, Edge))
+        self.assertTrue(edges[subs[0]._id] is edge)
+        self.assertEqual(edge.name, 'sub_node_list')
+
+        parent2.sub_node_list.remove(parent2.sub_node_list[0])
+        parent2.save()
+        self.assertEqual(Edge.COLLECTION.find({'outboundId':parent._id}).count(), 2)
 
+    def test_large_list_paging(self):
+        Edge.COLLECTION.drop()
+        parent = ParentNode()
+        subs = [SubNode() for i in range(250)]
+        parent.sub_node_list.extend(subs) #newest edge first, so subs[-1] is first
+        parent.save()
+        whiskeycache.clear_cache()
+
+        parent2 = ParentNode.from_id(parent._id)
+        self.assertEqual(len(parent2.sub_node_list), 250) #no more 200 edge limit
+        self.assertTrue(subs[0] in parent2.sub_node_list)
+        with mock.patch.object(SubNode, 'from_ids', wraps=SubNode.from_ids) as from_ids_mock:
+            window = parent2.sub_node_list[100:150]
+            self.assertEqual(len(from_ids_mock.call_args[0][0]), 50) #only the window was loaded
+        self.assertEqual([x._id for x in window], [x._id for x in reversed(subs)][100:150])
+        self.assertEqual(parent2.sub_node_list[0]._id, subs[-1]._id)
+        self.assertTrue(parent2.sub_node_list._list is None)
+
+        whiskeycache.clear_cache()
+        parent3 = ParentNode.from_id(parent._id)
+        pages = [[x._id for x in page] for page in parent3.sub_node_list.iter_pages(page_size=100)]
+        self.assertEqual([len(x) for x in pages], [100, 100, 50])
+        self.assertEqual(sum(pages, []), [x._id for x in reversed(subs)])
+        self.assertFalse(parent3.sub_node_list.activated) #streamed without loading the edges
+        self.assertEqual(len(list(iter(parent3.sub_node_list))), 250)
+
+        whiskeycache.clear_cache()
+        parent4 = ParentNode.from_id(parent._id)
+        with mock.patch.object(Edge, 'find_refs', wraps=Edge.find_refs) as find_refs_mock:
+            window = parent4.sub_node_list[100:150]
+            self.assertEqual(find_refs_mock.call_args[1]['limit'], 150) #only the edges up to the window
+            self.assertEqual(parent4.sub_node_list[3]._id, subs[-4]._id)
+            self.assertEqual(find_refs_mock.call_args[1]['limit'], 4)
+        self.assertEqual([x._id for x in window], [x._id for x in reversed(subs)][100:150])
+        self.assertFalse(parent4.sub_node_list.activated)
+        self.assertRaises(IndexError, lambda: parent4.sub_node_list[250])
+
+    def test_list_order(self):
+        parent = ParentNode()
+        parent.sub_node_list.get()
+        subs = [SubNode({'sub_prop':unicode(i % 3)}) for i in range(10)]
+        for sub in subs:
+            parent.sub_node_list.append(sub)
+        self.assertEqual(list(parent.sub_node_list), subs[::-1]) #newest edge first
+        parent.sub_node_list.remove(subs[4])
+        parent.sub_node_list.remove(subs[9])
+        expected = [x for x in subs[::-1] if x not in (subs[4], subs[9])]
+        self.assertEqual(list(parent.sub_node_list), expected)
+        self.assertEqual(parent.sub_node_list._ordered_ids(), [x._id for x in expected])
+
+        key = lambda x: x.sub_prop
+        parent.sub_node_list.sort(key=key)
+        new = SubNode({'sub_prop':u'1'})
+        parent.sub_node_list.append(new) #the custom order is kept
+        parent.sub_node_list.remove(subs[0])
+        self.assertEqual(list(parent.sub_node_list), sorted([x for x in expected if x is not subs[0]] + [new], key=key))
+        parent.sub_node_list.sort()
+        self.assertEqual(parent.sub_node_list[0], new)
+
+    def test_bulk_list_operations(self):
+        Edge.COLLECTION.drop()
+        parent = ParentNode()
+        subs = [SubNode() for i in range(6)]
+        parent.sub_node_list.extend(subs[:4] + subs[:2]) #duplicates are skipped
+        self.assertEqual(len(parent.sub_node_list), 4)
+        self.assertEqual(subs[0].parents[0], parent) #the other end knows
+        parent.save()
+        edges = dict((x.inboundId, x._id) for x in Edge.find({'outboundId':parent._id}))
+
+        with mock.patch('mongomock.Collection.remove', wraps=Edge.COLLECTION.remove) as remove_mock:
+            parent.sub_node_list.set([subs[4], subs[5], subs[3], subs[2]])
+            self.assertEqual(remove_mock.call_count, 1) #one write for both removed edges
+        self.assertEqual(len(subs[0].parents), 0)
+        self.assertEqual([x._id for x in parent.sub_node_list], [x._id for x in [subs[4], subs[5], subs[3], subs[2]]])
+        parent.save()
+        after = dict((x.inboundId, x._id) for x in Edge.find({'outboundId':parent._id}))
+        self.assertEqual(set(after.keys()), set(x._id for x in subs[2:]))
+        self.assertEqual(after[subs[2]._id], edges[subs[2]._id]) #kept nodes kept their edges
+        self.assertEqual(Edge.COLLECTION.find({'outboundId':parent._id}).count(), 4)
+
+        order = [subs[2], subs[4], subs[5], subs[3]]
+        parent.sub_node_list.set(order) #only subs[2] has to move
+        self.assertEqual([x._id for x in parent.sub_node_list], [x._id for x in order])
+        parent.save()
+        moved = dict((x.inboundId, x._id) for x in Edge.find({'outboundId':parent._id}))
+        self.assertNotEqual(moved[subs[2]._id], after[subs[2]._id])
+        self.assertEqual(moved[subs[3]._id], after[subs[3]._id])
+        whiskeycache.clear_cache()
+        parent = ParentNode.from_id(parent._id)
+        self.assertEqual([x._id for x in parent.sub_node_list], [x._id for x in order])
+
+        parent.sub_node_list.remove_many([x for x in parent.sub_node_list if x._id in (subs[2]._id, subs[3]._id)])
+        self.assertEqual([x._id for x in parent.sub_node_list], [subs[4]._id, subs[5]._id])
+        self.assertEqual(Edge.COLLECTION.find({'outboundId':parent._id}).count(), 2)
+
+    def test_remove_cascades_to_edges_on_edges(self):
+        Edge.COLLECTION.drop()
+        parent = ParentNode()
+        sub = SubNode()
+        parent.sub_node_list.append(sub)
+        parent.save()
+        edge = parent.sub_node_list.get_edge(sub)
+        vote = Edge.from_nodes(edge, SubNode(), 'voters', TerminalType.LIST_OF_NODES)
+        vote.save()
+        self.assertEqual(Edge.COLLECTION.find({'outboundId':edge._id}).count(), 1)
+        parent.sub_node_list.remove(sub)
+        self.assertEqual(Edge.COLLECTION.find({'outboundId':edge._id}).count(), 0)
+        self.assertEqual(Edge.COLLECTION.find().count(), 0)
+
+    def test_prefetch(self):
+        Edge.COLLECTION.drop()
+        parents = [ParentNode() for i in range(5)]
+        for parent in parents:
+            parent.sub_node_list.extend([SubNode() for i in range(3)])
+            parent.sub_node #created on request
+            parent.save()
+        ids = [x._id for x in parents]
+        whiskeycache.clear_cache()
+
+        calls = []
+        original = mongomock.Collection.find
+        def find(collection, *args, **kwargs):
+            calls.append(collection.name)
+            return original(collection, *args, **kwargs)
+        with mock.patch('mongomock.Collection.find', find):
+            loaded = [x for x in ParentNode.find({'_id':{'$in':ids}}, prefetch=['sub_node_list', 'sub_node'])]
+            #one edge query per terminal, one node query per collection they point at
+            self.assertEqual(sorted(calls), sorted([ParentNode.COLLECTION_NAME, Edge.COLLECTION_NAME, Edge.COLLECTION_NAME, SubNode.COLLECTION_NAME]))
+            del calls[:]
+            for parent in loaded:
+                self.assertEqual(len(parent.sub_node_list), 3)
+                self.assertEqual(len(parent.sub_node_list.render()), 3)
+                self.assertTrue(parent.sub_node is not None)
+            self.assertEqual(calls, [])
+
+        whiskeycache.clear_cache()
+        loaded = ParentNode.from_ids(ids, prefetch='sub_node_list')
+        self.assertTrue(all(x.sub_node_list._list is not None for x in loaded))
+        self.assertEqual(sorted(x._id for x in loaded[0].sub_node_list), sorted(x._id for x in SubNode.from_ids([e.inboundId for e in Edge.find({'outboundId':loaded[0]._id, 'name':'sub_node_list'})])))
+
+        orphan = SubNode()
+        orphan.save()
+        whiskeycache.clear_cache()
+        sub_id = Edge.find_one({'outboundId':ids[0], 'name':'sub_node'}).inboundId
+        subs = SubNode.from_ids([sub_id, orphan._id], prefetch='parent')
+        del calls[:]
+        with mock.patch('mongomock.Collection.find', find):
+            self.assertEqual(dict((x._id, x.parent._id if x.parent else None) for x in subs), {sub_id:ids[0], orphan._id:None})
+            self.assertEqual(calls, []) #the orphan's terminal knows it has no edge, it doesn't look again
+
+    def test_aggregate_counts(self):
+        Edge.COLLECTION.drop()
+        subs = [SubNode() for i in range(4)]
+        parents = [ParentNode() for i in range(4)]
+        parents[0].sub_node_list.extend(subs)
+        parents[1].sub_node_list.extend(subs[:3])
+        parents[2].sub_node_list.extend(subs[2:])
+        map(lambda x:x.save(), parents)
+        ids = [x._id for x in parents]
+        whiskeycache.clear_cache()
+
+        calls = []
+        original = mongomock.Collection.find
+        def find(collection, *args, **kwargs):
+            calls.append(collection.name)
+            return original(collection, *args, **kwargs)
+        parents = sorted(ParentNode.from_ids(ids), key=lambda x:ids.index(x._id))
+        with mock.patch('mongomock.Collection.find', find):
+            self.assertEqual(count_terminals(parents, 'sub_node_list'), dict(zip(ids, [4, 3, 2, 0])))
+            self.assertEqual(calls, [Edge.COLLECTION_NAME]) #one $match/$group for all of them
+            self.assertEqual([x.sub_node_list.count() for x in parents], [4, 3, 2, 0]) #remembered
+            self.assertEqual(calls, [Edge.COLLECTION_NAME])
+            self.assertFalse(parents[0].sub_node_list.activated) #no edges were loaded
+
+            self.assertEqual(parents[0].sub_node_list.shared_count(parents[1]), 3)
+            self.assertEqual(parents[1].sub_node_list.shared_count(parents[2]), 1)
+            self.assertEqual(parents[0].sub_node_list.most_shared(), [(ids[1], 3), (ids[2], 2)])
+            self.assertEqual(parents[0].sub_node_list.most_shared(limit=1), [(ids[1], 3)])
+            self.assertEqual(parents[3].sub_node_list.most_shared(), [])
+            sub = SubNode.from_id(subs[3]._id)
+            self.assertEqual(sub.parents.most_shared(limit=1), [(subs[2]._id, 2)]) #inbound lists look the other way
+            self.assertEqual(sorted(sub.parents.most_shared()[1:]), sorted([(subs[0]._id, 1), (subs[1]._id, 1)]))
+            self.assertEqual(sub.parents.count(), 2)
+
+            parent = ParentNode()
+            parent.sub_node_list.extend([SubNode(), SubNode()])
+            del calls[:]
+            self.assertEqual(count_terminals([parent], 'sub_node_list'), {parent._id:2})
+            self.assertEqual(ParentNode().sub_node_list.count(), 0)
+            self.assertEqual(ParentNode().sub_node_list.shared_count(ParentNode()), 0)
+            self.assertEqual(calls, []) #new nodes are counted out of RAM
+
+        parents[1].sub_node_list.append(SubNode()) #unsaved edges are counted too
+        self.assertEqual(parents[1].sub_node_list.count(), 4)
+        parents[3].sub_node_list.append(SubNode.from_id(subs[0]._id))
+        self.assertEqual(sorted(parents[0].sub_node_list.most_shared()), sorted([(ids[1], 3), (ids[2], 2), (ids[3], 1)]))
+
+    def test_counted_terminals(self):
+        Edge.COLLECTION.drop()
+        Account.COLLECTION.drop()
+        Club.COLLECTION.drop()
+        a, b, c = Account(), Account(), Account()
+        self.assertEqual((a.followsCount, a.followersCount), (0, 0))
+        self.assertTrue('memberCount' in Club.fields) #set up along with Account, it's on the other end
+        a.follows.extend([b, c])
+        b.follows.append(c)
+        self.assertEqual(a.followsCount, 0) #the field is what's saved
+        self.assertEqual(a.follows.count(), 2)
+        a.save()
+        self.assertEqual((a.followsCount, b.followsCount, c.followersCount), (2, 1, 2))
+        self.assertEqual(Account.COLLECTION.find_one({'_id':c._id})['followersCount'], 2)
+        club = Club()
+        club.save()
+        a.clubs.append(club)
+        b.clubs.append(club)
+        a.save()
+        b.save()
+        self.assertEqual(club.memberCount, 2)
+        ids = [x._id for x in (a, b, c)]
+        club_id = club._id
+        whiskeycache.clear_cache()
+        del a, b, c, club
+
+        calls = []
+        original = mongomock.Collection.find
+        def find(collection, *args, **kwargs):
+            calls.append(collection.name)
+            return original(collection, *args, **kwargs)
+        a, b, c = [Account.from_id(x) for x in ids]
+        with mock.patch('mongomock.Collection.find', find):
+            self.assertEqual([x.followers.count() for x in (a, b, c)], [0, 1, 2])
+            self.assertEqual([x.followerCount for x in (a, b, c)], [0, 1, 2])
+            self.assertEqual(a.follows.count(), 2)
+            self.assertEqual(calls, [])
+
+        a.follows.remove(c)
+        self.assertEqual((a.followsCount, c.followersCount), (1, 1))
+        a.clubs.set([]) #the club isn't loaded, the db still hears about it
+        self.assertEqual(Club.COLLECTION.find_one({'_id':club_id})['memberCount'], 1)
+        whiskeycache.clear_cache()
+        self.assertEqual(Account.COLLECTION.find_one({'_id':ids[2]})['followersCount'], 1)
+        self.assertEqual(Club.from_id(club_id).members.count(), 1)
+
+        Account.COLLECTION.update({'_id':ids[1]}, {'$set':{'followersCount':7}})
+        Account.COLLECTION.update({'_id':ids[0]}, {'$unset':{'followsCount':True}})
+        self.assertEqual(repair_counters(Account), 2)
+        counts = dict((x['_id'], (x['followsCount'], x['followersCount'])) for x in Account.COLLECTION.find())
+        self.assertEqual([counts[x] for x in ids], [(1, 0), (1, 1), (0, 1)])
+        self.assertEqual(repair_counters(Club), 0)
+        Account.COLLECTION.drop()
+        Club.COLLECTION.drop()
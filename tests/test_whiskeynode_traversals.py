@@ -1,6 +1,8 @@
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
 from datetime import datetime
+import gc
+import weakref
 from functools import partial
 from unittest import TestCase
 from whiskeynode import WhiskeyNode
@@ -8,10 +10,13 @@ from whiskeynode import whiskeycache
 from whiskeynode.db import db
 from whiskeynode.edges import Edge
 from whiskeynode.exceptions import InvalidFieldNameException, FieldNameNotDefinedException
+from whiskeynode.sessions import WhiskeySession
 from whiskeynode.terminals import outbound_node, outbound_list, inbound_node, inbound_list
 from whiskeynode.terminaltypes import TerminalType
 from whiskeynode.traversals import lazy_traversal  
+from tests import patch_aggregate
 import mock
+import mongomock
 import datetime
 
 
@@ -84,8 +89,49 @@ class ContactInfo(WhiskeyNode):
                         }
 
 
+class Activity(WhiskeyNode):
+    COLLECTION_NAME =   'traversal_activities'
+    COLLECTION =        db[COLLECTION_NAME]
+
+    FIELDS =            {
+                            'title':unicode,
+                        }
+
+class Person(WhiskeyNode):
+    COLLECTION_NAME =   'traversal_people'
+    COLLECTION =        db[COLLECTION_NAME]
+
+    FIELDS =            {
+                            'name':unicode,
+                        }
 
+    @classmethod
+    def init_terminals(cls):
+        cls.TRAVERSALS= {
+                            'friendActivities': lazy_traversal('friends.activities.count', default_value=0),
+                            'teamOwnerName':    lazy_traversal('team.owner.name', default_value=u''),
+                            'friendTeamOwner':  lazy_traversal('friends.team.owner.name', default_value=u'DEFAULT'),
+                        }
+
+        cls.TERMINALS = {
+                            'friends':          outbound_list(Person),
+                            'activities':       outbound_list(Activity),
+                            'team':             outbound_node(Team),
+                        }
+
+class Team(WhiskeyNode):
+    COLLECTION_NAME =   'traversal_teams'
+    COLLECTION =        db[COLLECTION_NAME]
 
+    @classmethod
+    def init_terminals(cls):
+        cls.TERMINALS = {
+                            'owner':            outbound_node(Person),
+                        }
+
+
+
+@patch_aggregate
 class DocumentBaseTest(TestCase):
     def tearDown(self):
         self.__cleanup()
@@ -114,10 +160,13 @@ class DocumentBaseTest(TestCase):
         self.assertTrue(e.user.contactInfo.email == new_email_address)
         self.assertTrue(e2.user.contactInfo.email == new_email_address)
 
-        with mock.patch('mongomock.Collection.save') as save_moc:
-            e.save()
-            print save_moc.call_count
-            self.assertTrue(save_moc.call_count == 7) #2 emails with 2 edges to 1 user with 1 edge to 1 contactInfo
+        session = WhiskeySession()
+        e.save(session=session)
+        self.assertEqual(len(session), 7) #2 emails with 2 edges to 1 user with 1 edge to 1 contactInfo
+        with mock.patch('mongomock.Collection.insert') as insert_mock:
+            session.flush()
+            self.assertEqual(insert_mock.call_count, 4) #one per collection
+        self.assertEqual(session.write_counts, {EmailAddress.COLLECTION_NAME:2, User.COLLECTION_NAME:1, ContactInfo.COLLECTION_NAME:1, Edge.COLLECTION_NAME:3})
 
     def __load_objects(self):
         self.__cleanup()
@@ -141,10 +190,57 @@ class DocumentBaseTest(TestCase):
         e2.user = e.user
         self.assertTrue(e.user.contactInfo.email == new_email_address)
 
-
-
-
-
-
-
-
+    def test_multi_hop_traversals(self):
+        self.__cleanup()
+        p = Person({'name':u'p'})
+        friends = [Person({'name':u'f%d' % i}) for i in range(3)]
+        p.friends.extend(friends)
+        for friend in friends:
+            friend.activities.extend([Activity() for i in range(2)])
+        p.team = Team()
+        p.team.owner = friends[0]
+        p.save()
+        _id = p._id
+        whiskeycache.clear_cache()
+        del p, friends
+
+        p = Person.from_id(_id)
+        self.assertEqual(p.friendActivities, 6) #saved value, the terminals aren't loaded
+        self.assertEqual(len(p.friends), 3)
+        calls = []
+        original = mongomock.Collection.find
+        def find(collection, *args, **kwargs):
+            calls.append(collection.name)
+            return original(collection, *args, **kwargs)
+        with mock.patch('mongomock.Collection.find', find):
+            self.assertEqual(p.friendActivities, 6)
+            self.assertEqual(calls, [Person.COLLECTION_NAME, Edge.COLLECTION_NAME]) #the friends, then all of their activities at once
+            del calls[:]
+            self.assertEqual(p.friendActivities, 6)
+            self.assertEqual(calls, []) #remembered
+
+        p.friends[0].activities.append(Activity()) #changes a terminal on the path
+        self.assertEqual(p.friendActivities, 7)
+        p.friends.remove(p.friends[1])
+        self.assertEqual(p.friendActivities, 5)
+
+        self.assertEqual(p.friendTeamOwner, u'DEFAULT') #the friends have no teams, not the first friend's name
+        self.assertEqual(p.teamOwnerName, u'f0')
+        p.team.owner = p.friends[1]
+        self.assertEqual(p.teamOwnerName, p.friends[1].name)
+        p.team.owner.name = u'renamed' #fields are read fresh, only the path is remembered
+        self.assertEqual(p.teamOwnerName, u'renamed')
+
+        owner = Person({'name':u'o'})
+        p.team.owner = owner
+        self.assertEqual(p.teamOwnerName, u'o')
+        owner_ref = weakref.ref(owner)
+        p.team.owner = None
+        del owner
+        gc.collect()
+        self.assertTrue(owner_ref() is None) #the remembered path doesn't keep what it found in RAM
+        self.assertEqual(p.teamOwnerName, u'')
+        self.__cleanup()
+        Person.COLLECTION.drop()
+        Activity.COLLECTION.drop()
+        Team.COLLECTION.drop()
@@ -1,5 +1,4 @@
 from bson.objectid import ObjectId, InvalidId
-from collections import deque
 from datetime import datetime
 from functools import partial
 from pprint import pformat
@@ -12,14 +11,18 @@ from whiskeynode.exceptions import (BadEdgeRemovalException,
                                     FieldNameNotDefinedException,
                                     InvalidFieldNameException,
                                     InvalidConnectionNameException,)
-from whiskeynode.fieldtypes import FieldDict
+from whiskeynode.fieldtypes import FieldDict, TrackedDict, TrackedList, peek, track
+from whiskeynode.queries import MISSING, compile_query, sort_keys
+from whiskeynode.schema import NodeSchema, WhiskeyNodeType
+from whiskeynode.sessions import WhiskeySession, waiting_session
 from whiskeynode.terminaltypes import TerminalDict, TerminalType
 from copy import copy, deepcopy
+from collections import deque
+import heapq
 import itertools
 import os
 
 environment = os.environ.get('ENVIRONMENT')
-save_id = 0
 
 
 
@@ -27,15 +30,10 @@ save_id = 0
 def get_current_user_id():
     return None
 
-def get_new_save_id():
-    global save_id
-    i = save_id
-    save_id = save_id + 1
-    return i
-
 
 ''' WhiskeyNode '''
 class WhiskeyNode(object):
+    __metaclass__ = WhiskeyNodeType
 
     ''' REQUIRED OVERRIDES '''
     #DATABASE, override these variables in your class
@@ -67,6 +65,23 @@ class WhiskeyNode(object):
                         [
                             #'name'
                         ])
+    #CACHE_INDEXES, fields listed here are hash indexed in the whiskeycache so equality and $in
+    #                       queries against nodes in RAM don't scan the whole collection, values should be hashable
+    CACHE_INDEXES = set(
+                        [
+                            #'name'
+                        ])
+    #CACHE_SORTED_INDEXES, fields listed here are kept sorted in the whiskeycache, so $gt/$gte/$lt/$lte queries
+    #                       bisect instead of scanning, and come back presorted when the sort is on the same field
+    CACHE_SORTED_INDEXES = set(
+                        [
+                            #'createdAt'
+                        ])
+    #CACHE_COMPOUND_INDEXES, tuples of fields hash indexed together in the whiskeycache, one level per field, so queries 
+    #                       with equality or $in on the first few of them only look at the nodes that match
+    CACHE_COMPOUND_INDEXES = [
+                            #('name', 'createdAt')
+                        ]
 
     #DATABASE FIELD MANAGEMENT, these properties auto manage data sent to and from the client
     DO_NOT_UPDATE_FIELDS = set([])
@@ -93,55 +108,68 @@ class WhiskeyNode(object):
     TERMINALS = {}
     TRAVERSALS = {}
 
-    fields = {} #PRIVATE
+    #PREFETCH_BATCH, finds with prefetch load terminals for this many nodes at a time
+    PREFETCH_BATCH = 100
+
+    #CACHE_NIN_LIMIT, finds exclude up to this many matching nodes that are already in RAM from the db query with a $nin
+    CACHE_NIN_LIMIT = 1000
+
+    #COMPACT, instances store their fields in __slots__ generated from FIELDS instead of a __dict__, and _dict
+    #only keeps what isn't a field, so there's one copy of the saved state instead of two. on_save's old_dict
+    #only has those leftovers too. traversals still go in a __dict__
+    COMPACT = False
+
+    fields = {} #PRIVATE, built for every class by WhiskeyNodeType along with _schema
 
     check_errors = True #really speeds up initialization
 
-    def __init__(self, init_with=None, dirty=True):
+    def __init__(self, init_with=None, dirty=True, projection=None):
         if self.check_errors:
             assert self.__class__ != WhiskeyNode, 'WhiskeyNode is meant to be an abstract class'
-        self._dict = init_with if init_with else {}  #why a variable here? store everything that we get out of mongo, so we don't have data loss
-        self._dirty = dirty
-        self._is_new_local = False
-        self._save_record = {}
-        self._terminals = None
-        self._traversals = None
-        self.DO_NOT_RENDER_FIELDS.update(self.DEFAULT_DO_NOT_RENDER_FIELDS)
-        self.DO_NOT_UPDATE_FIELDS.update(self.DEFAULT_DO_NOT_UPDATE_FIELDS)
-        
-        #INIT CLASS FIELDS
-        if self.__class__.fields == {}:
-            self.__class__.fields = FieldDict(self.DEFAULT_FIELDS, **self.FIELDS)
-        #self.fields = self.__class__._FIELDS.copy()
-
-        #INIT CLASS TERMINALS
-        if self.__class__.TERMINALS == {}:
-            self.__class__.init_terminals()
-            for name in self.__class__.TERMINALS:
-                self.__class__._add_terminal_property(self, name)
-            if self.check_errors:
-                bad_fields = set(self.__class__.fields.keys()).intersection(list(self.__class__.RESERVED_FIELDS) + self.__class__.TERMINALS.keys() + self.__dict__.keys())
-                if len(bad_fields) > 0:
-                    raise InvalidFieldNameException('Fields %s cannot be used on class %s because they are reserved or terminals.' % (str(bad_fields), str(self.__class__)))
-            for name in self.__class__.TRAVERSALS:
-                self.__class__._add_traversal_property(self, name)
+        cls = self.__class__
+        if cls.COMPACT:
+            store = partial(object.__setattr__, self) #into slots, touching __dict__ would create it
+        else:
+            store = self.__dict__.__setitem__ #straight into __dict__, skipping __setattr__
+        data = init_with if init_with else {}
+        store('_changed', set()) #fields that were assigned or removed since the last save
+        store('_unloaded', set()) #fields a projection left out, they're fetched the first time they're touched
+        store('_dict', data)  #why a variable here? store everything that we get out of mongo, so we don't have data loss
+        store('_dirty', dirty)
+        store('_is_new_local', False)
+        store('_terminals', None)
+        store('_traversals', None)
+        unloaded = self._unloaded
+
+        #INIT CLASS TERMINALS, terminals can point at classes defined later, so this waits for the first instance
+        if '_terminals_ready' not in cls.__dict__:
+            self._init_class_terminals()
+
+        if cls.COMPACT:
+            #the fields are the only copy of what we loaded, _dict keeps whatever isn't a field so it isn't lost
+            store('_dict', dict((k, v) for k, v in data.iteritems() if k not in cls.fields and k not in cls.TRAVERSALS))
+        if projection is not None:
+            unloaded.update(x for x in itertools.chain(cls.fields, cls.TRAVERSALS) if x not in data)
 
         #INIT INSTANCE FIELDS
-        for field, field_type in self.fields.items():
-            try: #this is in two places to prevent a function call in a loop
-                if field_type is dict or field_type is list:
-                    self.__dict__[field] = deepcopy(self._dict[field]) #make a copy so we can compare it later (this is in two places)
-                else:
-                    self.__dict__[field] = self._dict[field]
-            except KeyError:
-                self.__dict__[field] = field_type()
-                if field == '_id':
-                    self._is_new_local = True
-        for field, trav in self.traversals.items():
+        for field, field_type, is_container in cls._schema.fields:
+            if unloaded and field in unloaded:
+                continue
             try:
-                self.__dict__[field] = self._dict[field]
+                value = data[field]
             except KeyError:
-                self.__dict__[field] = trav.default_value
+                value = field_type()
+                if field == '_id':
+                    store('_is_new_local', True)
+            store(field, track(value, self, field) if is_container else value) #None and scalars are kept as they are
+        if cls.TRAVERSALS:
+            for field, trav in self.traversals.items():
+                if field in unloaded:
+                    continue
+                try:
+                    self.__dict__[field] = data[field]
+                except KeyError:
+                    self.__dict__[field] = trav.default_value
         
         whiskeycache.save( self )
 
@@ -162,23 +190,30 @@ class WhiskeyNode(object):
 
 
     @classmethod
-    def find(cls, query={}, limit=0, skip_cache=False, sort=None, skip=0):
+    def find(cls, query={}, limit=0, skip_cache=False, sort=None, skip=0, projection=None, prefetch=None):
         '''
             Returns an iterator of whiskeynodes SORTED HIGHEST TO LOWEST _id (most recent first)
             all params are passed to pymongo except skip_cache - this allows you to make complex queries to mongodb
+            projection is a list of field names, nodes that aren't already in RAM are loaded with just those
+            fields (and the sort fields), the rest are fetched the first time they're touched
+            prefetch is a list of terminal names, they're loaded for PREFETCH_BATCH nodes at a time as you iterate
         ''' 
         if sort is None:
             sort = [('_id', -1)]
         else:
             assert isinstance(sort, list) and len(sort) >= 1, 'sort should be a list of tuples'
             assert isinstance(sort[0], tuple), 'sort should be a list of tuples'
+        if projection is not None:
+            projection = cls._projection(projection, [key.split('.')[0] for key, direction in sort]) #the merge needs the sort keys
 
-        existing = deque( whiskeycache.find(cls, query, sort)) if not skip_cache else [] #grab the items we already have in RAM
+        existing = whiskeycache.find(cls, query, sort) if not skip_cache else [] #grab the items we already have in RAM, sorted
+        node_key, document_key = sort_keys(sort)
+        db_query, db_skip, db_limit, excludes_existing = cls._plan_find(query, existing, skip_cache, limit, skip)
         
-        if limit > 0:
-            cursor = cls.COLLECTION.find(query, limit=limit+skip).sort(sort) #otherwise, hit the db, todo, pass a $notin:_ids
+        if db_query is None:
+            cursor = None #the whole collection is in RAM
         else:
-            cursor = cls.COLLECTION.find(query).sort(sort) #todo - take out the if else after fixing mongo mock
+            cursor = cls.COLLECTION.find(db_query, fields=projection, sort=sort, skip=db_skip, limit=db_limit)
         class WhiskeyCursor():
             def __init__(self, existing, cursor, limit=0, skip=0):
                 self.existing = existing
@@ -186,14 +221,20 @@ class WhiskeyNode(object):
                 self.__count = None
                 self.__limit = limit
                 self.__retrieved = 0
-                self.__d = None
-                if skip > 0:
-                    skipped = 0
-                    for s in self:
-                        skipped += 1
-                        if skipped >= skip:
-                            self.__retrieved = 0
-                            break
+                self.__existing_returned = 0
+                self.__prefetched = deque()
+                #cached nodes already won, so db documents for them are dropped in the merge
+                self.__existing_ids = None if excludes_existing else set([x._id for x in existing])
+                self.__predicate = compile_query(query) if not skip_cache else None
+                self.__merged = heapq.merge(self.__existing_keys(), self.__document_keys())
+                for i in xrange(skip):
+                    #skip whatever the db couldn't, without building nodes for the documents
+                    try:
+                        key, source, i, rv = next(self.__merged)
+                    except StopIteration:
+                        break
+                    if source == 0:
+                        self.__existing_returned += 1
             def __iter__(self):
                 return self
 
@@ -201,84 +242,138 @@ class WhiskeyNode(object):
                 ''' python 3 '''
                 return self.next() 
 
+            def __existing_keys(self):
+                for i, node in enumerate(self.existing):
+                    yield node_key(node), 0, i, node
+
+            def __document_keys(self):
+                ''' documents from the db that the cache hasn't already accounted for '''
+                if self.cursor is None:
+                    return
+                for i, d in enumerate(self.cursor):
+                    if self.__existing_ids is not None and d['_id'] in self.__existing_ids:
+                        continue
+                    if self.__predicate is not None:
+                        node = whiskeycache.RAM.get(d['_id'])
+                        if node is not None and self.__predicate(node) is False:
+                            continue #changed in RAM, doesn't match anymore
+                    yield document_key(d), 1, i, d
+
             def next(self):
-                ''' this will return the items in cache and the db'''
-                if self.__limit == 0 or self.__retrieved < self.__limit:
-                    self.__retrieved = self.__retrieved + 1
-                    if len(self.existing) >  0:
-                        if self.__d is None:
-                            try:
-                                self.__d = self.cursor.next()
-                            except StopIteration:
-                                return self.existing.popleft()
-                        d = self.__d
-                        attr_existing = getattr(self.existing[0], sort[0][0])
-                        attr_d = d.get(sort[0][0])
-                        if sort[0][1] == -1:
-                            if attr_existing > attr_d:
-                                return self.existing.popleft()
-                        else:
-                            if attr_existing < attr_d:
-                                return self.existing.popleft()
-
-                        if self.existing[0]._id == d['_id']:
-                            self.__d = None
-                            return self.existing.popleft()
-                        else:
-                            self.__d = None
-                            rv = whiskeycache.from_cache(cls, d, dirty=False)
-                            try:
-                                self.existing.remove(rv) #todo test to see if "rv in self.existing" is faster than try excepting
-                            except ValueError:
-                                pass
-                            return rv
-                    else:
-                        if self.__d:
-                            d = self.__d
-                            self.__d = None
-                            return whiskeycache.from_cache(cls, d, dirty=False)
-                        else:
-                            return whiskeycache.from_cache(cls, self.cursor.next(), dirty=False)
-                raise StopIteration()
-
-            def count(self):
-                ''' NOTE - this count isn't exactly accurate
-                    since we don't know how many items will already be in the cache, but it's pretty close '''
+                ''' this will return the items in cache and the db, merged on the full sort key'''
+                if not prefetch:
+                    return self.__next_node()
+                if not self.__prefetched:
+                    batch = []
+                    try:
+                        while len(batch) < cls.PREFETCH_BATCH:
+                            batch.append(self.__next_node())
+                    except StopIteration:
+                        pass
+                    if not batch:
+                        raise StopIteration()
+                    from whiskeynode.terminals import prefetch_terminals
+                    prefetch_terminals(batch, prefetch)
+                    self.__prefetched.extend(batch)
+                return self.__prefetched.popleft()
+
+            def __next_node(self):
+                if self.__limit != 0 and self.__retrieved >= self.__limit:
+                    raise StopIteration()
+                key, source, i, rv = next(self.__merged)
+                if source == 0:
+                    self.__existing_returned += 1
+                else:
+                    rv = whiskeycache.from_cache(cls, rv, dirty=False, projection=projection)
+                self.__retrieved = self.__retrieved + 1
+                return rv
+
+            def count(self, with_limit_and_skip=True):
+                ''' the exact number of nodes the cursor has left to return, with skip and limit applied. nodes in RAM
+                    are counted the way they look in RAM. with_limit_and_skip=False counts every node the find
+                    matches like pymongo does, ignoring skip, limit and what's already been returned '''
                 if self.__count is None:
-                    #self.__count = len(self.existing) + self.cursor.count()
-                    self.__count = self.cursor.count() #we're only looking at what's actually in the db for now...
-                    for x in self.existing:
-                        if x._is_new_local:
-                            self.__count = self.__count + 1
-                return self.__count
+                    self.__count = cls._count_find(query, existing, db_query, excludes_existing, skip_cache)
+                if not with_limit_and_skip:
+                    return self.__count
+                count = max(0, self.__count - skip)
+                if self.__limit > 0:
+                    count = min(count, self.__limit)
+                return max(0, count - self.__retrieved + len(self.__prefetched))
             def limit(self, limit):
-                self.__limit = self.cursor.limit = limit
+                self.__limit = limit
 
             def __len__(self):
                 return self.count()
-        return WhiskeyCursor(existing, cursor, limit, skip)
+        return WhiskeyCursor(existing, cursor, limit, skip - db_skip)
+
+    @classmethod
+    def _plan_find(cls, query, existing, skip_cache, limit, skip):
+        ''' decides how find gets whatever isn't in RAM out of the db, returns (db_query, db_skip, db_limit, excludes_existing).
+            db_query is None if the db doesn't need to be hit at all, excludes_existing is true if the 
+            db results won't include the nodes in existing.
+            at most len(existing) of the skipped results can come from the cache, so when the db results exclude 
+            every saved node in RAM the rest of the skip can happen on the server. nodes that changed in RAM and
+            stopped matching are excluded too, otherwise the cursor drops their documents after the server 
+            already counted them towards the skip and limit '''
+        if skip_cache:
+            return query, skip, limit, True
+        if whiskeycache.is_resident(cls.COLLECTION_NAME):
+            return None, 0, 0, True
+        if skip == 0 and limit == 0:
+            unmatched = [] #nothing is counted on the server, the cursor drops them
+        else:
+            unmatched = [x._id for x in whiskeycache.find_unmatched(cls, query)]
+        ids = [x._id for x in existing] + unmatched
+        if len(ids) == 0:
+            return query, skip, limit, True
+        if len(ids) <= cls.CACHE_NIN_LIMIT:
+            db_skip = max(0, skip - len(existing))
+            return _exclude_ids(query, ids), db_skip, limit + skip - db_skip if limit > 0 else 0, True
+        #too many to send over the wire, pull them from the db, skip in the merge and drop them there
+        if len(existing) <= cls.CACHE_NIN_LIMIT:
+            return _exclude_ids(query, ids[:len(existing)]), 0, limit + skip + len(unmatched) if limit > 0 else 0, True
+        return query, 0, limit + skip + len(ids) if limit > 0 else 0, False
+
+    @classmethod
+    def _count_find(cls, query, existing, db_query, excludes_existing, skip_cache):
+        ''' the exact number of nodes a find returns: nodes in RAM that match, plus documents in the db that 
+            aren't in RAM, minus documents for nodes that changed in RAM and stopped matching '''
+        if db_query is None:
+            return len(existing)
+        if skip_cache:
+            return cls.COLLECTION.find(query).count()
+        if not excludes_existing:
+            db_query = _exclude_ids(query, [x._id for x in existing])
+        count = len(existing) + cls.COLLECTION.find(db_query).count()
+        changed = [x._id for x in whiskeycache.find_unmatched(cls, query)]
+        if len(changed) > 0:
+            count -= cls.COLLECTION.find({'$and':[db_query, {'_id':{'$in':changed}}]}).count()
+        return count
 
 
     @classmethod
-    def find_one(cls, query={}):
+    def find_one(cls, query={}, projection=None):
         '''Returns one node as a Node object or None.'''
         from_cache = whiskeycache.find_one(cls, query)
         if from_cache is not None:
             return from_cache
         else:
-            data = cls.COLLECTION.find_one(query, sort=[('_id',-1)])
+            projection = cls._projection(projection)
+            data = cls.COLLECTION.find_one(query, fields=projection, sort=[('_id',-1)])
             if data is not None:
-                return whiskeycache.from_cache(cls, data, dirty=False)
+                return whiskeycache.from_cache(cls, data, dirty=False, projection=projection)
             else:
                 return None
 
 
     @classmethod
-    def from_dbref(cls, collection, _id):
+    def from_dbref(cls, collection, _id, projection=None):
         ''' try to avoid using this function - it's not recomended in the mongodb docs '''
-        data = db[collection].find_one({'_id':_id})
+        projection = cls._projection(projection)
+        data = db[collection].find_one({'_id':_id}, fields=projection)
         if data:
-            c = cls.from_dict(data)
+            c = cls.from_dict(data, projection=projection)
             c.COLLECTION_NAME = collection
             c.COLLECTION = db[collection]
             return c
@@ -287,14 +382,14 @@ class WhiskeyNode(object):
 
 
     @classmethod
-    def from_dict(cls, data, dirty=False):
+    def from_dict(cls, data, dirty=False, projection=None):
         if data is None:
             return None
-        return whiskeycache.from_cache(cls, data, dirty)
+        return whiskeycache.from_cache(cls, data, dirty, projection)
 
 
     @classmethod
-    def from_id(cls, _id):
+    def from_id(cls, _id, projection=None):
         '''Returns a node based on the _id field.
            if objectid is a string it will try to cast it to an objectid'''
         if type(_id) is not ObjectId:
@@ -303,11 +398,12 @@ class WhiskeyNode(object):
             except InvalidId:
                 return None
         rv = whiskeycache.from_id(_id, cls.COLLECTION_NAME)
-        return rv if rv else cls.find_one({'_id': _id})
+        return rv if rv else cls.find_one({'_id': _id}, projection=projection)
 
 
     @classmethod
-    def from_ids(cls, ids):
+    def from_ids(cls, ids, projection=None, prefetch=None):
+        ''' prefetch is a list of terminal names to load on all of the nodes at once '''
         if len(ids) == 0:
             return []
         if not isinstance(ids[0], ObjectId):
@@ -320,11 +416,56 @@ class WhiskeyNode(object):
             else:
                 to_query.append(_id)
         if len(to_query) > 0:
-            cursor = cls.COLLECTION.find({'_id':{'$in':to_query}})
-            to_return.extend([whiskeycache.from_cache(cls, data, dirty=False) for data in cursor])
+            projection = cls._projection(projection)
+            cursor = cls.COLLECTION.find({'_id':{'$in':to_query}}, fields=projection)
+            to_return.extend([whiskeycache.from_cache(cls, data, dirty=False, projection=projection) for data in cursor])
+        if prefetch:
+            from whiskeynode.terminals import prefetch_terminals
+            prefetch_terminals(to_return, prefetch)
         return to_return
 
 
+    @classmethod
+    def make_resident(cls):
+        ''' loads the whole collection into RAM and keeps it there, so finds never have to hit the db. 
+            only for small collections that nobody else writes to '''
+        whiskeycache.make_resident(cls.COLLECTION_NAME)
+        for data in cls.COLLECTION.find():
+            whiskeycache.from_cache(cls, data, dirty=False)
+
+
+    @classmethod
+    def _projection(cls, projection, required=()):
+        ''' the list of fields to ask mongo for, or None for the whole document '''
+        if projection is None:
+            return None
+        if cls.check_errors:
+            assert not [x for x in projection if '.' in x], 'projections are top level fields only, saving part of a sub document would overwrite the rest of it'
+        return list(set(itertools.chain(projection, required, ['_id'])))
+
+
+    def _init_class_terminals(self):
+        cls = self.__class__
+        if cls.TERMINALS == {}:
+            cls.init_terminals()
+            for name in cls.TERMINALS:
+                cls._add_terminal_property(self, name)
+            if self.check_errors:
+                bad_fields = set(cls.fields.keys()).intersection(list(cls.RESERVED_FIELDS) + cls.TERMINALS.keys() + self.__dict__.keys())
+                if len(bad_fields) > 0:
+                    raise InvalidFieldNameException('Fields %s cannot be used on class %s because they are reserved or terminals.' % (str(bad_fields), str(cls)))
+            for name in cls.TRAVERSALS:
+                cls._add_traversal_property(self, name)
+        cls._terminals_ready = True
+        from whiskeynode.terminals import register_counters
+        register_counters(cls)
+
+    @classmethod
+    def _ensure_class_terminals(cls):
+        ''' sets up the class's terminals without waiting for its first instance '''
+        if '_terminals_ready' not in cls.__dict__:
+            cls.__new__(cls)._init_class_terminals()
+
     @classmethod
     def init_terminals(cls):
         cls.TERMINALS =     {
@@ -365,18 +506,32 @@ class WhiskeyNode(object):
     def add_field(self, field, field_type, render=True, update=True, dirty=True):
         if self.check_errors:
                 self._check_add_field_errors(field, field_type)
-        try: #this is in two places to prevent a function call in a loop
-            if field_type is dict or field_type is list:
-                self.__dict__[field] = deepcopy(self._dict[field]) #make a copy so we can compare it later
+        if self.fields.get(field) is not field_type:
+            self.fields[field] = field_type
+            self.__class__._schema = NodeSchema(self.__class__)
+        if self._unloaded and field not in self._dict:
+            #partially loaded, the db might have a value for it
+            self._unloaded.add(field)
+        else:
+            try: #this is in two places to prevent a function call in a loop
+                value = self._dict[field]
+            except KeyError:
+                value = field_type()
+                self._changed.add(field)
             else:
-                self.__dict__[field] = self._dict[field]
-        except KeyError:
-            self.__dict__[field] = field_type()
-        self.fields[field] = field_type
-        if render == False:
+                if self.COMPACT:
+                    del self._dict[field] #it's a field now, only keep one copy
+            if field_type is dict or field_type is list:
+                value = track(value, self, field) #anything that isn't a dict or list is left alone
+            if field in self._schema.cache_indexed:
+                whiskeycache.index_field(self, field, value)
+            object.__setattr__(self, field, value)
+        if render == False and field not in self.DO_NOT_RENDER_FIELDS:
             self.DO_NOT_RENDER_FIELDS.add(field)
-        if update == False:
+            self.__class__._schema = NodeSchema(self.__class__)
+        if update == False and field not in self.DO_NOT_UPDATE_FIELDS:
             self.DO_NOT_UPDATE_FIELDS.add(field)
+            self.__class__._schema = NodeSchema(self.__class__)
         self._dirty = self._dirty or dirty
 
     def add_inbound_edge(self, name, edge):
@@ -392,12 +547,19 @@ class WhiskeyNode(object):
         self._add_terminal(self, name, connection_def)
         self._add_terminal_property(self, name)
 
+    def connected(self, name, node, max_depth=None):
+        ''' is node reachable along the terminal called name, see whiskeynode.graph '''
+        return self.terminals[name].connected(node, max_depth)
+
     def get_field(self, name, default=None):
         ''' for generically getting fields on a whiskey node '''
-        try:
-            return self.__dict__[name]
-        except KeyError:
-            return self._dict.get(name, default)
+        value = peek(self, name, MISSING)
+        if value is not MISSING:
+            return value
+        if name in self._unloaded:
+            self._load()
+            return peek(self, name)
+        return self._dict.get(name, default)
 
     def get_inbound_edges(self):
         from whiskeynode.edges import Edge
@@ -419,37 +581,58 @@ class WhiskeyNode(object):
     def has_terminal(self, name):
         return name in self.terminals
 
+    def k_hop(self, name, k):
+        ''' _ids k hops or less away along the terminal called name, one list per hop '''
+        return self.terminals[name].k_hop(k)
+
     def pre_render(self):
         data = {}
         for field in self.PRE_RENDER_FIELDS:
-            try:
-                data[field] = self.__dict__[field]
-            except KeyError:
-                try:
-                    data[field] = self._dict[field]
-                except KeyError:
-                    pass
+            value = peek(self, field, MISSING)
+            if value is not MISSING:
+                data[field] = value
+            elif field in self._dict:
+                data[field] = self._dict[field]
         data['guid'] = str(self._id)
         return data
 
-    def remove(self):
-        ''' removes this node and all inbound and outbound edges pointing to this node'''
+    def remove(self, session=None):
+        ''' removes this node and all inbound and outbound edges pointing to this node. the deletes go in the session 
+            a write for this node is still waiting in, if there is one, so flushing it can't put the node back. 
+            otherwise they're flushed together, pass a session to flush it yourself '''
+        if session is None:
+            session = waiting_session(self._id)
+            if session is None:
+                session = WhiskeySession()
+                self._remove(session)
+                session.flush()
+                return
+        self._remove(session)
+
+    def _remove(self, session):
+        ''' queues the deletes for this node and its edges in the session '''
         ob = list(self.get_outbound_edges())
         for edge in ob:
             if edge.inboundId in whiskeycache.RAM:
                 whiskeycache.RAM[edge.inboundId].remove_inbound_edge(edge.name, edge)
-            edge.remove()
+            edge.remove(session)
         ib = list(self.get_inbound_edges())
         for edge in ib:
             if edge.outboundId in whiskeycache.RAM:
                 whiskeycache.RAM[edge.outboundId].remove_outbound_edge(edge.name, edge)
-            edge.remove()
+            edge.remove(session)
         whiskeycache.remove(self)
-        self.COLLECTION.remove(self._id)
+        session.remove(self.COLLECTION, {'_id':self._id})
 
     def remove_field(self, field):
-        if field in self.__dict__:
-            del self.__dict__[field]
+        if field in self._schema.cache_indexed:
+            whiskeycache.index_field(self, field, None)
+        self._unloaded.discard(field)
+        self._changed.add(field)
+        try:
+            object.__delattr__(self, field)
+        except AttributeError:
+            pass
         if field in self._dict:
             del self._dict[field]
 
@@ -468,7 +651,7 @@ class WhiskeyNode(object):
 
     def render(self, render_terminals=True):
         data = self._to_dict()
-        for field in self.DO_NOT_RENDER_FIELDS:
+        for field in self._schema.do_not_render:
             try:
                 del data[field]
             except KeyError:
@@ -488,73 +671,164 @@ class WhiskeyNode(object):
         else:
             return r
 
-    def save(self, update_last_modified=True, current_user_id = None, save_id=None, save_terminals=True):
-        if save_id is None:
-            save_id = get_new_save_id()
+    def save(self, update_last_modified=True, current_user_id = None, save_terminals=True, session=None):
+        ''' saves this node and everything it's connected to that changed. writes are collected in the session 
+            and flushed together at the end, pass a session to flush it yourself '''
+        if session is None:
+            session = WhiskeySession()
+            self.save(update_last_modified, current_user_id, save_terminals, session)
+            session.flush()
+            return self
 
         if current_user_id is None:
             current_user_id=get_current_user_id()
-        
-        if save_id not in self._save_record:
-            self._save_record[save_id] = True #prevent infinite recursive loops
-            data = self._to_dict()
-
-            is_saving = self._dirty or self._diff_dict(data)
-            #from logger import logger
-            #logger.debug(    '--------------- save ' + str(self) + " : " + str(data.get('name','')))
-            if is_saving:
-
-                #for k in data:
-                #    if self._dict.get(k) is None or cmp(data[k], self._dict.get(k)) != 0:
-                #        try:
-                #            logger.debug(    '!! ' + k + " : " + str(data[k]) + " : " + str(self._dict.get(k)))
-                #        except UnicodeEncodeError:
-                #            logger.debug(    '!! ' + k + " : bad UnicodeEncodeError")
-
-
-                if self.check_errors:
-                    assert self._id is not None and self._id != ''
-                if update_last_modified:
-                    data['lastModified'] = self.lastModified = datetime.now()
-                if self.check_errors:
-                    assert self.COLLECTION_NAME != '_whiskeynode', 'COLLECTION_NAME has not ben defined for class %s' % self.__class__
-
-                #save to db
-                
-                #logger.debug('+++++++++++++++++ save ' + str(self) + " : " + str(data.get('name','')))
-                key = self.COLLECTION.save(data, safe=True)
-                self._dirty = False
-                self._is_new_local = False
-                #record changes in event if requested
-                self.on_save(new_dict=data, old_dict=self._dict)
-                #reset our current state
-                self._dict = data
 
-            #save our terminals
+        #walk the graph with a worklist instead of recursing, visited only lives as long as this save
+        visited = set()
+        worklist = deque([self])
+        while worklist:
+            node = worklist.popleft()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            node._save_self(session, update_last_modified)
             if save_terminals:
-                for name, terminal in self.terminals.items():
-                    terminal.save(update_last_modified=update_last_modified, current_user_id=current_user_id, save_id=save_id)
+                for terminal in node.terminals.values():
+                    worklist.extend(terminal.to_save())
         return self
 
+    def _save_self(self, session, update_last_modified):
+        ''' queues the write for this node in the session, if anything changed '''
+        if (self._dirty or self._is_new_local) and not self._unloaded:
+            sets, unsets = None, None #write the whole document
+        else:
+            sets, unsets = self._changes()
+
+        if sets is None or sets or unsets:
+            if self.check_errors:
+                assert self._id is not None and self._id != ''
+            if update_last_modified:
+                self.lastModified = datetime.now()
+                if sets is not None:
+                    sets['lastModified'] = self.lastModified
+            if self.check_errors:
+                assert self.COLLECTION_NAME != '_whiskeynode', 'COLLECTION_NAME has not ben defined for class %s' % self.__class__
+
+            #save to db
+            if sets is None:
+                data = self._to_dict(copy_containers=False)
+                if self._is_new_local:
+                    session.insert(self.COLLECTION, data)
+                else:
+                    session.save(self.COLLECTION, data)
+            else:
+                #only send what changed, partially loaded nodes can't clobber the fields they don't have
+                data = self._dict.copy()
+                data.update(sets)
+                update = {}
+                if sets:
+                    update['$set'] = sets
+                if unsets:
+                    update['$unset'] = unsets
+                    for field in unsets:
+                        data.pop(field, None)
+                session.update(self.COLLECTION, {'_id':self._id}, update)
+            #if the flush fails, put back what the write was made from so saving again retries it
+            session.on_failure(self.COLLECTION, partial(self._restore, self._dirty, self._is_new_local, set(self._changed), self._dict))
+            self._dirty = False
+            self._is_new_local = False
+            self._changed.clear()
+            #record changes in event if requested
+            self.on_save(new_dict=data, old_dict=self._dict)
+            #reset our current state, compact nodes only keep what isn't in a field
+            if self.COMPACT:
+                self._dict = dict((k, v) for k, v in data.iteritems() if k not in self.fields and k not in self.TRAVERSALS)
+            else:
+                self._dict = data
+
+    def _restore(self, dirty, is_new_local, changed, saved):
+        ''' undoes what queueing a write did, the session it was in failed to flush '''
+        self._dirty = self._dirty or dirty
+        self._is_new_local = is_new_local
+        self._changed.update(changed)
+        self._dict = saved
+
     def on_save(self, new_dict, old_dict):
         pass
 
+    def shortest_path(self, name, node, max_depth=None):
+        ''' _ids from this node to node along the terminal called name, or None '''
+        return self.terminals[name].shortest_path(node, max_depth)
+
+    def _set_counter(self, field, value):
+        ''' counters are only ever written with $inc, this keeps the node in step without marking the field changed '''
+        if field in self._unloaded:
+            return #it'll come back from the db with the new value
+        object.__setattr__(self, field, value)
+        if field in self._dict:
+            #a copy, the last write may still be waiting in a session with this dict
+            self._dict = dict(self._dict)
+            self._dict[field] = value
+
     def set_field(self, name, value):
         ''' for generically getting fields on a whiskey node '''
-        if name not in self.fields:
+        if isinstance(value, (dict, list)):
+            if name not in self.fields:
+                self.add_field(name, dict if isinstance(value, dict) else list)
+            value = track(value, self, name)
+        elif name not in self.fields:
             self.add_field(name, type(value))
-        self.__dict__[name] = value
-
-    def _to_dict(self):
+        if name in self._schema.cache_indexed:
+            whiskeycache.index_field(self, name, value)
+        self._unloaded.discard(name)
+        self._changed.add(name)
+        object.__setattr__(self, name, value)
+
+    def _changes(self):
+        ''' returns ($set, $unset) for the fields that changed since the last save. fields only need to be compared 
+            if they were assigned, removed, or (for dicts and lists) changed in place, traversals are always compared '''
+        fields = set(self._changed)
+        fields.update(self.TRAVERSALS)
+        fields.difference_update(self._unloaded)
+        sets = {}
+        unsets = {}
+        for field in fields:
+            if field in self.TRAVERSALS:
+                value = getattr(self, field)
+            else:
+                value = peek(self, field, MISSING)
+                if value is MISSING:
+                    if field in self._changed:
+                        unsets[field] = True #removed
+                    continue
+            if value is None:
+                continue #same as _to_dict, None leaves the saved value alone
+            if field not in self._dict or value != self._dict[field]:
+                if isinstance(value, (TrackedDict, TrackedList)):
+                    #what we send becomes what was saved, keep changing a fresh copy of the top level
+                    object.__setattr__(self, field, track(value, self, field))
+                sets[field] = value
+        return sets, unsets
+
+    def _to_dict(self, copy_containers=True):
         data = self._dict.copy()
         for field, field_type in self.fields.items():
+            if field in self._unloaded:
+                continue
             value = getattr(self, field)
             if value is not None:
-                if field_type is dict or field_type is list:
-                    data[field] = deepcopy(value) #make a copy so we can compare it later
+                if isinstance(value, (TrackedDict, TrackedList)):
+                    if copy_containers:
+                        data[field] = deepcopy(value)
+                    else:
+                        #what we send becomes what was saved, keep changing a fresh copy of the top level
+                        data[field] = value
+                        object.__setattr__(self, field, track(value, self, field))
                 else:
                     data[field] = value
         for field in self.TRAVERSALS:
+            if field in self._unloaded:
+                continue
             value = getattr(self, field)
             if value is not None:
                 data[field] = value
@@ -569,10 +843,13 @@ class WhiskeyNode(object):
 
     def update(self, data):
         '''Performs an update on the node from a dict. Does not save.'''
-        fields = set(self.fields.keys()) - self.DO_NOT_UPDATE_FIELDS
-        for field in fields:
+        for field in self._schema.updatable:
             if field in data:
-                self.__dict__[field] = data[field]
+                if field in self._schema.cache_indexed:
+                    whiskeycache.index_field(self, field, data[field])
+                self._unloaded.discard(field)
+                self._changed.add(field)
+                object.__setattr__(self, field, track(data[field], self, field) if isinstance(data[field], (dict, list)) else data[field])
         if self.check_errors and environment != 'production':
             legit_fields = self.fields.keys() + self.terminals.keys() + self.traversals.keys() + ['guid']
             bad_fields = set(data.keys()) - set(legit_fields)
@@ -586,7 +863,7 @@ class WhiskeyNode(object):
     ##
 
     def _check_add_field_errors(self, field, field_type):
-        if  field in self.__dict__ or field in self.RESERVED_FIELDS or field in self.TERMINALS:
+        if  peek(self, field, MISSING) is not MISSING or field in self.RESERVED_FIELDS or field in self.TERMINALS:
             raise InvalidFieldNameException('Field name [%s] on %s is not valid because it is a reserved field or a terminal' % (field, self.__class__))
     
     def _init_terminals(self):
@@ -606,7 +883,7 @@ class WhiskeyNode(object):
     @classmethod
     def _add_terminal_property(cls, self, name):
         if cls.check_errors:
-            if name in self.RESERVED_FIELDS or name in self.fields or name in self.__dict__:
+            if name in self.RESERVED_FIELDS or name in self.fields or name in getattr(self, '__dict__', ()):
                 raise InvalidConnectionNameException('Terminal name [%s] on %s is not valid because it is a reserved field.' % (name, self.__class__))
         
         if not hasattr(cls, name):
@@ -655,10 +932,53 @@ class WhiskeyNode(object):
         return self.traversals[name].delete()
     
 
+    def _load(self):
+        ''' fetches the fields a projection left out '''
+        unloaded = self._unloaded
+        self._unloaded = set()
+        data = self.COLLECTION.find_one({'_id':self._id}, fields=list(unloaded)) or {}
+        for field in unloaded:
+            if field in data and not (self.COMPACT and field in self.fields):
+                self._dict[field] = data[field]
+            if field in self.fields:
+                field_type = self.fields[field]
+                value = data[field] if field in data else field_type()
+                if field_type is dict or field_type is list:
+                    value = track(value, self, field)
+            else:
+                value = data.get(field, self.traversals[field].default_value)
+            if field in self._schema.cache_indexed:
+                whiskeycache.index_field(self, field, value)
+            if field in self.fields:
+                object.__setattr__(self, field, value)
+            else:
+                self.__dict__[field] = value
+
     def _diff_dict(self, target_dict):
         ''' return false if same same, true if we find diffs '''
         return cmp(self._dict, target_dict) != 0
 
+    def __getattr__(self, name):
+        ''' only called when the normal lookup fails, partially loaded nodes fetch the rest of their fields here '''
+        try:
+            unloaded = object.__getattribute__(self, '_unloaded')
+        except AttributeError:
+            raise AttributeError(name) #still in __init__
+        if name in unloaded:
+            self._load()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self._schema.cache_indexed:
+            whiskeycache.index_field(self, name, value)
+        if name in self.fields:
+            self._changed.add(name)
+            self._unloaded.discard(name) #assigning a field loads it
+            if isinstance(value, (dict, list)):
+                value = track(value, self, name)
+        object.__setattr__(self, name, value)
+
     def __eq__(self, other):
         return other != None and self._id == other._id
 
@@ -670,6 +990,11 @@ class WhiskeyNode(object):
         return '%s:%s' % (self.__class__.__name__, self.guid)
 
 
+def _exclude_ids(query, ids):
+    if '_id' in query:
+        return {'$and':[query, {'_id':{'$nin':ids}}]}
+    return dict(query, _id={'$nin':ids})
+
 def str_to_objectid(guid):
     #guid should be a string, try to cast the guid to an ObjectId - hopefully it works maybe
     if guid is None:
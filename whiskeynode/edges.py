@@ -1,7 +1,15 @@
+from functools import partial
+from operator import attrgetter, itemgetter
 from whiskeynode import WhiskeyNode
+from whiskeynode import whiskeycache
 from whiskeynode.db import db
 from whiskeynode.exceptions import InvalidEdgeParameterException
-from whiskeynode.fieldtypes import _none
+from whiskeynode.fieldtypes import _none, peek
+from whiskeynode.sessions import WhiskeySession, waiting_session
+
+#counted terminals, (node collection, 'inbound' or 'outbound' end, edge name, collection at the other end):(node class, field)
+#filled in as classes set up their terminals, edges keep the fields in step as they're inserted and removed
+COUNTERS = {}
 
 class Edge(WhiskeyNode):
 
@@ -12,6 +20,8 @@ class Edge(WhiskeyNode):
     
     COLLECTION = db[COLLECTION_NAME]
 
+    COMPACT = True #there are a lot more edges than nodes
+
     FIELDS =            {
                             'inboundId': _none, #query for edges with an inboundId that matches mine for all connections pointing to me
                             'inboundCollection':_none,
@@ -23,12 +33,18 @@ class Edge(WhiskeyNode):
                         }
 
     ENSURE_INDEXES =    [
-                            #todo - i want to sort these by _id - newest first, may need to update the indexes
-                            [('inboundId',1), ('outboundCollection',1), ('name',1)],
-                            [('outboundId',1), ('name',1)],
+                            #_id last so terminals can page through their edges newest first
+                            [('inboundId',1), ('outboundCollection',1), ('name',1), ('_id',-1)],
+                            [('outboundId',1), ('name',1), ('_id',-1)],
                             [('name', 1), ('outboundCollection', 1), ('createdAt', 1)], #for the metrics
                         ]
 
+    #the same lookups terminals make against the db, so finding a node's edges in RAM is O(degree)
+    CACHE_COMPOUND_INDEXES = [
+                            ('inboundId', 'outboundCollection', 'name'),
+                            ('outboundId', 'name'),
+                        ]
+
     def __init__(self, *args, **kwargs):
         WhiskeyNode.__init__(self, *args, **kwargs)
 
@@ -60,6 +76,64 @@ class Edge(WhiskeyNode):
                 'terminalType':terminaltype,
             })
 
+    @classmethod
+    def find_refs(cls, query, limit=0, before=None):
+        ''' like find, but edges that aren't already in RAM come back as EdgeRefs instead of being loaded.
+            for terminals that only need to know who they're connected to. newest first, 
+            page through them with limit and before (the _id of the last edge on the previous page) '''
+        if before is not None:
+            query = dict(query, _id={'$lt':before})
+        rv = whiskeycache.find(cls, query, [('_id', -1)])
+        seen = set(x._id for x in rv)
+        if limit > 0:
+            rv = rv[:limit]
+        found = 0
+        while True:
+            #edges in RAM come back from the db too, ask for enough to fill the page without them
+            cursor = cls.COLLECTION.find(query, fields=EdgeRef.FIELDS).sort('_id', -1)
+            if limit > 0:
+                cursor = cursor.limit(limit + len(seen))
+            returned = 0
+            for doc in cursor:
+                returned += 1
+                if doc['_id'] in seen or doc['_id'] in whiskeycache.RAM:
+                    continue #in RAM, and either we have it or it doesn't match anymore
+                rv.append(EdgeRef.from_doc(doc))
+                found += 1
+                if found == limit:
+                    break
+            if limit == 0 or found == limit or returned < limit + len(seen):
+                break
+            query = dict(query, _id={'$lt':doc['_id']}) #RAM took more than its share of the page, keep going
+        if limit > 0:
+            rv.sort(key=attrgetter('_id'), reverse=True)
+            rv = rv[:limit]
+        return rv
+
+    @classmethod
+    def count_by(cls, query, key, limit=0, min_count=1, skip_db=False, skip_cache=False):
+        ''' [(key value, number of edges)] for the edges matching query, most first. the db does it in one
+            $match/$group, edges that haven't been saved yet are counted out of RAM on top of that.
+            skip_db when the query can only match unsaved edges (everything it asks about is new locally),
+            skip_cache to count only what's in the db '''
+        counts = {}
+        for edge in (whiskeycache.find(cls, query, None) if not skip_cache else ()):
+            if edge._is_new_local:
+                value = getattr(edge, key)
+                counts[value] = counts.get(value, 0) + 1
+        if not skip_db:
+            pipeline = [{'$match':query}, {'$group':{'_id':'$' + key, 'count':{'$sum':1}}}]
+            if not counts:
+                #nothing to add to the db's numbers, so it can filter and cut the list itself
+                if min_count > 1:
+                    pipeline.append({'$match':{'count':{'$gte':min_count}}})
+                if limit > 0:
+                    pipeline.extend([{'$sort':{'count':-1}}, {'$limit':limit}])
+            for value, count in _aggregate_counts(cls.COLLECTION, pipeline):
+                counts[value] = counts.get(value, 0) + count
+        rv = sorted((x for x in counts.iteritems() if x[1] >= min_count), key=itemgetter(1), reverse=True)
+        return rv[:limit] if limit > 0 else rv
+
     @classmethod
     def from_nodes(cls, outbound_node, inbound_node, name, terminaltype):
         #if checkerrors
@@ -78,7 +152,113 @@ class Edge(WhiskeyNode):
             )
 
 
+    def _remove(self, session):
+        saved = not self._is_new_local
+        WhiskeyNode._remove(self, session)
+        if saved and COUNTERS:
+            _count_edge(session, self, self.name, -1)
+
+    @classmethod
+    def remove_many(cls, edges, name=None, session=None):
+        ''' removes Edges or EdgeRefs from the cache and the db with one write. like remove(), the edges that 
+            point at these edges go too, found with one more query, and the deletes go in the session a write 
+            for them is waiting in. name is the edges' name, EdgeRefs don't have it and counted terminals need it '''
+        if session is None:
+            for edge in edges:
+                session = waiting_session(edge._id)
+                if session is not None:
+                    break
+            else:
+                session = WhiskeySession()
+                cls._remove_many(edges, name, session)
+                session.flush()
+                return
+        cls._remove_many(edges, name, session)
+
+    @classmethod
+    def _remove_many(cls, edges, name, session):
+        ids = []
+        for edge in edges:
+            cached = whiskeycache.RAM.get(edge._id)
+            if cached is not None:
+                whiskeycache.remove(cached)
+            if cached is None or not cached._is_new_local:
+                ids.append(edge._id)
+                if COUNTERS:
+                    _count_edge(session, edge, cached.name if cached is not None else name, -1)
+        if ids:
+            session.remove(cls.COLLECTION, {'_id':{'$in':ids}})
+        removed = set(ids)
+        removed.update(x._id for x in edges)
+        hanging = [x for x in cls.find({'$or':[{'outboundId':{'$in':list(removed)}}, {'inboundId':{'$in':list(removed)}}]}) if x._id not in removed]
+        for edge in hanging:
+            #tell the other end, like WhiskeyNode.remove does
+            if edge.outboundId in removed:
+                node = whiskeycache.RAM.get(edge.inboundId)
+                if node is not None:
+                    node.remove_inbound_edge(edge.name, edge)
+            else:
+                node = whiskeycache.RAM.get(edge.outboundId)
+                if node is not None:
+                    node.remove_outbound_edge(edge.name, edge)
+        if hanging:
+            cls._remove_many(hanging, None, session)
+
+    def _save_self(self, session, update_last_modified):
+        inserting = self._is_new_local
+        WhiskeyNode._save_self(self, session, update_last_modified)
+        if inserting and COUNTERS:
+            _count_edge(session, self, self.name, 1) #in the same flush as the insert
+
     def __str__(self):
         return '<Edge %s %s::%s->%s>' % (self.guid, self.name, self.outboundCollection, self.inboundCollection)
 
 
+
+def _count_edge(session, edge, name, delta):
+    ''' $inc the counters on both ends of an edge that was just inserted or removed, and the nodes in RAM '''
+    for collection, end, _id, other in (
+            (edge.outboundCollection, 'outbound', edge.outboundId, edge.inboundCollection),
+            (edge.inboundCollection, 'inbound', edge.inboundId, edge.outboundCollection)):
+        try:
+            node_class, field = COUNTERS[(collection, end, name, other)]
+        except KeyError:
+            continue
+        node = whiskeycache.RAM.get(_id)
+        if node is None or not node._is_new_local:
+            session.update(node_class.COLLECTION, {'_id':_id}, {'$inc':{field:delta}})
+        if node is not None:
+            #new nodes are inserted with whatever they have when they're saved
+            count = peek(node, field) or 0
+            node._set_counter(field, count + delta)
+            session.on_failure(node_class.COLLECTION, partial(node._set_counter, field, count))
+
+def _aggregate_counts(collection, pipeline):
+    ''' (_id, count) for each group a $match/$group pipeline returns '''
+    result = collection.aggregate(pipeline)
+    docs = result['result'] if isinstance(result, dict) else result #pymongo 2 returns a dict, 3 a cursor
+    return ((doc['_id'], doc['count']) for doc in docs)
+
+
+class EdgeRef(tuple):
+    ''' the ids of a saved edge, a few dozen bytes instead of an Edge. promote() loads the whole thing, 
+        do that before changing it or reading its data '''
+    __slots__ = ()
+
+    FIELDS = ['_id', 'inboundId', 'outboundId', 'inboundCollection', 'outboundCollection']
+
+    _id = property(itemgetter(0))
+    inboundId = property(itemgetter(1))
+    outboundId = property(itemgetter(2))
+    inboundCollection = property(itemgetter(3))
+    outboundCollection = property(itemgetter(4))
+
+    @classmethod
+    def from_doc(cls, doc):
+        return tuple.__new__(cls, (doc['_id'], doc.get('inboundId'), doc.get('outboundId'), doc.get('inboundCollection'), doc.get('outboundCollection')))
+
+    def promote(self):
+        return Edge.from_id(self._id)
+
+    def __repr__(self):
+        return '<EdgeRef %s %s->%s>' % (self._id, self.outboundId, self.inboundId)
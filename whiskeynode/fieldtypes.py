@@ -1,6 +1,8 @@
 '''
 because sometimes you want a boolean that defaults to true
 '''
+from copy import deepcopy
+import weakref
 
 #suppored types from pymongo:
 '''
@@ -53,3 +55,210 @@ class FieldDict(dict):
             ret_val.append('  %s: %r\n' % (key, self[key]))
         ret_val.append('}')
         return ''.join(ret_val)
+
+
+def peek(node, field, default=None):
+    ''' a field's value straight off a node, without fetching fields a projection left out. works for compact nodes too '''
+    try:
+        return object.__getattribute__(node, field)
+    except AttributeError:
+        return default
+
+
+'''
+tracked containers - dict and list fields on nodes are wrapped in these instead of being deep copied and compared 
+on save. every level is wrapped (and copied) when its parent is, so nothing is shared with what was loaded from 
+the db, and any change marks the field as changed on its node. it can't be left until a child is reached, 
+dict(x), {}.update(x) and [] + x copy the raw children of a dict or list subclass without asking it. containers 
+put in later are wrapped the first time they're handed out
+'''
+
+def track(value, node, field):
+    ''' wraps a dict or list field value. anything else (None, a scalar from a document that doesn't match 
+        the schema) is stored as it is '''
+    if not isinstance(value, (dict, list)):
+        return value
+    return _track(value, weakref.ref(node), field, object())
+
+def _track(value, ref, field, root):
+    if isinstance(value, dict):
+        return TrackedDict(value, ref, field, root)
+    return TrackedList(value, ref, field, root)
+
+def _is_container(value):
+    return type(value) is dict or type(value) is list
+
+def _mutates(method):
+    def mutate(self, *args, **kwargs):
+        node = self._ref()
+        if node is not None:
+            node._changed.add(self._field)
+        return method(self, *args, **kwargs)
+    mutate.__name__ = method.__name__
+    return mutate
+
+class _Tracked(object):
+    __slots__ = ()
+
+    def _child(self, key, value):
+        ''' children that aren't wrapped yet are wrapped (and copied) when they're reached, 
+            including tracked children that came from another node or an older save '''
+        if _is_container(value) or (isinstance(value, (TrackedDict, TrackedList)) and value._root is not self._root):
+            value = _track(value, self._ref, self._field, self._root)
+            self._store(key, value)
+        return value
+
+    def __copy__(self):
+        self._track_children()
+        return self._plain()(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self._plain()(self), memo)
+
+    def __reduce__(self):
+        return (self._plain(), (self._plain()(self),))
+
+
+class TrackedDict(_Tracked, dict):
+    __slots__ = ('_ref', '_field', '_root')
+
+    def __init__(self, value, ref, field, root):
+        dict.__init__(self, value)
+        self._ref = ref
+        self._field = field
+        self._root = root
+        self._track_children()
+
+    def _plain(self):
+        return dict
+
+    def _store(self, key, value):
+        dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        return self._child(key, dict.__getitem__(self, key))
+
+    def _track_children(self):
+        for key in dict.keys(self):
+            self[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def copy(self):
+        return self.__copy__()
+
+    def viewvalues(self):
+        self._track_children()
+        return dict.viewvalues(self)
+
+    def viewitems(self):
+        self._track_children()
+        return dict.viewitems(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            self[key]
+        return self._pop(key, *default)
+
+    def popitem(self):
+        self._track_children()
+        return self._popitem()
+
+    def itervalues(self):
+        for key in dict.keys(self):
+            yield self[key]
+
+    def iteritems(self):
+        for key in dict.keys(self):
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    __setitem__ = _mutates(dict.__setitem__)
+    __delitem__ = _mutates(dict.__delitem__)
+    clear = _mutates(dict.clear)
+    _pop = _mutates(dict.pop)
+    _popitem = _mutates(dict.popitem)
+    update = _mutates(dict.update)
+
+
+class TrackedList(_Tracked, list):
+    __slots__ = ('_ref', '_field', '_root')
+
+    def __init__(self, value, ref, field, root):
+        list.__init__(self, value)
+        self._ref = ref
+        self._field = field
+        self._root = root
+        self._track_children()
+
+    def _plain(self):
+        return list
+
+    def _store(self, index, value):
+        list.__setitem__(self, index, value)
+
+    def _track_children(self):
+        for i in xrange(len(self)):
+            self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return self._child(index, list.__getitem__(self, index))
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(max(0, i), max(0, j)))
+
+    def __iter__(self):
+        for i, value in enumerate(list.__iter__(self)):
+            yield self._child(i, value)
+
+    def __reversed__(self):
+        for i in xrange(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __add__(self, other):
+        self._track_children()
+        return list.__add__(list(self), other)
+
+    def __radd__(self, other):
+        self._track_children()
+        return list.__add__(list(other), self)
+
+    def __mul__(self, n):
+        self._track_children()
+        return list.__mul__(list(self), n)
+
+    __rmul__ = __mul__
+
+    def pop(self, index=-1):
+        if self:
+            self[index]
+        return self._pop(index)
+
+    __setitem__ = _mutates(list.__setitem__)
+    __delitem__ = _mutates(list.__delitem__)
+    __setslice__ = _mutates(list.__setslice__)
+    __delslice__ = _mutates(list.__delslice__)
+    __iadd__ = _mutates(list.__iadd__)
+    __imul__ = _mutates(list.__imul__)
+    append = _mutates(list.append)
+    extend = _mutates(list.extend)
+    insert = _mutates(list.insert)
+    _pop = _mutates(list.pop)
+    remove = _mutates(list.remove)
+    reverse = _mutates(list.reverse)
+    sort = _mutates(list.sort)
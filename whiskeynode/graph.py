@@ -0,0 +1,127 @@
+from whiskeynode.edges import Edge
+from whiskeynode.exceptions import InvalidTerminalOperationException
+from whiskeynode.terminals import BIDIRECTIONAL, INBOUND, OUTBOUND
+
+'''
+Graph searches - breadth first walks along one terminal, a level at a time. every level is one $in
+edge query per direction (two for bidirectional terminals), nodes are never loaded, and the
+visited sets are plain sets of _ids
+to run:
+    user.friends.k_hop(2)                  #[[friend _ids], [friend of friend _ids]]
+    user.friends.shortest_path(other_user) #[user._id, ..., other_user._id] or None
+    user.friends.connected(other_user, max_depth=6)
+searches longer than one hop keep following the same terminal, so it has to lead back to the class it's on
+'''
+
+
+def k_hop(terminal, k):
+    ''' the _ids k hops or less from the terminal's node, one list per hop. each _id only shows up
+        at the first hop that reaches it, and the node itself is never in there '''
+    if k > 1:
+        _check_walkable(terminal)
+    step = _step_from(terminal, reverse=False)
+    visited = set([terminal.node._id])
+    frontier = [terminal.node._id]
+    rv = []
+    for i in xrange(k):
+        level = []
+        for _id, neighbours in step(frontier):
+            for neighbour in neighbours:
+                if neighbour not in visited:
+                    visited.add(neighbour)
+                    level.append(neighbour)
+        if not level:
+            break
+        rv.append(level)
+        frontier = level
+    return rv
+
+def shortest_path(terminal, target, max_depth=None):
+    ''' the _ids along a shortest path from the terminal's node to target, both ends included,
+        or None if there isn't one max_depth hops or shorter. searches from both ends at once,
+        expanding whichever frontier is smaller '''
+    _check_walkable(terminal)
+    source = terminal.node._id
+    target = getattr(target, '_id', target)
+    if source == target:
+        return [source]
+    forward = _Search(source, _step_from(terminal, reverse=False))
+    backward = _Search(target, _step_from(terminal, reverse=True))
+    depth = 0
+    while forward.frontier and backward.frontier and (max_depth is None or depth < max_depth):
+        if len(forward.frontier) <= len(backward.frontier):
+            meeting = forward.expand(backward)
+        else:
+            meeting = backward.expand(forward)
+        depth += 1
+        if meeting is not None:
+            return forward.path_to(meeting)[::-1] + backward.path_to(meeting)[1:]
+    return None
+
+def connected(terminal, target, max_depth=None):
+    return shortest_path(terminal, target, max_depth) is not None
+
+
+class _Search(object):
+    ''' one end of a bidirectional search '''
+    def __init__(self, root, step):
+        self.step = step
+        self.parents = {root:None}
+        self.depths = {root:0}
+        self.frontier = [root]
+
+    def expand(self, other):
+        ''' walks one level, returns the _id closest to other's root that both searches have seen, if any '''
+        depth = self.depths[self.frontier[0]] + 1
+        level = []
+        meeting = None
+        for _id, neighbours in self.step(self.frontier):
+            for neighbour in neighbours:
+                if neighbour in self.parents:
+                    continue
+                self.parents[neighbour] = _id
+                self.depths[neighbour] = depth
+                level.append(neighbour)
+                if neighbour in other.depths and (meeting is None or other.depths[neighbour] < other.depths[meeting]):
+                    meeting = neighbour
+        self.frontier = level
+        return meeting
+
+    def path_to(self, _id):
+        ''' _id back to the root '''
+        rv = []
+        while _id is not None:
+            rv.append(_id)
+            _id = self.parents[_id]
+        return rv
+
+
+def _check_walkable(terminal):
+    if terminal.to_node_class.COLLECTION_NAME != terminal.node.COLLECTION_NAME:
+        raise InvalidTerminalOperationException(
+            'Terminal [%s] on [%s] leads to [%s], searches past one hop need a terminal back to the same class' %
+                (terminal.original_name, terminal.node.__class__, terminal.to_node_class))
+
+def _step_from(terminal, reverse):
+    ''' a function from a frontier of _ids to (_id, [neighbour _ids]) pairs, one query per direction.
+        reverse walks the terminal's edges backwards, for searching from the far end '''
+    directions = [INBOUND, OUTBOUND] if terminal.direction == BIDIRECTIONAL else [terminal.direction]
+    if reverse:
+        directions = [OUTBOUND if x == INBOUND else INBOUND for x in directions]
+    #the collection the far end of an inbound edge has to be in
+    collection = (terminal.node if reverse else terminal.to_node_class).COLLECTION_NAME
+    name = terminal.name
+
+    def step(frontier):
+        rv = {}
+        for direction in directions:
+            if direction == OUTBOUND:
+                refs = Edge.find_refs({'outboundId':{'$in':frontier}, 'name':name})
+                pairs = ((x.outboundId, x.inboundId) for x in refs)
+            else:
+                refs = Edge.find_refs({'inboundId':{'$in':frontier}, 'outboundCollection':collection, 'name':name})
+                pairs = ((x.inboundId, x.outboundId) for x in refs)
+            for _id, neighbour in pairs:
+                rv.setdefault(_id, []).append(neighbour)
+        return rv.iteritems()
+    return step
@@ -0,0 +1,358 @@
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+import operator
+
+'''
+Compiled queries - turns mongo style query dicts into python predicates for searching nodes in RAM.
+The structure of a query (keys and operators, not values) is compiled once into a binder, binders are
+kept in a small LRU keyed by that structure, and binding the values of a query returns a predicate(node).
+Predicates never load fields a projection left out, they return None when the answer depends on one,
+or on an operator outside SUPPORTED_OPERATORS, so the node is left for the db to decide.
+'''
+
+COMPILED_QUERY_CACHE_SIZE = 256
+
+SUPPORTED_OPERATORS = ('$in', '$nin', '$ne', '$gt', '$gte', '$lt', '$lte', '$exists')
+LOGICAL_OPERATORS = ('$or', '$and', '$nor')
+
+_compiled = OrderedDict() #shape:binder
+lock = Lock()
+
+
+class _Missing(object):
+    def __repr__(self):
+        return 'MISSING'
+MISSING = _Missing() #what a getter returns when a node doesn't have the field at all
+
+class _Unknown(Exception):
+    ''' a getter reached a field that isn't loaded '''
+    pass
+
+class _Values(list):
+    ''' the values found when a dotted path fans out over a list of sub documents '''
+    pass
+
+
+def bson_order(value):
+    ''' mongo only compares values of the same type in range queries, this returns the
+        rank of the value's type in mongo's sort order so we can do the same '''
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 2
+    if isinstance(value, basestring):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def compile_query(query):
+    ''' returns predicate(node) for the query, True or False, or None if it can't tell without loading fields '''
+    shape = _shape(query)
+    with lock:
+        bind = _compiled.pop(shape, None)
+    if bind is None:
+        bind = _compile(query)
+    with lock:
+        if len(_compiled) >= COMPILED_QUERY_CACHE_SIZE:
+            _compiled.popitem(last=False)
+        _compiled[shape] = bind
+    return _known(bind(query))
+
+def clear_compiled_queries():
+    ''' for testing '''
+    with lock:
+        _compiled.clear()
+
+
+def _is_operators(value):
+    return type(value) is dict and len(value) > 0 and all(k.startswith('$') for k in value)
+
+def _shape(query):
+    rv = []
+    for key, value in query.iteritems():
+        if key in LOGICAL_OPERATORS:
+            rv.append((key, tuple([_shape(q) for q in value])))
+        elif _is_operators(value):
+            rv.append((key, tuple(sorted(value))))
+        else:
+            rv.append((key, None))
+    rv.sort()
+    return tuple(rv)
+
+
+def _compile(query):
+    ''' returns binder(query) -> predicate(node) for queries shaped like this one '''
+    binders = []
+    for key, value in query.iteritems():
+        if key in LOGICAL_OPERATORS:
+            binders.append(_bind_logical(key, [_compile(q) for q in value]))
+        elif key.startswith('$'):
+            binders.append(_bind_unknown(None, key, key)) #$where, $text...
+        elif _is_operators(value):
+            get = _getter(key)
+            for op in value:
+                binders.append(_OPERATORS.get(op, _bind_unknown)(get, key, op))
+        else:
+            binders.append(_bind_equals(_getter(key), key))
+
+    if len(binders) == 0:
+        return lambda query: _true
+    if len(binders) == 1:
+        return binders[0]
+    def bind(query):
+        return _all([b(query) for b in binders])
+    return bind
+
+def _true(node):
+    return True
+
+def _known(predicate):
+    def known(node):
+        try:
+            return predicate(node)
+        except _Unknown:
+            return None
+    return known
+
+def _all(predicates):
+    ''' False if any of them is, even when others can't tell '''
+    def predicate(node):
+        unknown = None
+        for p in predicates:
+            try:
+                if not p(node):
+                    return False
+            except _Unknown as e:
+                unknown = e
+        if unknown is not None:
+            raise unknown
+        return True
+    return predicate
+
+def _any(predicates):
+    ''' True if any of them is, even when others can't tell '''
+    def predicate(node):
+        unknown = None
+        for p in predicates:
+            try:
+                if p(node):
+                    return True
+            except _Unknown as e:
+                unknown = e
+        if unknown is not None:
+            raise unknown
+        return False
+    return predicate
+
+
+''' getters '''
+
+def _getter(key, load=False):
+    ''' returns get(node) -> value, MISSING or _Values for dotted paths that fan out over lists.
+        fields a projection left out raise _Unknown, unless load is true and they're fetched '''
+    parts = key.split('.')
+    field = parts[0]
+    def get(node):
+        try:
+            return object.__getattribute__(node, field) #skips __getattr__, which would load the field
+        except AttributeError:
+            if field in node._unloaded:
+                if load:
+                    return getattr(node, field)
+                raise _Unknown(field)
+            return node._dict.get(field, MISSING)
+    if len(parts) == 1:
+        return get
+    path = parts[1:]
+    def get_path(node):
+        return _descend(get(node), path)
+    return get_path
+
+def _descend(value, path):
+    for i, part in enumerate(path):
+        #plain dict and list lookups, so reading a tracked field doesn't copy it
+        if isinstance(value, dict):
+            value = dict.get(value, part, MISSING)
+        elif isinstance(value, list):
+            if part.isdigit():
+                index = int(part)
+                value = list.__getitem__(value, index) if index < len(value) else MISSING
+            else:
+                rv = _Values()
+                for x in list.__iter__(value):
+                    if isinstance(x, dict):
+                        found = _descend(x, path[i:])
+                        if type(found) is _Values:
+                            rv.extend(found)
+                        elif found is not MISSING:
+                            rv.append(found)
+                return rv if len(rv) > 0 else MISSING
+        else:
+            return MISSING
+        if value is MISSING:
+            break
+    return value
+
+
+''' binders, each takes the getter and key/operator it was compiled for, and returns binder(query) -> predicate(node) '''
+
+def _bind_logical(op, sub_binders):
+    def bind(query):
+        predicates = [b(q) for b, q in zip(sub_binders, query[op])]
+        if op == '$or':
+            return _any(predicates)
+        elif op == '$nor':
+            matches = _any(predicates)
+            return lambda node: not matches(node)
+        else:
+            return _all(predicates)
+    return bind
+
+def _bind_equals(get, key, op=None):
+    def bind(query):
+        arg = query[key] if op is None else query[key][op]
+        def predicate(node):
+            value = get(node)
+            if value == arg:
+                return True
+            if value is MISSING:
+                return arg is None
+            if isinstance(value, list):
+                return arg in value #arrays match if any element matches
+            return False
+        if op == '$ne':
+            return lambda node: not predicate(node)
+        return predicate
+    return bind
+
+def _bind_in(get, key, op):
+    def bind(query):
+        args = query[key][op]
+        try:
+            members = frozenset(args)
+        except TypeError:
+            members = args
+        def is_member(value):
+            try:
+                return value in members
+            except TypeError:
+                return value in args
+        def predicate(node):
+            value = get(node)
+            if value is MISSING:
+                value = None
+            if is_member(value):
+                return True
+            if isinstance(value, list):
+                for x in value:
+                    if is_member(x):
+                        return True
+            return False
+        if op == '$nin':
+            return lambda node: not predicate(node)
+        return predicate
+    return bind
+
+_COMPARISONS = {
+                    '$gt':operator.gt,
+                    '$gte':operator.ge,
+                    '$lt':operator.lt,
+                    '$lte':operator.le,
+                }
+
+def _bind_range(get, key, op):
+    compare = _COMPARISONS[op]
+    def bind(query):
+        bound = query[key][op]
+        bound_type = type(bound)
+        order = bson_order(bound)
+        def matches(value):
+            return (type(value) is bound_type or bson_order(value) == order) and compare(value, bound)
+        def predicate(node):
+            value = get(node)
+            if matches(value):
+                return True
+            if isinstance(value, list):
+                for x in value:
+                    if matches(x):
+                        return True
+            return False
+        return predicate
+    return bind
+
+def _bind_exists(get, key, op):
+    ''' fields set to None aren't saved, so as far as the cache is concerned they don't exist '''
+    def bind(query):
+        if query[key][op]:
+            return lambda node: get(node) not in (MISSING, None)
+        else:
+            return lambda node: get(node) in (MISSING, None)
+    return bind
+
+def _bind_unknown(get, key, op):
+    ''' operators the cache doesn't evaluate ($regex, $all, $elemMatch...), nodes are left for the db to decide '''
+    def predicate(node):
+        raise _Unknown(op)
+    return lambda query: predicate
+
+_OPERATORS = {
+                '$in':_bind_in,
+                '$nin':_bind_in,
+                '$ne':_bind_equals,
+                '$gt':_bind_range,
+                '$gte':_bind_range,
+                '$lt':_bind_range,
+                '$lte':_bind_range,
+                '$exists':_bind_exists,
+            }
+
+
+''' sorting '''
+
+class SortKey(object):
+    ''' orders nodes and documents the way mongo would for a pymongo style sort, including mixed directions '''
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, values, directions):
+        self.values = values #[(bson order, value)]
+        self.directions = directions
+
+    def __lt__(self, other):
+        for a, b, direction in zip(self.values, other.values, self.directions):
+            if a != b:
+                return a < b if direction > 0 else b < a
+        return False
+
+    def __eq__(self, other):
+        return not self < other and not other < self
+
+    def __ne__(self, other):
+        return not self == other
+
+def sort_keys(sort):
+    ''' returns (node_key, document_key), functions that build a SortKey from a node in RAM or a raw document from the db '''
+    directions = [direction for key, direction in sort]
+    node_getters = [_getter(key, load=True) for key, direction in sort]
+    paths = [key.split('.') for key, direction in sort]
+    def node_key(node):
+        return SortKey([_sort_value(get(node)) for get in node_getters], directions)
+    def document_key(document):
+        return SortKey([_sort_value(_descend(document, path)) for path in paths], directions)
+    return node_key, document_key
+
+def _sort_value(value):
+    if value is MISSING:
+        value = None
+    return (bson_order(value), value)
@@ -0,0 +1,64 @@
+from whiskeynode.fieldtypes import FieldDict
+
+'''
+Schemas - everything a node class needs to build instances, worked out once when the class is created
+(and again if add_field adds a field to the class) instead of on every __init__
+'''
+
+
+class NodeSchema(object):
+    __slots__ = ('fields', 'names', 'containers', 'do_not_render', 'do_not_update', 'updatable', 'cache_indexed')
+
+    def __init__(self, cls):
+        #(name, default factory, is a dict or list), DEFAULT_FIELDS first then FIELDS, each sorted by name
+        fields = []
+        for name in sorted(cls.DEFAULT_FIELDS) + sorted(x for x in cls.fields if x not in cls.DEFAULT_FIELDS):
+            field_type = cls.fields[name]
+            fields.append((name, field_type, field_type is dict or field_type is list))
+        self.fields = tuple(fields)
+        self.names = frozenset(cls.fields)
+        self.containers = frozenset(name for name, field_type, is_container in fields if is_container)
+        self.do_not_render = frozenset(cls.DO_NOT_RENDER_FIELDS)
+        self.do_not_update = frozenset(cls.DO_NOT_UPDATE_FIELDS)
+        #fields the whiskeycache has to hear about before they change
+        self.cache_indexed = frozenset(cls.CACHE_INDEXES).union(cls.CACHE_SORTED_INDEXES, *cls.CACHE_COMPOUND_INDEXES)
+        self.updatable = self.names - self.do_not_update #set last, it freezes the schema
+
+    def __setattr__(self, name, value):
+        if hasattr(self, 'updatable'):
+            raise AttributeError('schemas are frozen, build a new one')
+        object.__setattr__(self, name, value)
+
+
+#what every node stores besides its fields, compact classes get slots for these too
+INTERNAL_SLOTS = ('_changed', '_dict', '_dirty', '_is_new_local', '_terminals', '_traversals', '_unloaded')
+
+
+class WhiskeyNodeType(type):
+    ''' metaclass for WhiskeyNode, gives every class its own fields, render/update masks and schema. 
+        classes with COMPACT = True get __slots__ for their fields so instances don't need a __dict__ '''
+    def __new__(mcs, name, bases, attrs):
+        if '__slots__' not in attrs and _inherited('COMPACT', attrs, bases):
+            fields = set(_inherited('DEFAULT_FIELDS', attrs, bases)) | set(_inherited('FIELDS', attrs, bases))
+            taken = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    taken.update(klass.__dict__.get('__slots__', ()))
+            attrs['__slots__'] = tuple(sorted(fields.union(INTERNAL_SLOTS) - taken))
+        return type.__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        cls.fields = FieldDict(cls.DEFAULT_FIELDS, **cls.FIELDS)
+        cls.DO_NOT_RENDER_FIELDS = set(cls.DO_NOT_RENDER_FIELDS) | cls.DEFAULT_DO_NOT_RENDER_FIELDS
+        cls.DO_NOT_UPDATE_FIELDS = set(cls.DO_NOT_UPDATE_FIELDS) | cls.DEFAULT_DO_NOT_UPDATE_FIELDS
+        cls._schema = NodeSchema(cls)
+
+
+def _inherited(name, attrs, bases):
+    if name in attrs:
+        return attrs[name]
+    for base in bases:
+        if hasattr(base, name):
+            return getattr(base, name)
+    return None
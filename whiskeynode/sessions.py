@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import weakref
+
+'''
+Unit of work - a save collects the writes for every dirty node and edge it reaches in a session,
+then flushes them as one ordered bulk write per collection. removes go in the session too
+to run:
+    session = WhiskeySession()
+    user.save(session=session)
+    session.flush()
+    print session.write_counts #{'collectionName':documents written}
+or:
+    with WhiskeySession() as session:
+        user.save(session=session)
+'''
+
+INSERT = 0
+SAVE = 1
+UPDATE = 2
+REMOVE = 3
+
+#_id:session, the documents with writes waiting in a session that hasn't been flushed
+_waiting = weakref.WeakValueDictionary()
+
+def waiting_session(_id):
+    ''' the session a write for the document with _id is waiting in, if there is one. removing it has 
+        to go in there too, or the flush would write it back '''
+    return _waiting.get(_id)
+
+
+class WhiskeySession(object):
+    def __init__(self):
+        self.pending = OrderedDict() #'databaseName.collectionName':(collection, [(op, args)])
+        self.write_counts = {} #'collectionName':documents written, across every flush
+        self._restores = {} #'databaseName.collectionName':[callables that undo what queueing the writes did]
+        self._ids = set() #what this session has in _waiting
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def insert(self, collection, document):
+        self._add(collection, INSERT, (document,), document['_id'])
+
+    def save(self, collection, document):
+        ''' replaces the whole document, inserting it if it isn't there '''
+        self._add(collection, SAVE, (document,), document['_id'])
+
+    def update(self, collection, spec, document):
+        self._add(collection, UPDATE, (spec, document), spec.get('_id'))
+
+    def remove(self, collection, spec):
+        self._add(collection, REMOVE, (spec,), spec.get('_id'))
+
+    def on_failure(self, collection, restore):
+        ''' restore is called if the writes for collection fail, so what queued them can be saved again '''
+        self._restores.setdefault(collection.full_name, []).append(restore)
+
+    def _add(self, collection, op, args, _id):
+        try:
+            self.pending[collection.full_name][1].append((op, args))
+        except KeyError:
+            #full names, collections with the same name in different databases are written separately
+            self.pending[collection.full_name] = (collection, [(op, args)])
+        if _id is not None and not isinstance(_id, dict):
+            _waiting[_id] = self
+            self._ids.add(_id)
+
+    def flush(self):
+        ''' writes everything, one round trip per collection. if a collection's writes fail, the 
+            restores for it and the collections after it are run and the error is raised '''
+        pending = self.pending.items()
+        restores = self._restores
+        self.pending = OrderedDict()
+        self._restores = {}
+        for _id in self._ids:
+            if _waiting.get(_id) is self:
+                del _waiting[_id]
+        self._ids = set()
+        for i, (name, (collection, ops)) in enumerate(pending):
+            try:
+                if hasattr(type(collection), 'initialize_ordered_bulk_op'): #collections make sub collections out of unknown attributes
+                    _bulk_write(collection, ops)
+                else:
+                    _write(collection, ops)
+            except Exception:
+                for name, entry in pending[i:]:
+                    for restore in reversed(restores.get(name, ())):
+                        restore()
+                raise
+            self.write_counts[collection.name] = self.write_counts.get(collection.name, 0) + len(ops)
+
+    def __len__(self):
+        return sum(len(ops) for collection, ops in self.pending.values())
+
+
+def _bulk_write(collection, ops):
+    bulk = collection.initialize_ordered_bulk_op()
+    for op, args in ops:
+        if op == INSERT:
+            bulk.insert(args[0])
+        elif op == SAVE:
+            bulk.find({'_id':args[0]['_id']}).upsert().replace_one(args[0])
+        elif op == UPDATE:
+            bulk.find(args[0]).update_one(args[1])
+        else:
+            bulk.find(args[0]).remove()
+    bulk.execute()
+
+def _write(collection, ops):
+    ''' for collections without the bulk api (mongomock), runs of inserts still go in one call '''
+    inserts = []
+    for op, args in ops:
+        if op == INSERT:
+            inserts.append(args[0])
+            continue
+        if inserts:
+            collection.insert(inserts)
+            inserts = []
+        if op == SAVE:
+            collection.save(args[0], safe=True)
+        elif op == UPDATE:
+            collection.update(args[0], args[1], safe=True)
+        else:
+            collection.remove(args[0])
+    if inserts:
+        collection.insert(inserts)
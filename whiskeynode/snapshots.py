@@ -0,0 +1,201 @@
+from array import array
+from whiskeynode.edges import Edge
+from whiskeynode.terminals import BIDIRECTIONAL, INBOUND, OUTBOUND
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Graph snapshots - one terminal's edges pulled out of the edge collection in a single pass and packed
+into a compressed sparse row adjacency (numpy arrays), for analytics over the whole graph that would
+take a query per node through the terminals. nodes are numbered 0..n-1, ids[i] is node i's _id
+to run:
+    snapshot = GraphSnapshot.from_terminal(User, 'activities')
+    snapshot.degrees()                         #activities per node
+    snapshot.ranked(snapshot.co_occurrence(user._id), limit=10) #[(_id, activities shared with user)]
+    snapshot.ranked(snapshot.pagerank([user._id]), limit=10)
+snapshots are read only and only see saved edges, build a new one to pick up changes
+needs numpy
+'''
+
+
+class GraphSnapshot(object):
+
+    #BATCH_SIZE, how many edges the cursor pulls per round trip while building
+    BATCH_SIZE = 10000
+
+    def __init__(self, ids, indptr, indices, index=None):
+        self.ids = ids #node number -> _id
+        self.index = index if index is not None else dict((_id, i) for i, _id in enumerate(ids)) #_id -> node number
+        self.indptr = indptr #node i's neighbours are indices[indptr[i]:indptr[i+1]]
+        self.indices = indices
+        self._transpose = None
+
+    def __repr__(self):
+        return 'GraphSnapshot of %d nodes and %d edges' % (len(self), self.edge_count)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, _id):
+        return _id in self.index
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    @classmethod
+    def from_terminal(cls, node_class, name):
+        ''' every saved edge of node_class's terminal called name, in one streamed query per edge direction '''
+        if np is None:
+            raise ImportError('graph snapshots need numpy')
+        node_class._ensure_class_terminals()
+        definition = node_class.TERMINALS[name]
+        to_node_class, direction = definition.args[:2]
+        edge_name = (definition.keywords or {}).get('inbound_name') or name
+        index = {}
+        rows = array('l')
+        cols = array('l')
+        if direction == OUTBOUND or direction == BIDIRECTIONAL:
+            query = {'name':edge_name, 'outboundCollection':node_class.COLLECTION_NAME, 'inboundCollection':to_node_class.COLLECTION_NAME}
+            cls._stream(query, 'outboundId', 'inboundId', index, rows, cols)
+        if direction == INBOUND or direction == BIDIRECTIONAL:
+            query = {'name':edge_name, 'outboundCollection':to_node_class.COLLECTION_NAME, 'inboundCollection':node_class.COLLECTION_NAME}
+            cls._stream(query, 'inboundId', 'outboundId', index, rows, cols)
+        ids = [None] * len(index)
+        for _id, i in index.iteritems():
+            ids[i] = _id
+        indptr, indices = _csr(np.array(rows, dtype=np.int_), np.array(cols, dtype=np.int_), len(ids))
+        return cls(ids, indptr, indices, index)
+
+    @classmethod
+    def _stream(cls, query, row_field, col_field, index, rows, cols):
+        number = index.setdefault
+        cursor = Edge.COLLECTION.find(query, fields=[row_field, col_field]).batch_size(cls.BATCH_SIZE)
+        for doc in cursor:
+            rows.append(number(doc[row_field], len(index)))
+            cols.append(number(doc[col_field], len(index)))
+
+    ##
+    ## lookups
+    ##
+
+    def degrees(self):
+        ''' neighbours per node, by node number '''
+        return np.diff(self.indptr)
+
+    def degree(self, _id):
+        i = self.index.get(_id)
+        return 0 if i is None else int(self.indptr[i + 1] - self.indptr[i])
+
+    def neighbours(self, _id):
+        i = self.index.get(_id)
+        return [] if i is None else [self.ids[x] for x in self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def numbers(self, ids):
+        ''' node numbers for the _ids in the snapshot, the rest are dropped '''
+        index = self.index
+        return np.array([index[x] for x in ids if x in index], dtype=np.int_)
+
+    def ranked(self, scores, limit=None, exclude=()):
+        ''' [(_id, score)] best first for a per node array like the ones below, nodes scoring 0 are left out '''
+        scores = np.asarray(scores)
+        candidates = np.flatnonzero(scores)
+        if len(exclude):
+            candidates = np.setdiff1d(candidates, self.numbers(exclude), assume_unique=True)
+        order = candidates[np.argsort(-scores[candidates], kind='mergesort')]
+        if limit is not None:
+            order = order[:limit]
+        return [(self.ids[i], scores[i].item()) for i in order]
+
+    def transpose(self):
+        ''' the same snapshot with every edge turned around, shares ids and index '''
+        if self._transpose is None:
+            rows = np.repeat(np.arange(len(self), dtype=np.int_), self.degrees())
+            indptr, indices = _csr(self.indices, rows, len(self))
+            self._transpose = GraphSnapshot(self.ids, indptr, indices, self.index)
+            self._transpose._transpose = self
+        return self._transpose
+
+    ##
+    ## analytics
+    ##
+
+    def co_occurrence(self, _id):
+        ''' per node, how many neighbours it shares with _id - users who share activities. 0 for _id itself '''
+        rv = np.zeros(len(self), dtype=np.int_)
+        i = self.index.get(_id)
+        if i is None:
+            return rv
+        reverse = self.transpose()
+        shared = _gather(reverse.indptr, reverse.indices, self.indices[self.indptr[i]:self.indptr[i + 1]])
+        rv += np.bincount(shared, minlength=len(self))
+        rv[i] = 0
+        return rv
+
+    def k_hop(self, _id, k):
+        ''' the _ids k hops or less from _id, one list per hop, like whiskeynode.graph.k_hop '''
+        i = self.index.get(_id)
+        if i is None:
+            return []
+        visited = np.zeros(len(self), dtype=bool)
+        visited[i] = True
+        frontier = np.array([i], dtype=np.int_)
+        rv = []
+        for hop in xrange(k):
+            level = np.unique(_gather(self.indptr, self.indices, frontier))
+            level = level[~visited[level]]
+            if not len(level):
+                break
+            visited[level] = True
+            rv.append([self.ids[x] for x in level])
+            frontier = level
+        return rv
+
+    def pagerank(self, personalization=None, alpha=0.85, tol=1e-6, max_iter=100):
+        ''' pagerank by node number. personalization is a list of _ids (or {_id:weight}) the random
+            walk restarts from, everywhere if it's None. rank from nodes with no neighbours restarts too '''
+        n = len(self)
+        if n == 0:
+            return np.zeros(0)
+        if personalization is None:
+            restart = np.ones(n) / n
+        else:
+            weights = personalization if isinstance(personalization, dict) else dict.fromkeys(personalization, 1.0)
+            restart = np.zeros(n)
+            for _id, weight in weights.iteritems():
+                if _id in self.index:
+                    restart[self.index[_id]] += weight
+            if restart.sum() == 0:
+                return np.zeros(n)
+            restart /= restart.sum()
+        degrees = self.degrees()
+        dangling = degrees == 0
+        spread = np.where(dangling, 0.0, 1.0 / np.maximum(degrees, 1))
+        rank = restart.copy()
+        for iteration in xrange(max_iter):
+            moved = np.bincount(self.indices, weights=np.repeat(rank * spread, degrees), minlength=n)
+            new_rank = alpha * moved + (alpha * rank[dangling].sum() + 1 - alpha) * restart
+            delta = np.abs(new_rank - rank).sum()
+            rank = new_rank
+            if delta < tol:
+                break
+        return rank
+
+
+def _csr(rows, cols, n):
+    ''' (indptr, indices) for the edges rows[i]->cols[i], duplicates dropped, each row's neighbours ascending '''
+    keys = np.unique(rows.astype(np.int64) * n + cols)
+    rows, indices = np.divmod(keys, n)
+    indptr = np.zeros(n + 1, dtype=np.int_)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, indices.astype(np.int_)
+
+def _gather(indptr, indices, rows):
+    ''' the neighbours of every node in rows, concatenated, without a python loop '''
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return indices[offsets + np.arange(offsets.size)]
@@ -1,8 +1,13 @@
 
+from bisect import bisect_left, bisect_right
 from functools import partial
+from itertools import chain
+from operator import itemgetter
 from whiskeynode import whiskeycache
 from whiskeynode import WhiskeyNode
-from whiskeynode.edges import Edge
+from whiskeynode.edges import COUNTERS, Edge, EdgeRef
+from whiskeynode.schema import NodeSchema
+from whiskeynode.sessions import WhiskeySession
 from whiskeynode.terminaltypes import TerminalType
 from whiskeynode.exceptions import (BadEdgeRemovalException,
                                     InvalidEdgeDataException,
@@ -47,11 +52,13 @@ def outbound_list(  to_node_class,
                     attributes=None, 
                     sort_func=None, 
                     voteable=False,
+                    page_size=None,
+                    counted=False,
                  ):
     if attributes is not None:
-        return partial(AttributedListOfNodesTerminal, to_node_class, OUTBOUND, render=render, attributes=attributes, sort_func=sort_func)
+        return partial(AttributedListOfNodesTerminal, to_node_class, OUTBOUND, render=render, attributes=attributes, sort_func=sort_func, page_size=page_size, counted=counted)
     else:
-        return partial(ListOfNodesTerminal,           to_node_class, OUTBOUND, render=render)
+        return partial(ListOfNodesTerminal,           to_node_class, OUTBOUND, render=render, page_size=page_size, counted=counted)
 
 def inbound_list(   to_node_class, 
                     inbound_name, 
@@ -59,17 +66,21 @@ def inbound_list(   to_node_class,
                     sort_func=None, 
                     render=False, 
                     voteable=False,
+                    page_size=None,
+                    counted=False,
                 ):
     if attributes is not None:
-        return partial(AttributedListOfNodesTerminal, to_node_class, INBOUND, inbound_name=inbound_name, attributes=attributes, sort_func=sort_func, render=render)
+        return partial(AttributedListOfNodesTerminal, to_node_class, INBOUND, inbound_name=inbound_name, attributes=attributes, sort_func=sort_func, render=render, page_size=page_size, counted=counted)
     else:
-        return partial(ListOfNodesTerminal,           to_node_class, INBOUND, inbound_name=inbound_name, render=render)
+        return partial(ListOfNodesTerminal,           to_node_class, INBOUND, inbound_name=inbound_name, render=render, page_size=page_size, counted=counted)
 
 def bidirectional_list( to_node_class, 
                         render=False, 
                         voteable=False,
+                        page_size=None,
+                        counted=False,
                       ):
-    return partial(ListOfNodesTerminal, to_node_class, BIDIRECTIONAL, render=render)
+    return partial(ListOfNodesTerminal, to_node_class, BIDIRECTIONAL, render=render, page_size=page_size, counted=counted)
 
 '''
 class BaseTerminal():
@@ -81,7 +92,6 @@ class BaseTerminal():
         self.terminaltype = terminaltype
         self.direction = direction
         self._render = render
-        self._insave = False
 
         if self.direction == INBOUND and inbound_name == None:
             raise InvalidTerminalException('inbound_name cannot be none when direction is INBOUND')
@@ -118,7 +128,6 @@ class NodeTerminal():
         self.terminaltype = TerminalType.NODE
         self.direction = direction
         self._render = render
-        self._insave = False
 
         if self.direction == INBOUND and inbound_name == None:
             raise InvalidTerminalException('inbound_name cannot be none when direction is INBOUND')
@@ -126,6 +135,7 @@ class NodeTerminal():
         self._edge = None
         self._to_node = None
         self.create_on_request = create_on_request
+        self.version = 0 #bumped whenever the edge changes, traversals use it to know their memo is stale
         
         if self.direction != OUTBOUND and self.direction != INBOUND:
             raise InvalidTerminalException('Node terminals can only be INBOUND or OUTBOUND')
@@ -155,11 +165,13 @@ class NodeTerminal():
         if self._to_node is None:
             self.activated = True
             self._edge = edge
+            self.version += 1
             self.get()
 
     def add_outbound_edge(self, edge):
         self.activated = True
         self._edge = edge
+        self.version += 1
         self._to_node = self.to_node_class.from_id(self._get_to_node_id())
 
     def delete(self):
@@ -181,6 +193,20 @@ class NodeTerminal():
     def exists(self):
         return self._edge != None or Edge.find(self.edge_query()).count() > 0
 
+    def connected(self, node, max_depth=None):
+        from whiskeynode import graph
+        return graph.connected(self, node, max_depth)
+
+    def k_hop(self, k):
+        ''' _ids k hops or less away along this terminal, one list per hop, see whiskeynode.graph '''
+        from whiskeynode import graph
+        return graph.k_hop(self, k)
+
+    def shortest_path(self, node, max_depth=None):
+        ''' _ids from this terminal's node to node along this terminal, or None, see whiskeynode.graph '''
+        from whiskeynode import graph
+        return graph.shortest_path(self, node, max_depth)
+
     def get_self(self):
         return self.get()
 
@@ -199,7 +225,8 @@ class NodeTerminal():
         return self._to_node
 
     def get_edge(self):
-        if not self.activated or self._edge is None:
+        ''' the edge, looked up once. an activated terminal without one knows it has none '''
+        if not self.activated:
             assert self._edge is None, 'edge should be none'
             self._edge = Edge.find_one(self.edge_query())
             assert  self.direction == INBOUND or \
@@ -216,6 +243,7 @@ class NodeTerminal():
             if self.get_edge() is not None and self._edge._id == edge._id:
                 self._edge = None
                 self._to_node = None
+                self.version += 1
                 #leaving activated as true, so lazy traversals know that something has changed
 
     def remove_outbound_edge(self, edge):
@@ -224,6 +252,7 @@ class NodeTerminal():
             if self.get_edge() is not None and self._edge._id == edge._id:
                 self._edge = None
                 self._to_node = None
+                self.version += 1
                 #leaving activated as true, so lazy traversals know that something has changed
 
     def render(self, render_terminals=False, *args, **kwargs):
@@ -241,16 +270,16 @@ class NodeTerminal():
             return ret_val
 
     def save(self, *args, **kwargs):
-        if not self._insave:
-            self._insave = True
-            #print "SAVE!!! "+str(self._edge)+" : "+self.name+" : "+str(self.node.__class__)
-
-            if self.activated and self._edge:
-                if self._to_node:
-                    self._to_node.save(*args, **kwargs)
-                self._edge.save(*args, **kwargs)
+        for node in self.to_save():
+            node.save(*args, **kwargs)
 
-            self._insave = False
+    def to_save(self):
+        ''' the nodes and edges a save visits from here '''
+        if self.activated and self._edge:
+            if self._to_node:
+                return [self._to_node, self._edge]
+            return [self._edge]
+        return []
 
     def set(self, value):
         assert self.direction == OUTBOUND, \
@@ -269,6 +298,7 @@ class NodeTerminal():
             self._edge.remove()
             self._edge = None
             self._to_node = None
+        self.version += 1
 
         if value is not None:
             if value.COLLECTION_NAME != self.to_node_class.COLLECTION_NAME:
@@ -287,7 +317,10 @@ class NodeTerminal():
 
 class ListOfNodesTerminal():
 
-    def __init__(self, to_node_class, direction, origin_node, name, inbound_name = None, render=False, **kwargs): 
+    #PAGE_SIZE, how many nodes iterating over a list that hasn't been loaded pulls at a time, override per terminal with page_size
+    PAGE_SIZE = 100
+
+    def __init__(self, to_node_class, direction, origin_node, name, inbound_name = None, render=False, page_size=None, counted=False, **kwargs): 
         self.activated = False
         self.name = inbound_name if inbound_name is not None else name
         self.original_name = name
@@ -296,14 +329,21 @@ class ListOfNodesTerminal():
         self.terminaltype = TerminalType.LIST_OF_NODES
         self.direction = direction
         self._render = render
-        self._insave = False
+        self.page_size = page_size or self.PAGE_SIZE
+        self.counter = _counter_field(name, counted) #the field on the node that keeps count, if there is one
         self._temp_yup_reference = [] #wanted to make appending o(1), so need to save a reference to the node so the whiskey weak reference cache doesn't drop it
 
         if self.direction == INBOUND and inbound_name == None:
             raise InvalidTerminalException('inbound_name cannot be none when direction is INBOUND')
 
         self._list = None
+        self._list_keys = None #parallel to _list, edge _ids newest first, or ascending sort_key(node) if sort() was given a key
+        self._sort_key = None
         self._edges = None
+        self._count = None
+        self.version = 0 #bumped whenever an edge is added or removed, traversals use it to know their memo is stale
+        self._order = None #_ids of the nodes we're connected to, newest edge first
+        self._order_keys = None #parallel to _order, edge _ids
         self._initialized = False
         global IDID
         self._idid = IDID
@@ -319,16 +359,27 @@ class ListOfNodesTerminal():
         return len(self.get_edges())
 
     def __getitem__(self, i): 
-        #if self.activated:
-        self.get()
+        if self._list is None:
+            #only load the nodes we were asked for, and only the edges up to them if we don't have them yet
+            if isinstance(i, slice):
+                if not self.activated and i.stop is not None and i.stop >= 0 and (i.start is None or i.start >= 0):
+                    return self._nodes(self._first_ids(i.stop)[i])
+                return self._nodes(self._ordered_ids()[i])
+            if not self.activated and i >= 0:
+                return self.to_node_class.from_id(self._first_ids(i + 1)[i])
+            return self.to_node_class.from_id(self._ordered_ids()[i])
         return self._list[i]
 
+    def __iter__(self):
+        if self._list is not None:
+            return iter(self._list[:])
+        return (node for page in self.iter_pages() for node in page)
 
     def __delitem__(self, i): 
         raise NotImplementedError()
 
-    #def __contains__(self, node):
-    #    return node._id in self.get_edges()
+    def __contains__(self, node):
+        return node._id in self.get_edges()
 
     def _add_node(self, to_node):
         assert self.direction != INBOUND, \
@@ -337,11 +388,12 @@ class ListOfNodesTerminal():
         assert to_node.COLLECTION_NAME == self.to_node_class.COLLECTION_NAME, \
             'Terminal [%s] on [%s] takes [%s] not [%s]' % (self.name, self.node.__class__, self.to_node_class, to_node.__class__)
         if not to_node._id in self.get_edges():
-            self._edges[to_node._id] = Edge.from_nodes(self.node, to_node, self.name, self.terminaltype)
-            to_node.add_inbound_edge(self.name, self._edges[to_node._id])
+            self._invalidate()
+            edge = self._edges[to_node._id] = Edge.from_nodes(self.node, to_node, self.name, self.terminaltype)
+            self._order_add(to_node._id, edge)
+            to_node.add_inbound_edge(self.name, edge)
             if self._list is not None:
-                self._list.append(to_node)
-                self.sort()
+                self._list_add(to_node, edge)
             else:
                 self._temp_yup_reference.append(to_node)
 
@@ -349,16 +401,27 @@ class ListOfNodesTerminal():
         assert self.direction != INBOUND, \
             'Terminal [%s] on [%s] is an inbound node, you can\'t remove connections from an inbound node' % (self.name, self.node.__class__)
         if to_node._id in self.get_edges():
-            self.get()
-            edge = self._edges[to_node._id]
-            if edge.inboundId == to_node._id:
-                to_node.remove_inbound_edge(self.name, edge)
-            else:
-                to_node.remove_outbound_edge(self.name, edge)
-            edge.remove()
-            del self._edges[to_node._id]
-            self._list.remove(to_node)
-            self.sort()
+            self._remove_edges([to_node._id])
+
+    def _remove_edges(self, ids):
+        ''' removes the edges to the nodes with these _ids, telling the other ends that are in RAM, 
+            and deletes them from the db in one write '''
+        edges = []
+        for _id in ids:
+            edge = self._edges[_id]
+            to_node = whiskeycache.RAM.get(_id) #if it isn't in RAM, none of its terminals are loaded
+            if to_node is not None:
+                if edge.inboundId == _id:
+                    to_node.remove_inbound_edge(self.name, edge)
+                else:
+                    to_node.remove_outbound_edge(self.name, edge)
+            edges.append(edge)
+        self._invalidate()
+        if len(edges) == 1:
+            self._forget(ids[0])
+        else:
+            self._forget_many(ids)
+        Edge.remove_many(edges, self.name)
 
 
     def add_inbound_edge(self, edge):
@@ -367,10 +430,11 @@ class ListOfNodesTerminal():
         #traverse all nodes and make the proper saves
         #self.get()
         if edge.outboundId not in self.get_edges():
+            self._invalidate()
             self._edges[edge.outboundId] = edge
+            self._order_add(edge.outboundId, edge)
             if self._list is not None:
-                self._list.append(self.to_node_class.from_id(edge.outboundId))
-                self.sort()
+                self._list_add(self.to_node_class.from_id(edge.outboundId), edge)
 
     def add_outbound_edge(self, edge):
         pass #don't think we need to do anything here
@@ -379,8 +443,15 @@ class ListOfNodesTerminal():
         self._add_node(node)
 
     def count(self):
-        ''' counts all items in db and in local cache '''
-        return Edge.find(self.edge_query()).count()
+        ''' counts all items in db and in local cache, remembered until an edge is added or removed '''
+        if self._count is None:
+            if self.activated:
+                self._count = len(self._edges)
+            elif self.counter is not None:
+                self._count = self.node.get_field(self.counter) or 0 #nothing unsaved can be in here until it's activated
+            else:
+                count_terminals([self.node], self.original_name)
+        return self._count
 
     def delete(self):
         self.set([])
@@ -409,43 +480,194 @@ class ListOfNodesTerminal():
     def exists(self):
         return len(self.get_edges()) > 0
 
+    def connected(self, node, max_depth=None):
+        from whiskeynode import graph
+        return graph.connected(self, node, max_depth)
+
+    def k_hop(self, k):
+        ''' _ids k hops or less away along this terminal, one list per hop, see whiskeynode.graph '''
+        from whiskeynode import graph
+        return graph.k_hop(self, k)
+
+    def shortest_path(self, node, max_depth=None):
+        ''' _ids from this terminal's node to node along this terminal, or None, see whiskeynode.graph '''
+        from whiskeynode import graph
+        return graph.shortest_path(self, node, max_depth)
+
     def extend(self, nodes):
+        ''' adds the nodes that aren't already in the list, in one pass. the edges are written with 
+            one insert when the list is saved, like everything else in a session '''
+        assert self.direction != INBOUND, \
+            '(wrong direction) Terminal [INBOUND:%s] on [%s] is an inbound node, you can\'t add connections to an inbound node' % (self.name, self.node.__class__)
+        edges = self.get_edges()
+        added = []
         for node in nodes:
-            self._add_node(node)
+            assert node.COLLECTION_NAME == self.to_node_class.COLLECTION_NAME, \
+                'Terminal [%s] on [%s] takes [%s] not [%s]' % (self.name, self.node.__class__, self.to_node_class, node.__class__)
+            if node._id not in edges:
+                edge = edges[node._id] = Edge.from_nodes(self.node, node, self.name, self.terminaltype)
+                node.add_inbound_edge(self.name, edge)
+                added.append((node, edge))
+        if len(added) == 0:
+            return
+        self._invalidate()
+        self._order = None #sorted again the next time it's needed, cheaper than inserting one at a time
+        if self._list is not None:
+            self._list.extend(node for node, edge in added)
+            self.sort(self._sort_key)
+        else:
+            self._temp_yup_reference.extend(node for node, edge in added)
 
     def get_self(self):
         return self
 
-    def get(self):
+    def get(self, prefetch=None):
+        ''' loads the list. prefetch names terminals to load on all of its nodes at once, see prefetch_terminals '''
         if self._list is None:
             self.get_edges()
             self._list = self.to_node_class.from_ids(self._edges.keys())
-            self.sort()
+            self.sort(self._sort_key)
+        if prefetch:
+            prefetch_terminals(self._list, prefetch)
 
     def get_edge(self, node):
+        ''' the full Edge, loading it if we only had its ids '''
         #todo run edge_query with to_node
-        return self.get_edges()[node._id]
+        self.get_edges()
+        return self._promote(node._id)
             
     def get_edges(self):
+        ''' {to node _id:edge}, edges that weren't already in RAM are EdgeRefs until they're promoted '''
         if self.activated == False:
-            assert self._edges is None, '_edges should be None'
-
-            self._edges = {}
-            self.activated = True
-
+            inbound = outbound = ()
             if self.direction == INBOUND or self.direction == BIDIRECTIONAL:
-                for edge in Edge.find(self.edge_query(INBOUND), limit=200): #hack here, if there is an edge filter, skip the cache
-                    self._edges[edge.outboundId] = edge
-
+                inbound = Edge.find_refs(self.edge_query(INBOUND))
             if self.direction == OUTBOUND or self.direction == BIDIRECTIONAL:
-                for edge in Edge.find(self.edge_query(OUTBOUND), limit=200): #hack here, if there is an edge filter, skip the cache
-                    self._edges[edge.inboundId] = edge
-                    #if self.check_errors
-                    assert edge.inboundCollection == self.to_node_class.COLLECTION_NAME, \
-                        'On node named [%s] on class [%s] data: %s' % (self.name, self.node.__class__, str(edge.to_dict()))
-
+                outbound = Edge.find_refs(self.edge_query(OUTBOUND))
+            self._activate(inbound, outbound)
         return self._edges
 
+    def _activate(self, inbound, outbound):
+        ''' fills _edges with edges that were already found, inbound edges point at us, outbound edges come from us '''
+        assert self._edges is None, '_edges should be None'
+        self._edges = {}
+        self.activated = True
+        for edge in inbound:
+            self._edges[edge.outboundId] = edge
+        for edge in outbound:
+            self._edges[edge.inboundId] = edge
+            #if self.check_errors
+            assert edge.inboundCollection == self.to_node_class.COLLECTION_NAME, \
+                'On node named [%s] on class [%s] edge: %s' % (self.name, self.node.__class__, edge)
+
+    def _invalidate(self):
+        ''' an edge was added or removed '''
+        self._count = None
+        self.version += 1
+
+    def _ordered_ids(self):
+        ''' _ids of the nodes we're connected to, newest edge first. sorted once, then kept in order as edges come and go '''
+        if self._order is None:
+            edges = sorted(self.get_edges().items(), key=lambda x: x[1]._id, reverse=True)
+            self._order = [k for k, v in edges]
+            self._order_keys = [v._id for k, v in edges]
+        return self._order
+
+    def _order_add(self, _id, edge):
+        if self._order is not None:
+            i = _bisect_desc(self._order_keys, edge._id)
+            self._order_keys.insert(i, edge._id)
+            self._order.insert(i, _id)
+
+    def _forget_many(self, ids):
+        ''' _forget for a lot of _ids, one pass over the order and the list '''
+        ids = set(ids)
+        for _id in ids:
+            del self._edges[_id]
+        if self._order is not None:
+            kept = [i for i, _id in enumerate(self._order) if _id not in ids]
+            self._order = [self._order[i] for i in kept]
+            self._order_keys = [self._order_keys[i] for i in kept]
+        if self._list is not None:
+            kept = [i for i, node in enumerate(self._list) if node._id not in ids]
+            self._list = [self._list[i] for i in kept]
+            self._list_keys = [self._list_keys[i] for i in kept]
+
+    def _list_add(self, node, edge):
+        if node is not None:
+            key = edge._id if self._sort_key is None else self._sort_key(node)
+            i = _bisect_desc(self._list_keys, key) if self._sort_key is None else bisect_right(self._list_keys, key)
+            self._list_keys.insert(i, key)
+            self._list.insert(i, node)
+
+    def _forget(self, _id):
+        ''' drops the node with _id and its edge from the edges, the order and the list '''
+        edge = self._edges.pop(_id)
+        if self._order is not None:
+            i = _bisect_desc(self._order_keys, edge._id)
+            _remove_at(self._order, self._order_keys, i, lambda j: self._order[j] == _id)
+        if self._list is not None:
+            if self._sort_key is None:
+                i = _bisect_desc(self._list_keys, edge._id)
+            else:
+                node = whiskeycache.RAM.get(_id) #anything in _list is in RAM
+                i = bisect_left(self._list_keys, self._sort_key(node)) if node is not None else 0
+            _remove_at(self._list, self._list_keys, i, lambda j: self._list[j]._id == _id)
+
+    def _nodes(self, ids):
+        ''' the nodes for ids in the same order, skipping any that don't exist '''
+        nodes = dict((x._id, x) for x in self.to_node_class.from_ids(ids))
+        return [nodes[x] for x in ids if x in nodes]
+
+    def _to_id(self, edge):
+        if self.direction == INBOUND or (self.direction == BIDIRECTIONAL and edge.outboundId != self.node._id):
+            return edge.outboundId
+        return edge.inboundId
+
+    def iter_pages(self, page_size=None):
+        ''' yields lists of up to page_size nodes, newest edge first. if the list hasn't been loaded 
+            only one page of edges and nodes is held at a time '''
+        page_size = page_size or self.page_size
+        if self._list is not None:
+            nodes = self._list[:]
+            for i in xrange(0, len(nodes), page_size):
+                yield nodes[i:i + page_size]
+        elif self.activated:
+            ids = self._ordered_ids()[:]
+            for i in xrange(0, len(ids), page_size):
+                yield self._nodes(ids[i:i + page_size])
+        else:
+            before = None
+            while True:
+                edges = self._page_refs(page_size, before)
+                if len(edges) == 0:
+                    return
+                yield self._nodes([self._to_id(x) for x in edges])
+                if len(edges) < page_size:
+                    return
+                before = edges[-1]._id
+
+    def _page_refs(self, limit, before=None):
+        ''' up to limit edges, newest first, older than before if it's given. straight from find_refs, nothing is kept '''
+        directions = [INBOUND, OUTBOUND] if self.direction == BIDIRECTIONAL else [self.direction]
+        edges = []
+        for direction in directions:
+            edges.extend(Edge.find_refs(self.edge_query(direction), limit=limit, before=before))
+        edges.sort(key=lambda x: x._id, reverse=True)
+        return edges[:limit]
+
+    def _first_ids(self, n):
+        ''' _ids of the first n nodes, newest edge first, for indexing a list whose edges haven't been loaded '''
+        if n == 0:
+            return []
+        return [self._to_id(x) for x in self._page_refs(n)]
+
+    def _promote(self, _id):
+        edge = self._edges[_id]
+        if type(edge) is EdgeRef:
+            edge = self._edges[_id] = edge.promote()
+        return edge
+
     def insert(self, i, node):
         raise NotImplementedError()
 
@@ -458,25 +680,33 @@ class ListOfNodesTerminal():
     def remove(self, node):
         self._remove_node(node)
 
+    def remove_many(self, nodes):
+        ''' removes all of these nodes that are in the list, with one write to the db '''
+        assert self.direction != INBOUND, \
+            'Terminal [%s] on [%s] is an inbound node, you can\'t remove connections from an inbound node' % (self.name, self.node.__class__)
+        edges = self.get_edges()
+        ids = list(set(node._id for node in nodes if node._id in edges))
+        if ids:
+            self._remove_edges(ids)
+
     def remove_inbound_edge(self, edge):
         assert self.direction != OUTBOUND
+        self._invalidate()
         if self.activated:
             if edge.outboundId in self._edges:
-                if self._list is not None:
-                    self._list.remove(self.to_node_class.from_id(edge.outboundId))
-                del self._edges[edge.outboundId]
-                self.sort()
+                self._forget(edge.outboundId)
 
     def remove_outbound_edge(self, edge):
         ''' called when a node we're connected to is removed '''
+        self._invalidate()
         if self.activated:
             if edge.inboundId in self._edges:
-                del self._edges[edge.inboundId]
-            if self._list != None:
-                self._list.remove(self.to_node_class.from_id(edge.inboundId))
+                self._forget(edge.inboundId)
 
     def render(self, render_terminals=False, *args, **kwargs):
         self.get()
+        if render_terminals:
+            prefetch_terminals(self._list, set(name for x in self._list for name, terminal in x.terminals.items() if terminal._render))
         return[x.render(render_terminals=render_terminals, *args, **kwargs) for x in self._list]
 
     def render_pretty(self, do_print=True, *args, **kwargs):
@@ -487,44 +717,306 @@ class ListOfNodesTerminal():
             return ret_val
 
     def save(self, *args, **kwargs):
-        if not self._insave:
-            self._insave = True
-            if self.activated and len(self._edges) > 0:
-                if self._list:
-                    for node in self._list:
-                        node.save(*args, **kwargs) #saves shouldn't call the db if nothing has changed
-                for edge in self._edges.values():
-                    edge.save(*args, **kwargs) #saves shouldn't call the db if nothing has changed
-            for node in self._temp_yup_reference:
-                node.save()
-            self._temp_yup_reference = []
-            self._insave = False
+        for node in self.to_save():
+            node.save(*args, **kwargs)
+
+    def to_save(self):
+        ''' the nodes and edges a save visits from here, saves shouldn't call the db if nothing has changed '''
+        rv = []
+        if self.activated and len(self._edges) > 0:
+            if self._list is not None:
+                rv.extend(self._list)
+            else:
+                #nodes handed out by indexing or iterating, without loading the list
+                rv.extend(x for x in (whiskeycache.RAM.get(_id) for _id in self._edges) if x is not None)
+            rv.extend(x for x in self._edges.values() if type(x) is not EdgeRef) #refs haven't changed
+        rv.extend(self._temp_yup_reference)
+        self._temp_yup_reference = []
+        return rv
 
 
     def set(self, nodes):
+        ''' makes the list nodes, in that order (nodes[0] is the newest), removing and adding only the difference. 
+            the run of nodes at the end that are already in the list, in the same order, keep their edges. 
+            nodes that were in the list but have to move get new edges, with their edge data carried over '''
         if type(nodes) != list:
             raise InvalidTerminalException('Terminal [%s] on [%s] should not be set to anything other than a list' % (self.name, self.to_node_class))
-        self.get()
-        old_nodes = self._list[:]
-        for node in old_nodes:
-            self._remove_node(node)
-        assert len(self) == 0, 'Why didn\'t we clear our list?'
-        for node in reversed(nodes):
-            self._add_node(node)
+        assert self.direction != INBOUND, \
+            'Terminal [%s] on [%s] is an inbound node, you can\'t remove connections from an inbound node' % (self.name, self.node.__class__)
+        edges = self.get_edges()
+        #the order is by edge _id, newest first, and new edges are always the newest, so only a tail 
+        #of nodes whose edges already get older along it can stay as it is
+        start = len(nodes)
+        last = None
+        for i in xrange(len(nodes) - 1, -1, -1):
+            edge = edges.get(nodes[i]._id)
+            if edge is None or (last is not None and edge._id <= last):
+                break
+            last = edge._id
+            start = i
+        kept = set(node._id for node in nodes[start:])
+        removed = [_id for _id in edges if _id not in kept]
+        moved = self._edge_data(set(node._id for node in nodes[:start]).intersection(removed))
+        if removed:
+            self._remove_edges(removed)
+        self.extend(reversed(nodes[:start]))
+        for _id, data in moved.iteritems():
+            self._edges[_id].data = data
+
+    def _edge_data(self, ids):
+        ''' {to node _id:edge data} for the edges to ids that have any, one query for the ones that are only EdgeRefs '''
+        ids = list(ids)
+        edges = [self._edges[_id] for _id in ids]
+        refs = [x._id for x in edges if type(x) is EdgeRef]
+        loaded = dict((x._id, x) for x in Edge.from_ids(refs)) if refs else {}
+        rv = {}
+        for _id, edge in zip(ids, edges):
+            edge = loaded.get(edge._id, edge)
+            if type(edge) is not EdgeRef and edge.data:
+                rv[_id] = dict(edge.data)
+        return rv
+
 
+    def most_shared(self, limit=10):
+        ''' [(_id, count)] for the other nodes whose terminal of the same kind shares the most nodes with this one, 
+            most first - the users with the most activities in common. counted in the db, one $match/$group per direction '''
+        ids = self.get_edges().keys()
+        if not ids:
+            return []
+        directions = [INBOUND, OUTBOUND] if self.direction == BIDIRECTIONAL else [self.direction]
+        counts = {}
+        for direction in directions:
+            #the edges the nodes we're connected to have of the same kind, from their end
+            reverse = OUTBOUND if direction == INBOUND else INBOUND
+            query, owner, far = _edge_query(reverse, self.name, self.node.COLLECTION_NAME, ids)
+            query[far] = {'$ne':self.node._id}
+            if reverse == OUTBOUND:
+                query['inboundCollection'] = self.node.COLLECTION_NAME
+            for _id, count in Edge.count_by(query, far, limit=limit if len(directions) == 1 else 0):
+                counts[_id] = counts.get(_id, 0) + count
+        rv = sorted(counts.iteritems(), key=itemgetter(1), reverse=True)
+        return rv[:limit] if limit > 0 else rv
+
+    def shared_count(self, node):
+        ''' how many nodes this terminal has in common with node's terminal of the same name. 
+            counted in memory if both are loaded, otherwise in the db, one $match/$group per direction '''
+        other = node.terminals[self.original_name]
+        if self.activated and other.activated:
+            return len(set(self._edges).intersection(other._edges))
+        directions = [INBOUND, OUTBOUND] if self.direction == BIDIRECTIONAL else [self.direction]
+        skip_db = self.node._is_new_local and node._is_new_local
+        counts = {}
+        for direction in directions:
+            query, owner, far = _edge_query(direction, self.name, self.to_node_class.COLLECTION_NAME, [self.node._id, node._id])
+            for _id, count in Edge.count_by(query, far, min_count=2 if len(directions) == 1 else 1, skip_db=skip_db):
+                counts[_id] = counts.get(_id, 0) + count
+        return len([x for x in counts.itervalues() if x >= 2])
 
     def sort(self, key=None):
+        ''' orders the list by key(node), newest edge first if there isn't one. the order is kept as nodes are added and removed '''
+        self._sort_key = key
         if self._list != None:
             if key is None:
-                edges_for_sort = [(k,v) for k,v in self._edges.items()]
-                edges_for_sort.sort(key=lambda x: x[1]._id, reverse=True)
-                _ids = [x[0] for x in edges_for_sort]
-                self._list.sort(key=lambda x: _ids.index(x._id))
+                pairs = sorted(((self._edges[x._id]._id, x) for x in self._list), key=itemgetter(0), reverse=True)
             else:
-                self._list.sort(key=key)
+                pairs = sorted(((key(x), x) for x in self._list), key=itemgetter(0))
+            self._list_keys = [k for k, x in pairs]
+            self._list = [x for k, x in pairs]
         
 
 
+def prefetch_terminals(nodes, names, edges_only=False):
+    ''' loads the terminals called names on every node in nodes together, with one edge query per terminal 
+        (and direction) and one node query per collection they point at, instead of a couple of queries per node.
+        terminals that already have their edges only get their nodes, edges_only skips the nodes '''
+    if isinstance(names, basestring):
+        names = [names]
+    groups = {} #(terminaltype, direction, edge name, to collection):[terminals]
+    for node in nodes:
+        for name in names:
+            terminal = node.terminals.get(name)
+            if terminal is not None:
+                key = (terminal.terminaltype, terminal.direction, terminal.name, terminal.to_node_class.COLLECTION_NAME)
+                groups.setdefault(key, []).append(terminal)
+
+    to_load = {} #to collection:(to_node_class, [_ids])
+    for (terminaltype, direction, name, collection), terminals in groups.items():
+        pending = [terminal for terminal in terminals if not terminal.activated]
+        found = {INBOUND:{}, OUTBOUND:{}} #direction:{owner _id:[edges]}
+        if pending:
+            owners = [terminal.node._id for terminal in pending]
+            for d in ([INBOUND, OUTBOUND] if direction == BIDIRECTIONAL else [direction]):
+                query, owner, far = _edge_query(d, name, collection, owners)
+                #node terminals hang on to their edge, so those get the whole thing
+                edges = Edge.find_refs(query) if terminaltype == TerminalType.LIST_OF_NODES else Edge.find(query)
+                for edge in edges:
+                    found[d].setdefault(getattr(edge, owner), []).append(edge)
+
+        ids = to_load.setdefault(collection, (terminals[0].to_node_class, []))[1]
+        for terminal in terminals:
+            if not terminal.activated:
+                inbound = found[INBOUND].get(terminal.node._id, ())
+                outbound = found[OUTBOUND].get(terminal.node._id, ())
+                if terminaltype == TerminalType.LIST_OF_NODES:
+                    terminal._activate(inbound, outbound)
+                else:
+                    #newest first, like find_one. terminals without an edge know they have none and don't look again
+                    terminal._edge = (inbound or outbound or (None,))[0]
+                    terminal.activated = True
+            if terminaltype == TerminalType.LIST_OF_NODES:
+                if terminal._list is None:
+                    ids.extend(terminal._edges.keys())
+            elif terminal.activated and terminal._edge is not None and terminal._to_node is None:
+                ids.append(terminal._get_to_node_id())
+
+    if edges_only:
+        return
+    loaded = [] #strong references until every terminal has its nodes
+    for to_node_class, ids in to_load.values():
+        if ids:
+            loaded.extend(to_node_class.from_ids(list(set(ids))))
+    for (terminaltype, direction, name, collection), terminals in groups.items():
+        for terminal in terminals:
+            if terminaltype == TerminalType.LIST_OF_NODES:
+                terminal.get()
+            elif terminal.activated and terminal._edge is not None and terminal._to_node is None:
+                terminal._to_node = whiskeycache.RAM.get(terminal._get_to_node_id())
+
+def count_terminals(nodes, name):
+    ''' {node _id:count} for the list terminals called name on nodes, remembered like count() does. loaded terminals 
+        already know, the rest are counted in the db with one $match/$group per terminal kind and direction '''
+    terminals = [x.terminals.get(name) for x in nodes]
+    terminals = [x for x in terminals if x is not None and x.terminaltype == TerminalType.LIST_OF_NODES]
+    groups = {} #(direction, edge name, to collection):[terminals]
+    for terminal in terminals:
+        if terminal._count is None and not terminal.activated and terminal.counter is None:
+            groups.setdefault((terminal.direction, terminal.name, terminal.to_node_class.COLLECTION_NAME), []).append(terminal)
+    for (direction, edge_name, collection), pending in groups.items():
+        owners = [x.node._id for x in pending]
+        skip_db = all(x.node._is_new_local for x in pending) #their edges can't have been saved
+        counts = {}
+        for d in ([INBOUND, OUTBOUND] if direction == BIDIRECTIONAL else [direction]):
+            query, owner, far = _edge_query(d, edge_name, collection, owners)
+            for _id, count in Edge.count_by(query, owner, skip_db=skip_db):
+                counts[_id] = counts.get(_id, 0) + count
+        for terminal in pending:
+            terminal._count = counts.get(terminal.node._id, 0)
+    return dict((x.node._id, x.count()) for x in terminals)
+
+def register_counters(node_class):
+    ''' called once a class has set up its terminals. adds the fields its counted terminals keep their counts in, 
+        and tells edges about them. the classes its terminals point at are set up too, so edges removed from here 
+        can find counters on the other end even if nothing has loaded one of those nodes yet '''
+    for name, definition in node_class.TERMINALS.items():
+        keywords = definition.keywords or {}
+        to_node_class, direction = definition.args[:2]
+        field = _counter_field(name, keywords.get('counted'))
+        if field is not None:
+            if field not in node_class.fields:
+                if node_class.COMPACT:
+                    raise InvalidTerminalParameterException('Terminal [%s] on compact class %s needs [%s] in FIELDS to count in' % (name, node_class, field))
+                node_class.fields[field] = int
+            node_class.DO_NOT_UPDATE_FIELDS.add(field)
+            node_class._schema = NodeSchema(node_class)
+            edge_name = keywords.get('inbound_name') or name
+            ends = {OUTBOUND:['outbound'], INBOUND:['inbound'], BIDIRECTIONAL:['outbound', 'inbound']}[direction]
+            for end in ends:
+                COUNTERS[(node_class.COLLECTION_NAME, end, edge_name, to_node_class.COLLECTION_NAME)] = (node_class, field)
+        to_node_class._ensure_class_terminals()
+
+def repair_counters(node_class, names=None):
+    ''' recounts the counted terminals called names (all of them if it's None) on every node_class in the db from
+        their edges, one $match/$group per terminal and direction. writes only the counts that were wrong, returns 
+        how many that was. for counters that were added to existing data, or drifted '''
+    node_class._ensure_class_terminals()
+    session = WhiskeySession()
+    for name, definition in node_class.TERMINALS.items():
+        field = _counter_field(name, (definition.keywords or {}).get('counted'))
+        if field is None or (names is not None and name not in names):
+            continue
+        to_node_class, direction = definition.args[:2]
+        edge_name = (definition.keywords or {}).get('inbound_name') or name
+        counts = {}
+        for d in ([INBOUND, OUTBOUND] if direction == BIDIRECTIONAL else [direction]):
+            if d == INBOUND:
+                query, owner = {'name':edge_name, 'outboundCollection':to_node_class.COLLECTION_NAME, 'inboundCollection':node_class.COLLECTION_NAME}, 'inboundId'
+            else:
+                query, owner = {'name':edge_name, 'outboundCollection':node_class.COLLECTION_NAME, 'inboundCollection':to_node_class.COLLECTION_NAME}, 'outboundId'
+            for _id, count in Edge.count_by(query, owner, skip_cache=True):
+                counts[_id] = counts.get(_id, 0) + count
+        for doc in node_class.COLLECTION.find({}, fields=[field]):
+            count = counts.get(doc['_id'], 0)
+            if doc.get(field) != count:
+                session.update(node_class.COLLECTION, {'_id':doc['_id']}, {'$set':{field:count}})
+                node = whiskeycache.RAM.get(doc['_id'])
+                if node is not None:
+                    node._set_counter(field, count)
+                    terminal = node.terminals[name]
+                    if not terminal.activated:
+                        terminal._count = None
+    fixed = len(session)
+    session.flush()
+    return fixed
+
+def _counter_field(name, counted):
+    ''' counted=True keeps the count in <name>Count, or give it a field name '''
+    if not counted:
+        return None
+    return counted if isinstance(counted, basestring) else '%sCount' % name
+
+def neighbour_ids(nodes, name):
+    ''' the distinct _ids the terminals called name on nodes lead to, without loading the nodes. loaded list terminals 
+        answer from memory, the rest are grouped by _id in the db, one $match/$group per terminal kind and direction.
+        node terminals find their edge like prefetch_terminals(edges_only=True) does '''
+    terminals = [x.terminals.get(name) for x in nodes]
+    terminals = [x for x in terminals if x is not None]
+    prefetch_terminals([x.node for x in terminals if x.terminaltype == TerminalType.NODE], name, edges_only=True)
+    rv = set()
+    groups = {} #(direction, edge name, to collection):[terminals]
+    for terminal in terminals:
+        if terminal.terminaltype == TerminalType.NODE:
+            if terminal._edge is not None:
+                rv.add(terminal._get_to_node_id())
+        elif terminal.activated:
+            rv.update(terminal._edges)
+        else:
+            groups.setdefault((terminal.direction, terminal.name, terminal.to_node_class.COLLECTION_NAME), []).append(terminal)
+    for (direction, edge_name, collection), pending in groups.items():
+        owners = [x.node._id for x in pending]
+        skip_db = all(x.node._is_new_local for x in pending)
+        for d in ([INBOUND, OUTBOUND] if direction == BIDIRECTIONAL else [direction]):
+            query, owner, far = _edge_query(d, edge_name, collection, owners)
+            rv.update(_id for _id, count in Edge.count_by(query, far, skip_db=skip_db))
+    return list(rv)
+
+def _edge_query(direction, name, collection, owners):
+    ''' (query, owner field, far end field) for the edges of one kind of terminal on all the nodes in owners '''
+    if direction == INBOUND:
+        return {'inboundId':{'$in':owners}, 'outboundCollection':collection, 'name':name}, 'inboundId', 'outboundId'
+    else:
+        return {'outboundId':{'$in':owners}, 'name':name}, 'outboundId', 'inboundId'
+
+def _bisect_desc(keys, key):
+    ''' bisect_left for keys sorted in descending order '''
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] > key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _remove_at(items, keys, i, match):
+    ''' removes the item where match(index) is true from items and keys, looking at i first. 
+        only scans if the keys tie or a custom sort key's value changed since the item was added '''
+    for j in chain(xrange(i, len(items)), xrange(0, min(i, len(items)))):
+        if match(j):
+            del items[j]
+            del keys[j]
+            return
+
+
 class AttributedListOfNodesTerminal(ListOfNodesTerminal):
     def __init__(self, *args, **kwargs):
         ListOfNodesTerminal.__init__(self, *args, **kwargs)
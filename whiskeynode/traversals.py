@@ -1,6 +1,8 @@
 
+from collections import OrderedDict
 from functools import partial
 from whiskeynode.terminaltypes import TerminalType
+import weakref
 
 
 def lazy_traversal(path, render=True, default_value=None, default_attr=None):
@@ -19,17 +21,33 @@ class LazyTraversal():
         self.default_attr = default_attr
 
         if len(self.path_parts) < 2:
-            assert 0, 'Lazy traversals should be declared as <terminal_name>.<field_value>'
-        if len(self.path_parts) > 2:
-            assert 0, 'Support for more than one traversal hasn\'t been developed, why don\'t you give it a shot?'
+            assert 0, 'Lazy traversals should be declared as <terminal_name>[.<terminal_name>...].<field_value>'
 
         self.terminal_name = self.path_parts[0]
-        self.field_name = self.path_parts[1]
+        self.field_name = self.path_parts[-1]
+        self.hops = self.path_parts[:-1]
+        self._memo = None #([(weak ref to terminal, version)], weak refs to the nodes or _ids at the end of the path, whether they're _ids)
 
     def get(self): 
+        if self.field_name == 'count' and len(self.hops) == 1 and getattr(self.node.terminals[self.terminal_name], 'counter', None):
+            return self.node.terminals[self.terminal_name].count() #kept on the node, no queries
+
         if self.node.terminals[self.terminal_name].activated:
 
-            if self.field_name == 'exists':
+            if len(self.hops) > 1:
+                found = self._walk()
+                if self.field_name == 'count':
+                    return len(found)
+                elif self.field_name == 'exists':
+                    return len(found) > 0
+                elif len(found) > 0:
+                    return getattr(found[0], self.field_name)
+                #the path ends nowhere, the first hop's nodes don't have what we're after
+                if self.default_attr is not None:
+                    return getattr(self.node, self.default_attr, self.default_value)
+                return self.default_value
+
+            elif self.field_name == 'exists':
                 return self.node.terminals[self.terminal_name].exists()
 
             #LISTS
@@ -54,6 +72,57 @@ class LazyTraversal():
         else:
             return self.node.__dict__.get(self.name, self.default_value)
 
+    def _walk(self):
+        ''' follows the path one hop at a time, loading each hop for every node on it together. remembers where 
+            it ended up until one of the terminals it went through changes. count and exists only need _ids 
+            at the end, everything else gets nodes '''
+        if self._memo is not None:
+            found = self._remembered()
+            if found is not None:
+                return found
+        from whiskeynode.terminals import neighbour_ids, prefetch_terminals
+        seen = []
+        frontier = [self.node]
+        for i, hop in enumerate(self.hops):
+            if i == len(self.hops) - 1 and self.field_name in ('count', 'exists'):
+                #the db groups the last hop's edges by where they lead, they're never loaded
+                seen.extend((x, x.version) for x in (node.terminals.get(hop) for node in frontier) if x is not None)
+                frontier = neighbour_ids(frontier, hop)
+                break
+            prefetch_terminals(frontier, hop)
+            found = OrderedDict()
+            for node in frontier:
+                terminal = node.terminals.get(hop)
+                if terminal is None:
+                    continue
+                seen.append((terminal, terminal.version))
+                if terminal.terminaltype == TerminalType.LIST_OF_NODES:
+                    found.update((x._id, x) for x in terminal._list)
+                elif terminal._edge is not None:
+                    _id = terminal._get_to_node_id()
+                    to_node = terminal._to_node or terminal.to_node_class.from_id(_id)
+                    if to_node is not None:
+                        found[_id] = to_node
+            frontier = found.values()
+        ids = i == len(self.hops) - 1 and self.field_name in ('count', 'exists')
+        self._memo = ([(weakref.ref(x), version) for x, version in seen], frontier if ids else [weakref.ref(x) for x in frontier], ids)
+        return frontier
+
+    def _remembered(self):
+        ''' what the last walk found, if none of the terminals it went through changed. the memo only holds weak 
+            references, so it doesn't keep nodes along the path in RAM, and it's forgotten if any of them went away '''
+        seen, found, ids = self._memo
+        for ref, version in seen:
+            terminal = ref()
+            if terminal is None or terminal.version != version:
+                return None
+        if ids:
+            return found
+        nodes = [ref() for ref in found]
+        if any(x is None for x in nodes):
+            return None
+        return nodes
+
     def set(self, value):
         assert 0, 'Traversals don\'t support set... yet'
 
@@ -1,8 +1,7 @@
-from bson.objectid import ObjectId
-from operator import attrgetter
+from bisect import bisect_left, bisect_right
 from threading import Lock
-from whiskeynode.exceptions import WhiskeyCacheException
-import itertools
+from whiskeynode.fieldtypes import peek
+from whiskeynode.queries import bson_order, compile_query, sort_keys
 import weakref
 
 '''
@@ -17,14 +16,20 @@ weakref.WeakSet.__len__ = weak_ref_len
 
 RAM = weakref.WeakValueDictionary()
 RAM_ALL = {} #'collectionName':weakSet
+INDEXES = {} #'collectionName':{'field':{value:weakSet}}, built from CACHE_INDEXES
+SORTED_INDEXES = {} #'collectionName':{'field':SortedIndex}, built from CACHE_SORTED_INDEXES
+COMPOUND_INDEXES = {} #'collectionName':{(fields):{value:{value:...weakSet}}}, built from CACHE_COMPOUND_INDEXES, one level per field
+RESIDENT = {} #'collectionName':set, strong references to every node in collections that are entirely in RAM
 
 lock = Lock()
 
-def from_cache(cls, data, dirty=True):
+def from_cache(cls, data, dirty=True, projection=None):
     try:
         return RAM[data['_id']]
     except KeyError:
-        return cls(init_with=data, dirty=dirty)
+        if projection is None:
+            return cls(init_with=data, dirty=dirty)
+        return cls(init_with=data, dirty=dirty, projection=projection)
 
 def clear_cache():
     ''' for testing '''
@@ -39,6 +44,10 @@ def clear_cache():
                 del RAM_ALL[key]
             except KeyError:
                 pass
+        INDEXES.clear()
+        SORTED_INDEXES.clear()
+        COMPOUND_INDEXES.clear()
+        RESIDENT.clear()
     
 def remove(node):
     with lock:
@@ -48,6 +57,14 @@ def remove(node):
                 RAM_ALL[node.COLLECTION_NAME].remove(node)
             except KeyError:
                 pass
+            for field in node.CACHE_INDEXES:
+                _index_discard(node, field, peek(node, field))
+            for field in node.CACHE_SORTED_INDEXES:
+                SORTED_INDEXES[node.COLLECTION_NAME][field].discard(node._id)
+            for fields in node.CACHE_COMPOUND_INDEXES:
+                _compound_discard(node, fields, tuple(peek(node, x) for x in fields))
+            if node.COLLECTION_NAME in RESIDENT:
+                RESIDENT[node.COLLECTION_NAME].discard(node)
         except:
             pass
 
@@ -59,6 +76,323 @@ def save(node):
             RAM_ALL[node.COLLECTION_NAME].add(node)
         except: #KeyError
             RAM_ALL[node.COLLECTION_NAME] = weakref.WeakSet([node])
+        for field in node.CACHE_INDEXES:
+            _index_add(node, field, peek(node, field))
+        for field in node.CACHE_SORTED_INDEXES:
+            _sorted_index(node.COLLECTION_NAME, field).add(node, peek(node, field))
+        for fields in node.CACHE_COMPOUND_INDEXES:
+            _compound_add(node, fields, tuple(peek(node, x) for x in fields))
+        if node.COLLECTION_NAME in RESIDENT:
+            RESIDENT[node.COLLECTION_NAME].add(node)
+
+def make_resident(collection_name):
+    ''' from now on every node in the collection is held in RAM, call before loading the collection '''
+    with lock:
+        if collection_name not in RESIDENT:
+            RESIDENT[collection_name] = set(RAM_ALL.get(collection_name, []))
+
+def release_resident(collection_name):
+    with lock:
+        RESIDENT.pop(collection_name, None)
+
+def is_resident(collection_name):
+    return collection_name in RESIDENT
+
+def index_field(node, field, value):
+    ''' call before changing a CACHE_INDEXES, CACHE_SORTED_INDEXES or CACHE_COMPOUND_INDEXES field on a node, moves the node to the new value '''
+    with lock:
+        if RAM.get(peek(node, '_id')) is not node:
+            return #not in the cache yet, save() will index it
+        if field in node.CACHE_INDEXES:
+            _index_discard(node, field, peek(node, field))
+            _index_add(node, field, value)
+        if field in node.CACHE_SORTED_INDEXES:
+            index = _sorted_index(node.COLLECTION_NAME, field)
+            index.discard(node._id)
+            index.add(node, value)
+        for fields in node.CACHE_COMPOUND_INDEXES:
+            if field in fields:
+                _compound_discard(node, fields, tuple(peek(node, x) for x in fields))
+                _compound_add(node, fields, tuple(value if x == field else peek(node, x) for x in fields))
+
+#key for the nodes an index holds whose value can't be hashed, lists and sub documents. mongo matches arrays 
+#element by element, so they aren't keyed, and the index isn't used while it has any
+_UNKEYED = object()
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def _index_add(node, field, value):
+    ''' expects the lock to be held '''
+    try:
+        index = INDEXES[node.COLLECTION_NAME]
+    except KeyError:
+        index = INDEXES[node.COLLECTION_NAME] = {}
+    index = index.setdefault(field, {})
+    if not _hashable(value):
+        value = _UNKEYED
+    try:
+        index[value].add(node)
+    except KeyError:
+        index[value] = weakref.WeakSet([node])
+
+def _index_discard(node, field, value):
+    ''' expects the lock to be held '''
+    if not _hashable(value):
+        value = _UNKEYED
+    try:
+        bucket = INDEXES[node.COLLECTION_NAME][field][value]
+    except KeyError:
+        return
+    bucket.discard(node)
+    if len(bucket) == 0:
+        del INDEXES[node.COLLECTION_NAME][field][value]
+
+def _compound_add(node, fields, values):
+    ''' expects the lock to be held '''
+    try:
+        index = COMPOUND_INDEXES[node.COLLECTION_NAME]
+    except KeyError:
+        index = COMPOUND_INDEXES[node.COLLECTION_NAME] = {}
+    level = index.setdefault(fields, {})
+    if not all(_hashable(x) for x in values):
+        values = (_UNKEYED,) #kept at the top, the whole index is skipped while it has any
+    for value in values[:-1]:
+        level = level.setdefault(value, {})
+    try:
+        level[values[-1]].add(node)
+    except KeyError:
+        level[values[-1]] = weakref.WeakSet([node])
+
+def _compound_discard(node, fields, values):
+    ''' expects the lock to be held '''
+    if not all(_hashable(x) for x in values):
+        values = (_UNKEYED,)
+    try:
+        levels = [COMPOUND_INDEXES[node.COLLECTION_NAME][fields]]
+        for value in values[:-1]:
+            levels.append(levels[-1][value])
+        bucket = levels[-1][values[-1]]
+    except KeyError:
+        return
+    bucket.discard(node)
+    if len(bucket) == 0:
+        #prune the levels that are empty now
+        for level, value in reversed(zip(levels, values)):
+            if len(level[value]) != 0:
+                break
+            del level[value]
+
+def _lookup_values(value):
+    ''' the values an index has to look up to answer value in a query, or None if an index can't '''
+    if type(value) is dict:
+        if len(value) != 1 or '$in' not in value:
+            return None
+        return value['$in']
+    elif type(value) is list:
+        return None
+    return (value,)
+
+def _compound_leaves(level, values, depth):
+    ''' every node under level whose values match, values runs out before the leaves for prefix lookups '''
+    if depth == len(values):
+        if isinstance(level, weakref.WeakSet):
+            return set(level)
+        rv = set()
+        for child in level.values():
+            rv.update(_compound_leaves(child, values, depth))
+        return rv
+    rv = set()
+    for value in values[depth]:
+        if value in level:
+            rv.update(_compound_leaves(level[value], values, depth + 1))
+    return rv
+
+def _from_indexes(cls, query):
+    ''' returns the set of nodes that could match the query according to CACHE_INDEXES and CACHE_COMPOUND_INDEXES,
+        or None if no index can answer any part of the query. an $or is answered if every part of it can be '''
+    if len(query) == 1 and '$or' in query:
+        rv = set()
+        for part in query['$or']:
+            candidates = _from_indexes(cls, part)
+            if candidates is None:
+                return None
+            rv.update(candidates)
+        return rv
+    rv = None
+    if cls.CACHE_INDEXES and cls.COLLECTION_NAME in INDEXES:
+        indexes = INDEXES[cls.COLLECTION_NAME]
+        for key, value in query.items():
+            if key not in cls.CACHE_INDEXES:
+                continue
+            values = _lookup_values(value)
+            if values is None:
+                continue
+            index = indexes.get(key, {})
+            candidates = set()
+            try:
+                with lock:
+                    if index.get(_UNKEYED):
+                        continue
+                    for v in values:
+                        if v in index:
+                            candidates.update(index[v])
+            except TypeError:
+                continue
+            if rv is None or len(candidates) < len(rv):
+                rv = candidates
+            if len(rv) == 0:
+                return rv
+    if cls.CACHE_COMPOUND_INDEXES and cls.COLLECTION_NAME in COMPOUND_INDEXES:
+        indexes = COMPOUND_INDEXES[cls.COLLECTION_NAME]
+        for fields in cls.CACHE_COMPOUND_INDEXES:
+            values = [] #for as many of the fields, from the first, as the query can be looked up on
+            for field in fields:
+                v = _lookup_values(query[field]) if field in query else None
+                if v is None:
+                    break
+                values.append(v)
+            if not values:
+                continue
+            try:
+                with lock:
+                    if indexes.get(fields, {}).get(_UNKEYED):
+                        continue
+                    candidates = _compound_leaves(indexes.get(fields, {}), values, 0)
+            except TypeError:
+                continue
+            if rv is None or len(candidates) < len(rv):
+                rv = candidates
+            if len(rv) == 0:
+                return rv
+    return rv
+
+class SortedIndex(object):
+    ''' (type, value) keys for one field of every node in a collection, kept sorted so range 
+        queries can bisect instead of scan. nodes are weakly referenced like everything else in here.
+        mongo matches and sorts arrays element by element, so nodes holding a list aren't keyed,
+        and the index isn't used while any are in it '''
+    def __init__(self):
+        self.keys = []      #sorted [(bson order, value)]
+        self.ids = []       #_ids, parallel to keys
+        self.refs = {}      #_id:(key, weakref), key is None for lists
+        self.lists = set()  #_ids of nodes holding a list
+        self.pending = []   #_ids of garbage collected nodes, removed the next time we're touched
+
+    def add(self, node, value):
+        self.purge()
+        ref = weakref.ref(node, lambda ref, _id=node._id, pending=self.pending: pending.append(_id))
+        if isinstance(value, (list, tuple)):
+            self.lists.add(node._id)
+            self.refs[node._id] = (None, ref)
+            return
+        key = (bson_order(value), value)
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.ids.insert(i, node._id)
+        self.refs[node._id] = (key, ref)
+
+    def discard(self, _id):
+        try:
+            key, ref = self.refs.pop(_id)
+        except KeyError:
+            return
+        if key is None:
+            self.lists.discard(_id)
+            return
+        i = bisect_left(self.keys, key)
+        j = bisect_right(self.keys, key)
+        i = self.ids.index(_id, i, j)
+        del self.keys[i]
+        del self.ids[i]
+
+    def purge(self):
+        while self.pending:
+            _id = self.pending.pop()
+            if _id in self.refs and self.refs[_id][1]() is None:
+                self.discard(_id)
+
+    def has_lists(self):
+        self.purge()
+        return len(self.lists) > 0
+
+    def range(self, lower=None, lower_inclusive=True, upper=None, upper_inclusive=True):
+        ''' returns live nodes with lower <(=) value <(=) upper, in ascending order. at least one bound is required,
+            and both bounds have to be the same type, since mongo won't match across types '''
+        self.purge()
+        order = bson_order(lower if lower is not None else upper)
+        if lower is not None and upper is not None and bson_order(upper) != order:
+            return []
+        if lower is None:
+            i = bisect_left(self.keys, (order,))
+        elif lower_inclusive:
+            i = bisect_left(self.keys, (order, lower))
+        else:
+            i = bisect_right(self.keys, (order, lower))
+        if upper is None:
+            j = bisect_left(self.keys, (order + 1,))
+        elif upper_inclusive:
+            j = bisect_right(self.keys, (order, upper))
+        else:
+            j = bisect_left(self.keys, (order, upper))
+        rv = []
+        for _id in self.ids[i:j]:
+            x = self.refs[_id][1]()
+            if x is not None:
+                rv.append(x)
+        return rv
+
+def _sorted_index(collection_name, field):
+    ''' expects the lock to be held '''
+    try:
+        return SORTED_INDEXES[collection_name][field]
+    except KeyError:
+        return SORTED_INDEXES.setdefault(collection_name, {}).setdefault(field, SortedIndex())
+
+_RANGE_OPERATORS = set(['$gt', '$gte', '$lt', '$lte'])
+
+def _from_sorted_indexes(cls, query, sort):
+    ''' returns (nodes, field, exact) where nodes could match the query according to CACHE_SORTED_INDEXES and are 
+        sorted ascending by field, or (None, None, False) if no sorted index can answer any part of the query.
+        exact is true if the index answered the whole query. prefers the index on the first sort key 
+        so the results don't need to be sorted again '''
+    if not cls.CACHE_SORTED_INDEXES:
+        return None, None, False
+    try:
+        indexes = SORTED_INDEXES[cls.COLLECTION_NAME]
+    except KeyError:
+        return None, None, False
+    keys = [key for key in query if key in indexes]
+    if sort and sort[0][0] in keys:
+        keys.remove(sort[0][0])
+        keys.insert(0, sort[0][0])
+    for key in keys:
+        with lock:
+            if indexes[key].has_lists():
+                continue
+        value = query[key]
+        if type(value) is dict:
+            if len(value) == 0 or not _RANGE_OPERATORS.issuperset(value.keys()):
+                continue
+            lower, lower_inclusive = (value['$gt'], False) if '$gt' in value else (value.get('$gte'), True)
+            upper, upper_inclusive = (value['$lt'], False) if '$lt' in value else (value.get('$lte'), True)
+            if lower is None and upper is None:
+                continue
+        elif type(value) is list or value is None:
+            continue
+        else:
+            lower = upper = value
+            lower_inclusive = upper_inclusive = True
+        #the range only uses one bound a side, redundant ones like {'$gt':3, '$gte':5} still need the predicate
+        exact = len(query) == 1 and (type(value) is not dict or (None not in value.values() and 
+                    not ('$gt' in value and '$gte' in value) and not ('$lt' in value and '$lte' in value)))
+        with lock:
+            return indexes[key].range(lower, lower_inclusive, upper, upper_inclusive), key, exact
+    return None, None, False
 
 def from_id(_id, collection_name):
     if _id in RAM:
@@ -77,104 +411,84 @@ def find_one(cls, query):
         for x in RAM.values():
             if type(x) is cls:
                 return x
-    elif '_id' in query:
-        return from_id(query['_id'], cls.COLLECTION_NAME)
-    try:
-        with lock:
-            l = list(RAM_ALL[cls.COLLECTION_NAME])
-        for x in l:
-            is_true = True
-            for key in query.keys():
-                if getattr(x, key, None) != query[key]:
-                    is_true = False
-                    break
-            if is_true:
-                return x
-    except KeyError:
-        return None
+    predicate = compile_query(query)
+    l = _from_id_query(cls, query)
+    if l is None:
+        l = _from_indexes(cls, query)
+    if l is None:
+        l = _from_sorted_indexes(cls, query, None)[0]
+    if l is None:
+        try:
+            with lock:
+                l = list(RAM_ALL[cls.COLLECTION_NAME])
+        except KeyError:
+            return None
+    for x in l:
+        if predicate(x):
+            return x
+    return None
 
 
 def _sort(dataset, sort):
     if sort:
-        if len(sort) == 1:
-            return sorted(dataset, key=attrgetter(sort[0][0]), reverse=sort[0][1]==-1)
-        for sortKey, sortDirection in reversed(sort):
-            dataset = iter(sorted(dataset, key = attrgetter(sortKey), reverse = sortDirection < 0))
+        return sorted(dataset, key=sort_keys(sort)[0])
     return dataset
 
+def _from_id_query(cls, query):
+    ''' _id and _id $in queries are answered straight out of RAM, returns None for anything else '''
+    if '_id' not in query:
+        return None
+    value = query['_id']
+    if type(value) is dict:
+        if len(value) != 1 or '$in' not in value:
+            return None
+        ids = value['$in']
+    else:
+        ids = (value,)
+    rv = []
+    for _id in ids:
+        try:
+            x = RAM.get(_id)
+        except TypeError:
+            continue
+        if x is not None and x.COLLECTION_NAME == cls.COLLECTION_NAME:
+            rv.append(x)
+    return rv
+
 def find(cls, query, sort):
     ''' find (should be mostly like pymongo find) '''
-    
-    def search(search_set, query):
-        return_values = set([])
-        if query == {}:
-            try:
-                l = list(RAM_ALL[cls.COLLECTION_NAME])
-                return [x for x in l]
-            except KeyError:
-                return []
-
-        if '_id' in query:
-            if not isinstance(query['_id'], dict):
-                try:
-                    return [RAM[query['_id']]]
-                except KeyError:
-                    return []
-
-        if '$or' == query.keys()[0] and len(query) == 1:
-            lol = [search(search_set, x) for x in query['$or']] #list of lists (lol)
-            return set(itertools.chain(*lol))
-
-        if '$and' == query.keys()[0] and len(query) == 1:
-            lol = [search(search_set, x) for x in query['$and']]
-            return set.intersection(*lol)
-
-        if len(query) > 1:
-            lol = [search(search_set, {k:v}) for k,v in query.items()]
-            return set.intersection(*lol)
-
-        key = query.keys()[0]
-        for x in search_set:
-            is_true = True
-            if type(query[key]) is dict:
-                if query[key] == {}:
-                    is_true = getattr(x,key, None) == query[key]
-                    break
-                query_keys = query[key].keys()
-                supported = ('$in', '$ne', '$gt', '$nin')
-                if len(query_keys) == 1 and query_keys[0] in supported:
-                    if query_keys[0] == '$in':
-                        is_true = getattr(x, key, None) in query[key]['$in']
-                    elif query_keys[0] == '$nin':
-                        is_true = getattr(x, key, None) not in query[key]['$nin']
-                    elif query_keys[0] == '$ne':
-                        is_true = getattr(x, key, None) != query[key]['$ne']
-                    elif query_keys[0] == '$gt':
-                        is_true = getattr(x, key, None) > query[key]['$gt']
-                else:
-                    raise WhiskeyCacheException('Whiskey cache only supports the %s paramater, for deeper searches like [%s] with key [%s], use the COLLECTION' % (str(supported), str(query[key]),key))
-            elif type(query[key]) is list:
-                if query[key] == []:
-                    is_true = getattr(x,key,None) == [] #com doesn't work for empty lists too well
-                else:
-                    is_true = cmp(query[key], getattr(x,key,None))
-                #print "is_true is " + str(is_true) + ' wanted: ' + str(query[key]) + ' got: ' + str(getattr(x,key,None))
-            else:
-                #print "Not a list or dict"
-                is_true = getattr(x,key, None) == query[key]
-            
-            if is_true:
-                #print "APPEND"
-                return_values.add(x)
-        
-        return return_values
+    predicate = compile_query(query)
+    l = _from_id_query(cls, query)
+    if l is None:
+        l = _from_indexes(cls, query)
+    if l is not None:
+        return _sort([x for x in l if predicate(x)], sort)
+    l, field, exact = _from_sorted_indexes(cls, query, sort)
+    if l is not None:
+        if not exact:
+            l = [x for x in l if predicate(x)]
+        if sort and len(sort) == 1 and sort[0][0] == field:
+            return l if sort[0][1] == 1 else l[::-1]
+        return _sort(l, sort)
+    try:
+        with lock:
+            l = list(RAM_ALL[cls.COLLECTION_NAME]) #i think i need the list here for weakref reasons
+    except KeyError:
+        return []
+    if query:
+        l = [x for x in l if predicate(x)]
+    return _sort(l, sort)
 
+def find_unmatched(cls, query):
+    ''' saved nodes in RAM that don't match the query, their documents in the db still might if they changed locally.
+        nodes that can't be checked without loading fields are left out, the db decides for them '''
+    predicate = compile_query(query)
     try:
-        l = list(RAM_ALL[cls.COLLECTION_NAME])
+        with lock:
+            l = list(RAM_ALL[cls.COLLECTION_NAME])
     except KeyError:
         return []
-    else:
-        return _sort(search(l, query), sort) #i think i need the list here for weakref reasons
+    return [x for x in l if not x._is_new_local and predicate(x) is False]
 
 def _quick_sort(values):
     pass